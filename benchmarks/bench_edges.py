@@ -0,0 +1,87 @@
+# Benchmark of grid_stretch.infer_axis_scale's edge detection: the packed-pixel
+# engine (grid_stretch.axis_edges) against the original per-row/per-column
+# implementation it replaced
+#
+# Run from the top-level directory with:
+#   python benchmarks/bench_edges.py
+
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+import fix  # noqa: E402
+import grid_stretch  # noqa: E402
+
+
+def legacy_axis_edges(frames, axis):
+    # The original edge detection: a full-size array of differences, then a
+    # Python-level call of any_nonzero() for every row/column of every frame
+    # and channel
+    size = frames.shape[axis]
+    pixel_diffs = np.take(frames, np.arange(1, size), axis=axis) - np.take(
+        frames, np.arange(0, size - 1), axis=axis
+    )
+    v_axis, h_axis = grid_stretch.spatial_axes(frames)
+    other_spatial_axis = v_axis if axis != v_axis else h_axis
+    edges = np.apply_along_axis(
+        grid_stretch.any_nonzero, axis=other_spatial_axis, arr=pixel_diffs
+    )
+    edges = np.any(edges, axis=1)
+    return np.any(edges, axis=0)
+
+
+def synthetic_frames(num_frames, native_size, rng):
+    # Random RGBA frames at a native resolution, stretched onto an uneven grid of
+    # 2- and 3-pixel blocks, with axes ordered as in fix.process_image()
+    height, width = native_size
+    native = rng.integers(0, 4, size=(num_frames, height, width, 4), dtype=np.uint8)
+    native = np.repeat(native, rng.integers(2, 4, size=height), axis=1)
+    native = np.repeat(native, rng.integers(2, 4, size=width), axis=2)
+    return fix.spatial_axes_to_end(native)
+
+
+def time_both(name, frames, repeat=3):
+    v_axis, h_axis = grid_stretch.spatial_axes(frames)
+
+    for axis in (v_axis, h_axis):
+        assert np.array_equal(
+            grid_stretch.axis_edges(frames, axis), legacy_axis_edges(frames, axis)
+        )
+
+    def legacy():
+        legacy_axis_edges(frames, v_axis)
+        legacy_axis_edges(frames, h_axis)
+
+    def packed():
+        grid_stretch.axis_edges(frames, v_axis)
+        grid_stretch.axis_edges(frames, h_axis)
+
+    legacy_time = min(timeit.repeat(legacy, number=1, repeat=repeat))
+    packed_time = min(timeit.repeat(packed, number=1, repeat=repeat))
+
+    print(
+        f"{name:<32} {str(frames.shape):<22} "
+        f"legacy {legacy_time * 1000:9.1f} ms   "
+        f"packed {packed_time * 1000:8.1f} ms   "
+        f"speedup {legacy_time / packed_time:6.1f}x"
+    )
+
+
+def main():
+    rng = np.random.default_rng(seed=0)
+
+    image = Image.open(Path(__file__).parents[1] / "test/images/smwgreen_x3.gif")
+    frames = fix.spatial_axes_to_end(fix.PIL_image_to_ndarray(image))
+    time_both("smwgreen_x3.gif", frames)
+
+    time_both("synthetic 100 frames 256x224", synthetic_frames(100, (224, 256), rng))
+    time_both("synthetic 400 frames 160x144", synthetic_frames(400, (144, 160), rng))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# Comparison of the output formats (see fix.py's --format): the size of each output,
+# and the time taken to process and save it, for each of the given recordings
+#
+# Run from the top-level directory with e.g.:
+#   python benchmarks/bench_formats.py examples/toy_in.gif examples/real_in.gif
+
+import argparse
+import io
+import json
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+import fix  # noqa: E402
+import io_tools  # noqa: E402
+
+DEFAULT_PATHS = [
+    "examples/trivial_in.gif",
+    "examples/toy_in.gif",
+    "examples/real_in.gif",
+    "examples/mario_86x54_animated.gif",
+]
+
+
+def benchmark_format(path, output_format, repeat=3):
+    # Size of the output in the given format, and the fastest of several runs of the
+    # whole pipeline (decoding, processing and saving, in memory)
+    options = fix.parse_args([str(path), "--format", output_format])
+    seconds = []
+    for _ in range(repeat):
+        output = io.BytesIO()
+        start = time.perf_counter()
+        fix.run_pipeline(path, output, options)
+        seconds.append(time.perf_counter() - start)
+
+    return {"bytes": len(output.getvalue()), "seconds": min(seconds)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("paths", nargs="*", default=DEFAULT_PATHS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", type=str)
+    args = parser.parse_args(argv)
+
+    results = []
+    for path in args.paths:
+        result = {"path": path, "input_bytes": Path(path).stat().st_size}
+        print(f"{path} ({result['input_bytes'] / 1000:.1f} kB)")
+        for output_format in sorted(io_tools.OUTPUT_FORMATS):
+            result[output_format] = benchmark_format(path, output_format, args.repeat)
+            print(
+                f"  {output_format:<5} {result[output_format]['bytes'] / 1000:9.1f} kB "
+                f"{result[output_format]['seconds'] * 1000:9.1f} ms"
+            )
+        results.append(result)
+
+    if args.out is not None:
+        with open(args.out, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+# Benchmark of decimating and upscaling: the fused single-gather kernel
+# (grid_stretch.decimate_and_upscale) against grid_stretch.mask_by_row_indices
+# followed by grid_stretch.integer_upscale
+#
+# Run from the top-level directory with:
+#   python benchmarks/bench_gather.py
+
+import sys
+import timeit
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+import fix  # noqa: E402
+import grid_stretch  # noqa: E402
+
+
+def synthetic_frames(num_frames, native_size, rng):
+    # Random RGBA frames at a native resolution, stretched onto an uneven grid of
+    # 2- and 3-pixel blocks, with axes ordered as in fix.process_image()
+    height, width = native_size
+    native = rng.integers(0, 4, size=(num_frames, height, width, 4), dtype=np.uint8)
+    native = np.repeat(native, rng.integers(2, 4, size=height), axis=1)
+    native = np.repeat(native, rng.integers(2, 4, size=width), axis=2)
+    return fix.spatial_axes_to_end(native)
+
+
+def time_both(name, frames, scale, repeat=3):
+    grid_indices, _ = grid_stretch.analyze_grid_edges(*grid_stretch.grid_edges(frames))
+
+    def separate():
+        return grid_stretch.integer_upscale(
+            grid_stretch.mask_by_row_indices(frames, grid_indices), scale
+        )
+
+    def fused():
+        return grid_stretch.decimate_and_upscale(frames, grid_indices, scale)
+
+    assert np.array_equal(separate(), fused())
+
+    separate_time = min(timeit.repeat(separate, number=1, repeat=repeat))
+    fused_time = min(timeit.repeat(fused, number=1, repeat=repeat))
+
+    print(
+        f"{name:<32} scale {str(scale):<8} "
+        f"separate {separate_time * 1000:8.1f} ms   "
+        f"fused {fused_time * 1000:8.1f} ms   "
+        f"speedup {separate_time / fused_time:5.1f}x"
+    )
+
+
+def main():
+    rng = np.random.default_rng(seed=0)
+
+    image = Image.open(Path(__file__).parents[1] / "test/images/smwgreen_x3.gif")
+    frames = fix.spatial_axes_to_end(fix.PIL_image_to_ndarray(image))
+    time_both("smwgreen_x3.gif", frames, (3, 3))
+    time_both("smwgreen_x3.gif", frames, (6, 6))
+
+    frames = synthetic_frames(200, (144, 160), rng)
+    time_both("synthetic 200 frames 160x144", frames, (2, 2))
+    time_both("synthetic 200 frames 160x144", frames, (6, 6))
+
+
+if __name__ == "__main__":
+    main()
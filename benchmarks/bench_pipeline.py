@@ -0,0 +1,280 @@
+# Benchmark of the whole pipeline, stage by stage, over a synthetic corpus of
+# emulator recordings (see corpus.py): the time taken and the peak memory used by
+# each stage, along with a check of the results against the corpus' ground truth
+#
+# Results are saved as JSON, so that they can be compared between commits. Run from
+# the top-level directory with e.g.:
+#   python benchmarks/bench_pipeline.py --frames 50 500 --out results.json
+#   python benchmarks/bench_pipeline.py --frames 50 500 --compare results.json
+# (or with --corpus, to use a corpus already written by corpus.py)
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+sys.path.insert(0, str(Path(__file__).parent))
+
+import corpus  # noqa: E402
+
+import fix  # noqa: E402
+import grid_stretch  # noqa: E402
+import io_tools  # noqa: E402
+
+
+def stages(case, out_path):
+    # The pipeline's stages, in order, as (name, function) pairs: each function takes
+    # and returns a dict holding the intermediate results so far
+    def decode(state):
+        state["img"] = Image.open(case["path"])
+        state["frames"] = fix.spatial_axes_to_end(
+            fix.PIL_image_to_ndarray(state["img"])
+        )
+        return state
+
+    def consistent_pure_transparency(state):
+        fix.consistent_pure_transparency(state["frames"])
+        state["has_transparency"] = fix.uses_transparency(
+            fix.spatial_axes_before_channels(state["frames"])
+        )
+        return state
+
+    def analyze_input_grid(state):
+        state["grid"] = grid_stretch.analyze_input_grid(state["frames"])
+        return state
+
+    def mask_by_row_indices(state):
+        grid_indices = state["grid"][0]
+        state["native"] = grid_stretch.mask_by_row_indices(
+            state["frames"], grid_indices
+        )
+        return state
+
+    def integer_upscale(state):
+        scale = tuple(state["grid"][1])
+        state["output"] = fix.spatial_axes_before_channels(
+            grid_stretch.integer_upscale(state["native"], scale)
+        )
+        return state
+
+    def decimate_and_upscale(state):
+        # (The fused replacement for the two stages above, as used by process_image)
+        grid_indices, scale = state["grid"]
+        state["fused_output"] = fix.spatial_axes_before_channels(
+            grid_stretch.decimate_and_upscale(
+                state["frames"], grid_indices, tuple(scale)
+            )
+        )
+        return state
+
+    def save_from_frames(state):
+        io_tools.save_from_frames(
+            state["img"],
+            state["output"],
+            out_path,
+            state["has_transparency"],
+            optimize=False,
+        )
+        return state
+
+    return [
+        ("decode", decode),
+        ("consistent_pure_transparency", consistent_pure_transparency),
+        ("analyze_input_grid", analyze_input_grid),
+        ("mask_by_row_indices", mask_by_row_indices),
+        ("integer_upscale", integer_upscale),
+        ("decimate_and_upscale", decimate_and_upscale),
+        ("save_from_frames", save_from_frames),
+    ]
+
+
+def run_pipeline(case, out_path, measure_memory=False):
+    # Run every stage once, returning the final state along with each stage's time
+    # (in seconds) or, with measure_memory, the peak memory it allocated on top of
+    # what was already allocated when it started (in bytes)
+    measurements = {}
+    state = {}
+    for name, stage in stages(case, out_path):
+        if measure_memory:
+            tracemalloc.reset_peak()
+            start = tracemalloc.get_traced_memory()[0]
+            state = stage(state)
+            measurements[name] = tracemalloc.get_traced_memory()[1] - start
+        else:
+            start = time.perf_counter()
+            state = stage(state)
+            measurements[name] = time.perf_counter() - start
+
+    return state, measurements
+
+
+def check(case, state, out_path):
+    # Compare the pipeline's results against the case's ground truth: the grid, the
+    # native-resolution frames recovered by decimation, and the saved output
+    native, palette = corpus.case_native_frames(case)
+    expected = np.full(shape=native.shape + (4,), fill_value=255, dtype=np.uint8)
+    expected[..., 0:3] = palette[native]
+    if case["transparent"]:
+        expected[native == 0] = 0
+
+    def normalized(frames):
+        frames = np.array(frames)
+        frames[frames[..., 3] == 0] = 0
+        return frames
+
+    grid_indices, grid_scale = state["grid"]
+    recovered = fix.spatial_axes_before_channels(state["native"])
+    scale = tuple(grid_scale)
+    saved = np.stack(
+        [
+            frame.convert("RGBA")
+            for frame in ImageSequence.Iterator(Image.open(out_path))
+        ]
+    )
+    upscaled = np.repeat(np.repeat(expected, scale[0], axis=1), scale[1], axis=2)
+
+    return {
+        "grid": all(
+            np.array_equal(found, truth)
+            for found, truth in zip(grid_indices, case["grid_indices"])
+        )
+        and [int(s) for s in grid_scale] == case["grid_scale"],
+        "native_frames": np.array_equal(normalized(recovered), expected),
+        "fused_output": np.array_equal(state["fused_output"], state["output"]),
+        "output": np.array_equal(normalized(saved), upscaled),
+    }
+
+
+def benchmark_case(case, scratch, repeat=3):
+    out_path = Path(scratch) / f"{case['name']}_out.gif"
+
+    # Timings: the fastest of several runs, for each stage
+    timings = []
+    for _ in range(repeat):
+        state, seconds = run_pipeline(case, out_path)
+        timings.append(seconds)
+
+    # Peak memory: from a separate run, since tracing allocations slows it down
+    tracemalloc.start()
+    _, peaks = run_pipeline(case, out_path, measure_memory=True)
+    total_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    correct = check(case, state, out_path)
+    results = {
+        name: {
+            "seconds": min(timing[name] for timing in timings),
+            "peak_bytes": peaks[name],
+        }
+        for name in timings[0]
+    }
+
+    return {
+        "case": case["name"],
+        "frames": case["frames"],
+        "native_size": case["native_size"],
+        "display_size": case["display_size"],
+        "transparent": case["transparent"],
+        "stages": results,
+        "total_seconds": sum(stage["seconds"] for stage in results.values()),
+        "peak_bytes": total_peak,
+        "correct": correct,
+    }
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+
+
+def print_result(result, baseline=None):
+    status = "ok" if all(result["correct"].values()) else f"WRONG {result['correct']}"
+    print(
+        f"{result['case']}: {result['total_seconds'] * 1000:.1f} ms total, "
+        f"peak {result['peak_bytes'] / 2**20:.1f} MiB, {status}"
+    )
+    for name, stage in result["stages"].items():
+        line = (
+            f"  {name:<30} {stage['seconds'] * 1000:9.1f} ms "
+            f"{stage['peak_bytes'] / 2**20:9.1f} MiB"
+        )
+        if baseline is not None and name in baseline["stages"]:
+            before = baseline["stages"][name]["seconds"]
+            line += f"   {before / max(stage['seconds'], 1e-9):5.2f}x vs baseline"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", type=str)
+    parser.add_argument("--frames", type=int, nargs="+", default=[50, 200])
+    parser.add_argument(
+        "--native", type=corpus.size_arg, nargs="+", default=[(40, 30), (256, 224)]
+    )
+    parser.add_argument("--display", type=corpus.size_arg, nargs="+")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--out", type=str)
+    parser.add_argument("--compare", type=str)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as scratch:
+        if args.corpus is not None:
+            with open(Path(args.corpus) / "corpus.json") as fp:
+                cases = json.load(fp)
+        else:
+            # By default, every native size is stretched to a little over twice its
+            # size, unevenly (like 40x30 onto 86x54)
+            cases = []
+            for native_size in args.native:
+                display_sizes = args.display or [
+                    (native_size[0] * 43 // 20, native_size[1] * 9 // 5)
+                ]
+                cases += corpus.make_corpus(
+                    scratch, args.frames, [native_size], display_sizes
+                )
+
+        baselines = {}
+        if args.compare is not None:
+            with open(args.compare) as fp:
+                baselines = {
+                    result["case"]: result for result in json.load(fp)["results"]
+                }
+
+        results = []
+        for case in cases:
+            result = benchmark_case(case, scratch, args.repeat)
+            print_result(result, baselines.get(case["name"]))
+            results.append(result)
+
+    if args.out is not None:
+        with open(args.out, "w") as fp:
+            json.dump({"environment": environment(), "results": results}, fp, indent=2)
+
+    return 0 if all(all(result["correct"].values()) for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# Generator of a synthetic corpus of "emulator recordings": native-resolution sprite
+# animations, stretched onto uneven grids the way an emulator's nearest-neighbour
+# resize does (e.g. 40x30 onto 86x54), written as GIFs along with their ground truth
+#
+# Run from the top-level directory with e.g.:
+#   python benchmarks/corpus.py corpus/ --frames 50 500 --native 40x30 --display 86x54
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parents[1] / "src"))
+
+import gif_writer  # noqa: E402
+import grid_stretch  # noqa: E402
+
+
+def stretch_indices(native_size, display_size):
+    # For each of the display_size rows (or columns) an emulator displays, the
+    # native row (or column) it shows, when resizing with nearest-neighbour sampling
+    # (pixel centers mapped back onto the native grid)
+    display = np.arange(display_size)
+    return ((2 * display + 1) * native_size) // (2 * display_size)
+
+
+def ground_truth_grid(native_size, display_size):
+    # Indices at which each block starts after stretching, and the most common block
+    # length: exactly what grid analysis should find
+    source = stretch_indices(native_size, display_size)
+    starts = np.flatnonzero(np.diff(source, prepend=-1))
+    lengths = np.diff(np.append(starts, display_size))
+    return starts, int(grid_stretch.np_mode(lengths))
+
+
+def sprite_animation(num_frames, native_size, rng, num_sprites=4, transparent=False):
+    # Frames of palette indices with shape (# of frames, height, width), at the
+    # native resolution: sprites moving over a tiled background, plus the palette
+    #
+    # The background guarantees that every pair of adjacent native rows and columns
+    # differs somewhere (so every block boundary is detectable); with transparent,
+    # index 0 is transparent, and used for a border around the background
+    width, height = native_size
+    rows, columns = np.indices((height, width))
+    background = 1 + (rows + 2 * columns) % 4
+
+    sprites = rng.integers(5, 16, size=(num_sprites, 4, 4), dtype=np.uint8)
+    positions = rng.integers(0, [height, width], size=(num_sprites, 2))
+    velocities = rng.integers(-1, 2, size=(num_sprites, 2))
+
+    frames = np.empty(shape=(num_frames, height, width), dtype=np.uint8)
+    for index in range(num_frames):
+        frame = background.copy()
+        if transparent:
+            frame[0, :] = frame[:, 0] = 0
+        for sprite, (top, left) in zip(sprites, positions):
+            frame[top : top + 4, left : left + 4] = sprite[
+                : height - top, : width - left
+            ]
+        frames[index] = frame
+        positions = (positions + velocities) % [height, width]
+
+    palette = rng.integers(0, 256, size=(16, 3), dtype=np.uint8)
+    return frames, palette
+
+
+def stretch(frames, display_size):
+    # Nearest-neighbour resize of frames with shape (..., height, width) to the given
+    # (width, height), like an emulator displaying them at that size
+    height, width = frames.shape[-2:]
+    display_width, display_height = display_size
+    frames = np.take(frames, stretch_indices(height, display_height), axis=-2)
+    return np.take(frames, stretch_indices(width, display_width), axis=-1)
+
+
+def write_gif(path, frames, palette, transparency=None, duration=20):
+    # Written with GifWriter rather than PIL, since PIL merges identical consecutive
+    # frames itself
+    height, width = frames.shape[-2:]
+    with open(path, "wb") as fp, gif_writer.GifWriter(fp, size=(width, height)) as w:
+        for frame in frames:
+            w.write_frame(
+                gif_writer.palette_image(frame, palette),
+                duration=duration,
+                disposal=1 if transparency is None else 2,
+                transparency=transparency,
+            )
+
+
+def case_name(num_frames, native_size, display_size, transparent=False):
+    name = f"native{native_size[0]}x{native_size[1]}_"
+    name += f"display{display_size[0]}x{display_size[1]}_{num_frames}f"
+    return name + ("_transparent" if transparent else "")
+
+
+def case_native_frames(case):
+    # The native-resolution frames (and palette) a case was made from, regenerated
+    # from its description
+    rng = np.random.default_rng(case["seed"])
+    return sprite_animation(
+        case["frames"], case["native_size"], rng, transparent=case["transparent"]
+    )
+
+
+def make_case(
+    directory, num_frames, native_size, display_size, seed=0, transparent=False
+):
+    # Write a single recording to the given directory, returning its description,
+    # including the ground truth grid (as JSON-friendly lists)
+    name = case_name(num_frames, native_size, display_size, transparent)
+    v_starts, v_scale = ground_truth_grid(native_size[1], display_size[1])
+    h_starts, h_scale = ground_truth_grid(native_size[0], display_size[0])
+    case = {
+        "name": name,
+        "path": str(Path(directory) / f"{name}.gif"),
+        "frames": num_frames,
+        "native_size": list(native_size),
+        "display_size": list(display_size),
+        "transparent": transparent,
+        "seed": seed,
+        "grid_indices": [v_starts.tolist(), h_starts.tolist()],
+        "grid_scale": [v_scale, h_scale],
+    }
+
+    frames, palette = case_native_frames(case)
+    write_gif(
+        case["path"],
+        stretch(frames, display_size),
+        palette,
+        0 if transparent else None,
+    )
+    return case
+
+
+def make_corpus(directory, frame_counts, native_sizes, display_sizes, seed=0):
+    # Every combination of frame count, native size and display size, with and
+    # without transparency; the descriptions are also written to corpus.json
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    cases = []
+    for num_frames in frame_counts:
+        for native_size in native_sizes:
+            for display_size in display_sizes:
+                for transparent in (False, True):
+                    cases.append(
+                        make_case(
+                            directory,
+                            num_frames,
+                            native_size,
+                            display_size,
+                            seed,
+                            transparent,
+                        )
+                    )
+
+    with open(Path(directory) / "corpus.json", "w") as fp:
+        json.dump(cases, fp, indent=2)
+    return cases
+
+
+def size_arg(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory")
+    parser.add_argument("--frames", type=int, nargs="+", default=[50])
+    parser.add_argument("--native", type=size_arg, nargs="+", default=[(40, 30)])
+    parser.add_argument("--display", type=size_arg, nargs="+", default=[(86, 54)])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    cases = make_corpus(
+        args.directory, args.frames, args.native, args.display, args.seed
+    )
+    for case in cases:
+        print(case["path"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import asyncio
+import functools
+import io
+
+import fix
+
+# Library API: fix an image held in memory, without touching the filesystem (and
+# without argparse or paths), e.g. for embedding in a web service:
+#
+#   output = api.fix_image(data, force_square=True)
+#   output = await api.fix_image_async(data, force_square=True)
+#
+# The input is given either as bytes, or as a binary file object, and the output is
+# returned as bytes, in the same format as the input (e.g. GIF or PNG) unless an
+# output_format is given. The options are the same as fix.py's commandline options
+# of the same name, plus optimize (on by default), which writes animations as
+# deltas between frames (see gif_writer.DeltaGifWriter).
+
+
+def fix_image(
+    data,
+    force_square=False,
+    force_scale=None,
+    transparent=False,
+    collapse_duplicates=False,
+    fast_grid=False,
+    optimize=True,
+    output_format=None,
+):
+    # Fix the given image (bytes or a binary file object), returning the output's
+    # bytes; force_scale is either a single scale, or a (vertical, horizontal) pair,
+    # and output_format is one of io_tools.OUTPUT_FORMATS (e.g. "webp")
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = io.BytesIO(data)
+    if isinstance(force_scale, int):
+        force_scale = [force_scale]
+
+    options = fix.parse_args(["-"])
+    options.force_square = force_square
+    options.force_scale = None if force_scale is None else list(force_scale)
+    options.transparent = transparent
+    options.collapse_duplicates = collapse_duplicates
+    options.fast_grid = fast_grid
+    options.format = output_format
+
+    output = io.BytesIO()
+    fix.run_pipeline(data, output, options, optimize)
+    return output.getvalue()
+
+
+async def fix_image_async(data, executor=None, **options):
+    # Same as fix_image(), run in the given concurrent.futures executor (the event
+    # loop's default one, i.e. a thread pool, if None), so that the event loop
+    # isn't blocked in the meantime
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        executor, functools.partial(fix_image, data, **options)
+    )
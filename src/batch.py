@@ -0,0 +1,285 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import io_tools
+
+# Name of the manifest kept in the output directory by incremental runs (--incremental)
+MANIFEST_NAME = ".fix-pixel-grid-manifest.json"
+
+# Options that don't affect the outputs themselves (only where they go, how they're
+# reported, or how fast they're made), so changing them doesn't make outputs stale
+RUN_OPTIONS = {
+    "paths",
+    "out",
+    "verbose",
+    "jobs",
+    "scratch",
+    "summary",
+    "profile",
+    "incremental",
+    "tile_threads",
+    "threads",
+    "memmap",
+    "max_memory",
+    "grid_cache",
+    "grid_cache_size",
+    "reference_grid",
+}
+
+
+def file_hash(path):
+    # Hash of a file's contents (or an archive member's, see io_tools.open_input()),
+    # read in chunks
+    digest = hashlib.sha256()
+    with io_tools.open_input(path) as fp:
+        for chunk in iter(lambda: fp.read(2**20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def grid_hash(reference_grid):
+    # Hash of a grid given with --grid-from (its input's size, along with the grid,
+    # see fix.reference_grid()), so that outputs made with it go stale when it changes
+    size, ((v_indices, h_indices), scale) = reference_grid
+    grid = [list(size), [int(i) for i in v_indices], [int(i) for i in h_indices]]
+    grid.append([int(s) for s in scale])
+    return hashlib.sha256(json.dumps(grid).encode()).hexdigest()
+
+
+def tool_version():
+    # Version of the tool itself: a hash of its source files, so that any change to
+    # the processing makes previous outputs stale
+    digest = hashlib.sha256()
+    for path in sorted(Path(__file__).parent.glob("*.py")):
+        digest.update(path.name.encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()[:16]
+
+
+class Manifest:
+    # Record of how each output in an output directory was made (its input's hash,
+    # the options used, and the tool's version), so that re-running over the same
+    # inputs can skip the ones whose outputs are already up to date, without even
+    # decoding them
+
+    def __init__(self, directory):
+        self.path = Path(directory) / MANIFEST_NAME
+        self.version = tool_version()
+        try:
+            with open(self.path) as fp:
+                self.outputs = json.load(fp)
+        except (FileNotFoundError, ValueError):
+            self.outputs = {}
+
+    def entry(self, in_path, options):
+        # What an output made from the given input, with the given options, is
+        # recorded as (a grid given with --grid-from by its hash, since the file it
+        # came from can change without its path changing)
+        entry_options = {
+            name: value
+            for name, value in sorted(vars(options).items())
+            if name not in RUN_OPTIONS
+        }
+        if getattr(options, "reference_grid", None) is not None:
+            entry_options["reference_grid_sha256"] = grid_hash(options.reference_grid)
+
+        return {
+            "input_sha256": file_hash(in_path),
+            "options": entry_options,
+            "version": self.version,
+        }
+
+    def key(self, out_path):
+        # Outputs are recorded by their path within the output directory (which
+        # includes the subdirectories of inputs that came from an archive)
+        return Path(out_path).relative_to(self.path.parent).as_posix()
+
+    def up_to_date(self, out_path, entry):
+        return Path(out_path).exists() and self.outputs.get(self.key(out_path)) == entry
+
+    def record(self, out_path, entry):
+        self.outputs[self.key(out_path)] = entry
+
+    def save(self):
+        fd, temp_path = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(self.outputs, fp, indent=2, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+
+def skipped_result(in_path, out_path):
+    # Result for a job skipped by an incremental run, since its output is up to date
+    return {
+        "path": str(in_path),
+        "out_path": str(out_path),
+        "status": "skipped",
+        "error": None,
+        "seconds": None,
+    }
+
+
+def failed_result(in_path, out_path, exception, start):
+    # Result for a job that failed with the given exception (being handled), after
+    # starting at the given time.perf_counter()
+    return {
+        "path": str(in_path),
+        "out_path": str(out_path),
+        "status": "failed",
+        "error": f"{type(exception).__name__}: {exception}",
+        "traceback": traceback.format_exc(),
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def run_incremental_batch(
+    jobs, process_file, options, manifest, num_workers=1, scratch_dir=None
+):
+    # Same as run_batch(), except that jobs whose outputs the given manifest shows to
+    # be up to date are skipped, and the manifest is updated (and saved) with every
+    # output that is made
+    #
+    # An input that can't even be hashed (e.g. a missing file) fails on its own,
+    # like it would in run_batch(), without stopping the rest of the batch
+    results = []
+    entries = []
+    stale = []
+    for index, (in_path, out_path) in enumerate(jobs):
+        start = time.perf_counter()
+        try:
+            entries.append(manifest.entry(in_path, options))
+        except Exception as exception:
+            entries.append(None)
+            results.append(failed_result(in_path, out_path, exception, start))
+            continue
+
+        results.append(skipped_result(in_path, out_path))
+        if not manifest.up_to_date(out_path, entries[index]):
+            stale.append(index)
+
+    stale_results = run_batch(
+        [jobs[index] for index in stale],
+        process_file,
+        options,
+        num_workers,
+        scratch_dir,
+    )
+    for index, result in zip(stale, stale_results):
+        results[index] = result
+        if result["status"] == "ok":
+            manifest.record(result["out_path"], entries[index])
+
+    manifest.save()
+    return results
+
+
+def run_job(process_file, in_path, out_path, options, scratch_dir=None):
+    # Process a single file with process_file(in_path, out_path, options), never
+    # raising: any failure is reported in the returned result instead (and whatever
+    # process_file() returns, e.g. its metrics, is included in it as "metrics")
+    #
+    # The output is first written into a scratch directory of this job's own, and
+    # only moved to out_path once it's complete, so concurrent jobs never share
+    # temporary files and a failed job never leaves a partial output behind
+    start = time.perf_counter()
+    result = {"path": str(in_path), "out_path": str(out_path)}
+
+    try:
+        with tempfile.TemporaryDirectory(
+            prefix="fix-pixel-grid-", dir=scratch_dir
+        ) as scratch:
+            scratch_path = Path(scratch) / Path(out_path).name
+            result["metrics"] = process_file(in_path, scratch_path, options)
+            shutil.move(scratch_path, out_path)
+
+        result["status"] = "ok"
+        result["error"] = None
+    except Exception as exception:
+        result["status"] = "failed"
+        result["error"] = f"{type(exception).__name__}: {exception}"
+        result["traceback"] = traceback.format_exc()
+
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def run_batch(
+    jobs, process_file, options, num_workers=1, scratch_dir=None, on_result=None
+):
+    # Run process_file() for every (in_path, out_path) pair in jobs, spread across
+    # the given number of worker processes, returning each job's result (in the same
+    # order as jobs)
+    #
+    # on_result, if given, is called with each job's result (in the same order) as
+    # soon as it's available, e.g. to move its output somewhere else right away
+    if on_result is None:
+        on_result = lambda result: None  # noqa: E731
+
+    if num_workers <= 1 or len(jobs) <= 1:
+        results = []
+        for in_path, out_path in jobs:
+            results.append(
+                run_job(process_file, in_path, out_path, options, scratch_dir)
+            )
+            on_result(results[-1])
+        return results
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(
+                run_job, process_file, in_path, out_path, options, scratch_dir
+            )
+            for in_path, out_path in jobs
+        ]
+
+        results = []
+        for (in_path, out_path), future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except Exception as exception:
+                # The worker process itself died (e.g. killed for running out of
+                # memory), so the job couldn't report its own failure
+                results.append(
+                    {
+                        "path": str(in_path),
+                        "out_path": str(out_path),
+                        "status": "failed",
+                        "error": f"{type(exception).__name__}: {exception}",
+                        "seconds": None,
+                    }
+                )
+            on_result(results[-1])
+
+    return results
+
+
+def print_summary(results):
+    # One line per file, followed by the totals
+    print("Summary:")
+    for result in results:
+        if result["status"] == "ok":
+            print(f"  ok      {result['path']} -> {result['out_path']}", end="")
+            print(f" ({result['seconds']:.2f}s)")
+        elif result["status"] == "skipped":
+            print(f"  skipped {result['path']} (up to date)")
+        else:
+            print(f"  FAILED  {result['path']}: {result['error']}")
+
+    num_skipped = sum(result["status"] == "skipped" for result in results)
+    num_failed = sum(result["status"] == "failed" for result in results)
+    num_processed = len(results) - num_skipped
+    print(
+        f"{num_processed} processed ({num_processed - num_failed} succeeded, "
+        f"{num_failed} failed), {num_skipped} skipped"
+    )
+
+
+def write_summary(results, summary_path):
+    with open(summary_path, "w") as fp:
+        json.dump(results, fp, indent=2)
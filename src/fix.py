@@ -1,11 +1,25 @@
 import argparse
+import contextlib
+import itertools
+import json
+import logging
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import numpy as np
 from PIL import Image, ImageSequence
 
+import batch
+import gif_writer
+import grid_cache
 import grid_stretch
 import io_tools
+import pipeline
+import stage_metrics
+
+logger = logging.getLogger(__name__)
 
 
 def consistent_pure_transparency(frames, set_RGB_to=255):
@@ -17,6 +31,19 @@ def consistent_pure_transparency(frames, set_RGB_to=255):
     frames[indices[0], 0:3, indices[1], indices[2]] = set_RGB_to
 
 
+def uses_transparency(frames, chunk_frames=None):
+    # Whether any pixel of the given frames, with shape
+    #   (# of frames, height, width, 4)
+    # is purely transparent (Alpha = 0): a single pass over the alpha channel, with
+    # no temporary arrays (and with chunk_frames, only that many frames at a time,
+    # e.g. for np.memmap-backed frames)
+    chunk_frames = chunk_frames or max(len(frames), 1)
+    return any(
+        frames[start : start + chunk_frames, ..., 3].min() == 0
+        for start in range(0, len(frames), chunk_frames)
+    )
+
+
 def spatial_axes_to_end(frames):
     # Switch the axes' order from
     #   (frame #, vertical, horizontal, color channel)
@@ -47,48 +74,1155 @@ def PIL_image_to_ndarray(img):
     )
 
 
-def process_image(img, force_square_aspect=False, force_scale=None):
-    # TODO: This WILL be renamed, and everything is going to be refactored anyway
+class DecodedFrames:
+    # An input image's frames, decoded in a single pass over them (see
+    # decode_frames()), along with everything else about the image that the rest of
+    # the pipeline needs, so that nothing (e.g. saving) has to go back to the image
+    # and decode its frames again:
+    #
+    #   frames        RGBA frames with shape (# of frames, height, width, 4), or
+    #                 palette indices with shape (# of frames, height, width, 1)
+    #   durations     each frame's duration (in miliseconds)
+    #   palette       for palette indices, the palette they index into, with shape
+    #                 (# of colors, 3), and its transparency index (or None)
+    #   format, is_animated, info
+    #                 the same as the PIL image's (e.g. info's "loop", see
+    #                 io_tools.output_loop())
+    #
+    # (Frames are fully composited as they're decoded, so the input's disposal
+    # methods don't apply to them any more: how output frames are disposed of only
+    # depends on their transparency)
 
-    frames = PIL_image_to_ndarray(img)
+    def __init__(self, img, frames, durations, palette=None, transparency=None):
+        self.frames = frames
+        self.durations = list(durations)
+        self.palette = palette
+        self.transparency = transparency
+        self.format = img.format
+        self.is_animated = len(frames) > 1
+        self.info = dict(img.info)
 
-    print(f"Frames shape: {frames.shape}")
-    print(f"{frames[0,:,:,3]}")
+    @property
+    def is_indexed(self):
+        return self.palette is not None
 
-    frames = spatial_axes_to_end(frames)
 
-    # Make RGB values for pure-transparent pixels the same everywhere
-    consistent_pure_transparency(frames)
+def decode_frames(img, executor=None, memmap_path=None, indexed=True):
+    # Decode every frame of the image, in a single pass, into a DecodedFrames: as
+    # palette indices if indexed and the image allows it (see PIL_image_to_indices()),
+    # and otherwise as RGBA, either in memory, or, with a memmap_path, into a
+    # np.memmap-backed array in a (scratch) file at that path, one frame at a time,
+    # so that the frames don't have to fit in memory
+    #
+    # (Only a GIF that turns out not to be representable as indices partway through
+    # its frames has those frames decoded again, as RGBA)
+    #
+    # With an executor (see pipeline.frame_executor()), frames are still read one
+    # after another, but each one is converted to RGBA on the executor
+    if indexed and memmap_path is None:
+        result = PIL_image_to_indices(img)
+        if result is not None:
+            frames, palette, transparency, durations = result
+            return DecodedFrames(img, frames, durations, palette, transparency)
 
-    # Get indices of starts of blocks, and apparent scales of the spatial axes
-    grid_indices, grid_scale = grid_stretch.analyze_input_grid(frames)
+    durations = []
+
+    def read_frames():
+        for frame in ImageSequence.Iterator(img):
+            durations.append(frame.info.get("duration", 0))
+            yield frame if executor is None else frame.copy()
+
+    converted = pipeline.ordered_map(
+        lambda frame: np.asarray(frame.convert("RGBA")), read_frames(), executor
+    )
+    if memmap_path is None:
+        frames = np.stack(list(converted), axis=0)
+    else:
+        shape = (getattr(img, "n_frames", 1), img.height, img.width, 4)
+        frames = np.memmap(memmap_path, dtype=np.uint8, mode="w+", shape=shape)
+        for index, frame in enumerate(converted):
+            frames[index] = frame
+
+    return DecodedFrames(img, frames, durations)
+
+
+def decode_image(img, executor=None):
+    # Same as PIL_image_to_ndarray(), but also returning each frame's duration
+    # (in miliseconds), read during the same pass over the frames
+    decoded = decode_frames(img, executor, indexed=False)
+    return decoded.frames, decoded.durations
+
+
+def estimated_frames_bytes(img):
+    # Memory taken up by all of the image's frames once decoded as RGBA, as by
+    # decode_image() (without actually decoding any of them)
+    return getattr(img, "n_frames", 1) * img.height * img.width * 4
+
+
+def decode_image_to_memmap(img, path):
+    # Same as decode_image(), but decoding the frames one at a time into a
+    # np.memmap-backed array in a (scratch) file at the given path, so that the
+    # frames don't have to fit in memory
+    decoded = decode_frames(img, memmap_path=path)
+    return decoded.frames, decoded.durations
+
+
+# Longest duration a single GIF frame can have (delays are stored as 16-bit counts
+# of centiseconds)
+MAX_FRAME_DURATION = 655350
+
+
+def same_as_previous(frames):
+    # Boolean array with shape (# of frames,), True for each frame that is identical
+    # to the frame right before it (emulator recordings often repeat frames, e.g.
+    # a 60fps game recorded at 30fps or vice versa, or the game lagging)
+    #
+    # Frames are compared as flat runs of 8-byte integers whenever possible, rather
+    # than one 1-byte color value at a time
+    flat = np.ascontiguousarray(frames).reshape((len(frames), -1))
+    if flat.dtype.itemsize == 1 and flat.shape[1] % 8 == 0:
+        flat = flat.view(np.uint64)
+
+    same = np.zeros(shape=(len(frames),), dtype=bool)
+    for index in range(1, len(frames)):
+        same[index] = np.array_equal(flat[index], flat[index - 1])
+    return same
+
+
+def collapse_duplicate_frames(
+    frames, durations, max_duration=MAX_FRAME_DURATION, in_place=False
+):
+    # Collapse each run of identical consecutive frames into a single frame, shown
+    # for the run's total duration (so that the run is only processed and encoded
+    # once, while the animation's timing stays the same)
+    #
+    # Returns the remaining frames and their durations; with in_place, the remaining
+    # frames are moved to the front of frames itself (e.g. a np.memmap-backed array),
+    # instead of being copied into a new array
+    same = same_as_previous(frames)
+
+    keep = []
+    collapsed_durations = []
+    for index, duration in enumerate(durations):
+        if same[index] and collapsed_durations[-1] + duration <= max_duration:
+            collapsed_durations[-1] += duration
+        else:
+            keep.append(index)
+            collapsed_durations.append(duration)
+
+    if len(keep) == len(frames):
+        return frames, list(durations)
+
+    if in_place:
+        for new_index, index in enumerate(keep):
+            frames[new_index] = frames[index]
+        return frames[: len(keep)], collapsed_durations
+
+    return frames[keep], collapsed_durations
+
+
+def collapse_duplicate_runs(frames_and_durations, max_duration=MAX_FRAME_DURATION):
+    # Same as collapse_duplicate_frames(), for an iterable of (frame array, duration)
+    # pairs, so that only one frame is held at a time
+    previous, total_duration = None, 0
+    for frames, duration in frames_and_durations:
+        if (
+            previous is not None
+            and total_duration + duration <= max_duration
+            and np.array_equal(frames, previous)
+        ):
+            total_duration += duration
+            continue
+
+        if previous is not None:
+            yield previous, total_duration
+        previous, total_duration = frames, duration
+
+    if previous is not None:
+        yield previous, total_duration
+
+
+def pack_RGB(colors):
+    # Pack the RGB values of an array with shape (..., 3) (or (..., 4), ignoring
+    # Alpha) into single integers, with shape (...)
+    colors = colors.astype(np.uint32)
+    return colors[..., 0] | (colors[..., 1] << 8) | (colors[..., 2] << 16)
+
+
+def canonical_palette_indices(palette, transparency=None):
+    # Lookup table mapping each palette index to the first index with the same
+    # color, so that two pixels' (mapped) indices are equal exactly when their
+    # colors are (palettes often contain the same color more than once, e.g. as
+    # padding); the transparency index is only ever equal to itself
+    packed = pack_RGB(palette)
+    if transparency is not None:
+        packed[transparency] = 1 << 24
+
+    _, first_indices, inverse = np.unique(
+        packed, return_index=True, return_inverse=True
+    )
+    lookup = np.zeros(shape=(256,), dtype=np.uint8)
+    lookup[: len(palette)] = first_indices[inverse.reshape((-1,))]
+    return lookup
+
+
+class PaletteRemapper:
+    # Maps frames decoded as RGB(A) (e.g. GIF frames after the first, which may also
+    # have their own local palettes) back onto palette indices into the given
+    # palette, one frame after another
+    #
+    # Consecutive frames of an animation are composited over each other, so only
+    # the pixels that changed since the previous frame are looked up in the palette
+
+    def __init__(self, palette, transparency=None):
+        self.palette_packed = pack_RGB(palette)
+        if transparency is not None:
+            # The transparency index can't stand in for any opaque color
+            self.palette_packed[transparency] = 1 << 24
+        self.transparency = transparency
+        self.order = np.argsort(self.palette_packed, kind="stable")
+        self.sorted_packed = self.palette_packed[self.order]
+        self.previous = None
+
+    def set_previous(self, indices):
+        # The previous frame, given as palette indices (e.g. the first frame)
+        self.previous = (self.palette_packed[indices], indices)
+
+    def remap(self, frame):
+        # Palette indices for the next frame, or None if any of its colors is
+        # missing from the palette
+        #
+        # (Pixels are packed by viewing their RGBA bytes as little-endian integers,
+        # which gives the same packed RGB values as pack_RGB(), plus Alpha << 24)
+        packed = np.asarray(frame.convert("RGBA")).view("<u4")[..., 0]
+        transparent = packed < (1 << 24)
+        packed = np.where(transparent, np.uint32(1 << 24), packed & 0xFFFFFF)
+        if self.transparency is None and np.any(transparent):
+            return None
+
+        if self.previous is None:
+            changed = np.ones(packed.shape, dtype=bool)
+            indices = np.zeros(packed.shape, dtype=np.uint8)
+        else:
+            changed = packed != self.previous[0]
+            indices = self.previous[1].copy()
+
+        changed_packed = packed[changed]
+        positions = np.searchsorted(self.sorted_packed, changed_packed)
+        changed_indices = self.order[np.minimum(positions, len(self.order) - 1)]
+        if not np.array_equal(self.palette_packed[changed_indices], changed_packed):
+            return None
+        indices[changed] = changed_indices
+
+        self.previous = (packed, indices)
+        return indices
+
+
+def PIL_image_to_indices(img):
+    # Palette-index alternative to PIL_image_to_ndarray() for GIFs that share a
+    # single (global) palette: a multi-dimensional numpy array with shape
+    #   (# of frames, height, width, 1)
+    # where the value at (f, i, j, 0) is the palette index of pixel (i,j) in frame #f
+    #
+    # Returns the array, the palette (with shape (# of colors, 3)), the transparency
+    # index (or None) and each frame's duration, or None if the image can't be
+    # represented this way (e.g. frames use colors that are missing from the global
+    # palette, or transparency without the first frame having a transparency index)
+    if img.format != "GIF":
+        return None
+
+    frames = []
+    durations = []
+
+    for index, frame in enumerate(ImageSequence.Iterator(img)):
+        if index == 0:
+            # The first frame's palette is the global palette
+            if frame.mode != "P":
+                return None
+            palette = np.asarray(frame.getpalette(), dtype=np.uint8)
+            palette = palette.reshape((-1, 3))
+            transparency = frame.info.get("transparency")
+            indices = np.array(frame)
+            remapper = PaletteRemapper(palette, transparency)
+            remapper.set_previous(indices)
+        else:
+            # PIL composites every frame after the first as RGB(A) (its loading
+            # strategy is process-wide, so it's left as is), so these are mapped back
+            # onto the global palette: exactly the colors (and transparency) of the
+            # RGBA decoding, whatever each frame's own palette and transparency index
+            indices = remapper.remap(frame)
+            if indices is None:
+                return None
+
+        frames.append(indices)
+        durations.append(frame.info.get("duration", 0))
+
+    return np.stack(frames, axis=0)[..., np.newaxis], palette, transparency, durations
+
+
+def batched_frames(frames_iterable, batch_size):
+    # Group an iterable of frame arrays (each of shape (1, # channels, h, w)) into
+    # arrays of (at most) batch_size frames each
+    batch = []
+    for frames in frames_iterable:
+        batch.append(frames)
+        if len(batch) == batch_size:
+            yield np.concatenate(batch, axis=0)
+            batch = []
+    if batch:
+        yield np.concatenate(batch, axis=0)
+
+
+def frame_to_ndarray(frame):
+    # Convert a single frame to a numpy array of shape
+    #   (1, # of color channels, height, width)
+    # i.e. the same layout as the full stack of frames used by process_image()
+    return spatial_axes_to_end(np.array(frame.convert("RGBA"))[np.newaxis])
 
+
+def choose_output_scale(grid_scale, force_square_aspect=False, force_scale=None):
     # Choose the vertical/horizontal size of the "pixels" (blocks) in the output
     if force_square_aspect:
         max_scale = np.max(grid_scale)
-        out_scale = (max_scale, max_scale)
+        return (max_scale, max_scale)
     elif force_scale is not None:
-        out_scale = force_scale if len(force_scale) == 2 else (force_scale, force_scale)
+        # Either two ints (vertical and horizontal scale), or one int used for both
+        force_scale = np.reshape(force_scale, (-1,))
+        return tuple(force_scale) if len(force_scale) == 2 else (force_scale[0],) * 2
     else:
-        out_scale = grid_scale
+        return grid_scale
+
+
+def analyze_grid(
+    frames, fast_grid=None, cached_grid=None, chunk_frames=None, executor=None
+):
+    # Get indices of starts of blocks, and apparent scales of the spatial axes,
+    # either with a full scan of every frame (if fast_grid is None), or with
+    # grid_stretch.analyze_input_grid_fast() given fast_grid as keyword arguments
+    # (falling back to a full scan if that doesn't converge)
+    #
+    # With a cached_grid (a grid_cache.CachedGrid or FixedGrid), its grid is used
+    # as-is if there is one, and otherwise the newly-analyzed grid is stored in it
+    #
+    # With chunk_frames, a full scan only looks at that many frames at a time, and
+    # with an executor (see tile_executor()), it's done strip by strip in parallel
+    with stage_metrics.stage("analyze_grid", frames):
+        return analyze_grid_uncounted(
+            frames, fast_grid, cached_grid, chunk_frames, executor
+        )
+
+
+def analyze_grid_uncounted(frames, fast_grid, cached_grid, chunk_frames, executor):
+    if cached_grid is not None:
+        grid = cached_grid.load()
+        if grid is not None:
+            check_grid(grid, frames.shape[-2:])
+            return grid
+
+    grid = None
+    if fast_grid is not None:
+        grid, converged = grid_stretch.analyze_input_grid_fast(frames, **fast_grid)
+        if not converged:
+            logger.info(
+                "Fast grid inference did not converge, falling back to a full scan"
+            )
+            grid = None
+
+    if grid is None and chunk_frames is None:
+        grid = grid_stretch.analyze_input_grid(frames, executor)
+    elif grid is None:
+        batches = (
+            frames[start : start + chunk_frames]
+            for start in range(0, len(frames), chunk_frames)
+        )
+        v_edges, h_edges, _ = grid_stretch.accumulate_grid_edges(batches)
+        grid = grid_stretch.analyze_grid_edges(v_edges, h_edges)
+
+    if cached_grid is not None:
+        cached_grid.save(grid)
+
+    return grid
+
+
+def check_grid(grid, size):
+    # Make sure a grid that wasn't analyzed from the frames themselves (e.g. a cached
+    # one) fits frames of the given (height, width) size
+    for indices, length in zip(grid[0], size):
+        if len(indices) == 0 or indices[0] != 0 or indices[-1] >= length:
+            raise ValueError(
+                f"Grid with blocks up to {tuple(int(i[-1]) for i in grid[0])} "
+                f"doesn't fit frames of size {tuple(size)}"
+            )
+
+
+@contextlib.contextmanager
+def tile_executor(frames, tile_threads=None, executor=None):
+    # Thread pool on which a still image (a single frame) is processed in strips of
+    # rows (see grid_stretch.row_strips()), when tile_threads is given, or None if
+    # the frames are processed whole instead
+    #
+    # An already-running executor (e.g. for --threads) is used as-is instead, for
+    # any number of frames
+    if executor is not None:
+        yield executor
+        return
+
+    if not tile_threads or frames.shape[0] != 1:
+        yield None
+        return
+
+    with ThreadPoolExecutor(max_workers=tile_threads) as executor:
+        yield executor
 
-    output_frames = grid_stretch.mask_by_row_indices(frames, grid_indices)
 
-    output_frames = grid_stretch.integer_upscale(output_frames, out_scale)
+def process_image(
+    img, force_square_aspect=False, force_scale=None, fast_grid=None, cached_grid=None
+):
+    # TODO: This WILL be renamed, and everything is going to be refactored anyway
+    return process_frames(
+        PIL_image_to_ndarray(img),
+        force_square_aspect,
+        force_scale,
+        fast_grid,
+        cached_grid,
+    )
+
+
+def process_frames(
+    frames,
+    force_square_aspect=False,
+    force_scale=None,
+    fast_grid=None,
+    cached_grid=None,
+    tile_threads=None,
+    upscale=True,
+    has_transparency=None,
+    executor=None,
+):
+    # Same as process_image(), for frames that have already been decoded (with shape
+    # (# of frames, height, width, 4), as returned by PIL_image_to_ndarray())
+    #
+    # has_transparency is whether any pixel is purely transparent, if already known
+    # (see uses_transparency()); if none are, there's nothing to make consistent
+    #
+    # With tile_threads, a still image is processed in strips of rows, on that many
+    # threads, so that no full-size temporaries are made (see tile_executor()); with
+    # an executor, frames of any kind are processed on it instead
+    #
+    # Without upscale, the frames are returned at the native resolution instead,
+    # along with the (vertical, horizontal) scale to upscale them by, e.g. as they're
+    # saved (see io_tools.save_from_frames())
+    logger.debug("Frames shape: %s", frames.shape)
+
+    if has_transparency is None:
+        has_transparency = uses_transparency(frames)
+
+    frames = spatial_axes_to_end(frames)
+
+    with tile_executor(frames, tile_threads, executor) as executor:
+        # Make RGB values for pure-transparent pixels the same everywhere
+        if has_transparency:
+            with stage_metrics.stage("consistent_pure_transparency", frames):
+                if executor is None:
+                    consistent_pure_transparency(frames)
+                else:
+                    strips = grid_stretch.row_strips(frames.shape[-2])
+                    list(
+                        executor.map(
+                            lambda strip: consistent_pure_transparency(
+                                frames[..., strip, :]
+                            ),
+                            strips,
+                        )
+                    )
+
+        # Get indices of starts of blocks, and apparent scales of the spatial axes
+        grid_indices, grid_scale = analyze_grid(
+            frames, fast_grid, cached_grid, executor=executor
+        )
+
+        # Choose the vertical/horizontal size of the "pixels" (blocks) in the output
+        out_scale = choose_output_scale(grid_scale, force_square_aspect, force_scale)
+
+        # Keep only the first row and column of each block, and upscale by out_scale
+        with stage_metrics.stage("decimate_and_upscale", frames):
+            output_frames = grid_stretch.decimate_and_upscale(
+                frames,
+                grid_indices,
+                out_scale if upscale else (1, 1),
+                executor=executor,
+            )
 
     output_frames = spatial_axes_before_channels(output_frames)
 
+    if not upscale:
+        return output_frames, out_scale
+    return output_frames
+
+
+def process_frames_chunked(
+    frames,
+    out_path,
+    force_square_aspect=False,
+    force_scale=None,
+    fast_grid=None,
+    cached_grid=None,
+    chunk_frames=16,
+    upscale=True,
+    has_transparency=None,
+):
+    # Same as process_frames(), for frames that don't fit in memory (e.g. from
+    # decode_image_to_memmap()): each step only works on chunk_frames frames at a
+    # time, and the output frames are written into a np.memmap-backed array in a
+    # (scratch) file at out_path, which is returned (along with the scale, without
+    # upscale, as for process_frames())
+    if has_transparency is None:
+        has_transparency = uses_transparency(frames, chunk_frames)
+
+    frames = spatial_axes_to_end(frames)
+    chunks = [
+        slice(start, start + chunk_frames)
+        for start in range(0, len(frames), chunk_frames)
+    ]
+
+    # Make RGB values for pure-transparent pixels the same everywhere
+    for chunk in chunks if has_transparency else []:
+        with stage_metrics.stage("consistent_pure_transparency", frames[chunk]):
+            consistent_pure_transparency(frames[chunk])
+
+    # Get indices of starts of blocks, and apparent scales of the spatial axes
+    grid_indices, grid_scale = analyze_grid(
+        frames, fast_grid, cached_grid, chunk_frames
+    )
+
+    # Choose the vertical/horizontal size of the "pixels" (blocks) in the output
+    out_scale = choose_output_scale(grid_scale, force_square_aspect, force_scale)
+    scale = out_scale if upscale else (1, 1)
+
+    shape = (
+        len(frames),
+        len(grid_indices[0]) * scale[0],
+        len(grid_indices[1]) * scale[1],
+        4,
+    )
+    output_frames = np.memmap(out_path, dtype=np.uint8, mode="w+", shape=shape)
+
+    # Keep only the first row and column of each block, and upscale by out_scale
+    out = spatial_axes_to_end(output_frames)
+    for chunk in chunks:
+        with stage_metrics.stage("decimate_and_upscale", frames[chunk]):
+            grid_stretch.decimate_and_upscale(
+                frames[chunk], grid_indices, scale, out=out[chunk]
+            )
+
+    if not upscale:
+        return output_frames, out_scale
     return output_frames
 
 
-def main():
+def process_indexed_image(
+    frames,
+    palette,
+    transparency,
+    force_square_aspect=False,
+    force_scale=None,
+    fast_grid=None,
+    cached_grid=None,
+    tile_threads=None,
+    upscale=True,
+    executor=None,
+):
+    # Same as process_image(), but for frames of palette indices (as returned by
+    # PIL_image_to_indices()): grid analysis, decimation and upscaling all work
+    # directly on the 1-byte indices, so the output keeps the input's exact palette
+    #
+    # (As for process_frames(), without upscale, the frames are returned at the
+    # native resolution, along with the scale to upscale them by, and frames are
+    # processed on the executor, if any)
+    frames = spatial_axes_to_end(frames)
+
+    with tile_executor(frames, tile_threads, executor) as executor:
+        # Grid analysis compares pixels' indices, so indices of the same color have
+        # to be made the same first
+        lookup = canonical_palette_indices(palette, transparency)
+        grid_indices, grid_scale = analyze_grid(
+            lookup[frames], fast_grid, cached_grid, executor=executor
+        )
+
+        # Choose the vertical/horizontal size of the "pixels" (blocks) in the output
+        out_scale = choose_output_scale(grid_scale, force_square_aspect, force_scale)
+
+        # Keep only the first row and column of each block, and upscale by out_scale
+        with stage_metrics.stage("decimate_and_upscale", frames):
+            output_frames = grid_stretch.decimate_and_upscale(
+                frames,
+                grid_indices,
+                out_scale if upscale else (1, 1),
+                executor=executor,
+            )
+
+    # Drop the (single) channel axis: shape (# of frames, height, width)
+    if not upscale:
+        return output_frames[:, 0, :, :], out_scale
+    return output_frames[:, 0, :, :]
+
+
+def stream_image(
+    img,
+    out_path,
+    force_square_aspect=False,
+    force_scale=None,
+    fast_grid=None,
+    collapse_duplicates=False,
+    optimize=True,
+    cached_grid=None,
+    upscale=True,
+    executor=None,
+):
+    # Constant-memory alternative to process_image() followed by
+    # io_tools.save_from_frames(), for animated images: no matter how many frames
+    # there are, only about one input frame and one output frame are held in memory
+    #
+    # Pass one: walk the frames, keeping only the running row and column edges
+    # (with fast_grid, given as keyword arguments like for analyze_grid(), the walk
+    # stops as soon as the edges stop changing)
+    #
+    # With collapse_duplicates, runs of identical consecutive frames are only looked
+    # at once, and written as a single frame shown for the run's total duration
+    #
+    # With a cached_grid that already holds a grid (see analyze_grid()), pass one is
+    # skipped entirely
+    #
+    # Without upscale, the output is written at the native resolution, and with an
+    # executor, frames are encoded on it (see gif_writer.DeltaGifWriter)
+    scan = {"has_transparency": False, "num_frames": 0, "num_pixels": 0}
+
+    def decoded_frames():
+        frames_and_durations = (
+            (frame_to_ndarray(frame), frame.info.get("duration", 0))
+            for frame in ImageSequence.Iterator(img)
+        )
+        if collapse_duplicates:
+            frames_and_durations = collapse_duplicate_runs(frames_and_durations)
+        return frames_and_durations
+
+    def scanned_frames():
+        scan["complete"] = False
+        for frames, _ in decoded_frames():
+            if uses_transparency(spatial_axes_before_channels(frames)):
+                consistent_pure_transparency(frames)
+                scan["has_transparency"] = True
+            scan["num_frames"] += 1
+            scan["num_pixels"] += frames.shape[-2] * frames.shape[-1]
+            if scan["num_frames"] >= getattr(img, "n_frames", 1):
+                # (Known before the walk even asks for another frame, e.g. when it
+                # was cut short at exactly the number of frames)
+                scan["complete"] = True
+            yield frames
+        scan["complete"] = True
+
+    grid = None if cached_grid is None else cached_grid.load()
+    if grid is not None:
+        check_grid(grid, (img.height, img.width))
+
+        # None of the frames were looked at, so any of them might use transparency
+        has_transparency = True
+    else:
+        batches = scanned_frames()
+        patience, sample_step = None, 1
+        if fast_grid is not None:
+            # (With max_frames, no more than that many frames are looked at, falling
+            # back to a full scan if the edges hadn't stopped changing by then)
+            max_frames = fast_grid.get("max_frames")
+            if max_frames is not None:
+                batches = itertools.islice(batches, max_frames)
+            batch_size = fast_grid.get("batch_size", 4)
+            batches = batched_frames(batches, batch_size)
+            patience = fast_grid.get("patience", 3)
+            sample_step = fast_grid.get("sample_step", 1)
+
+        with stage_metrics.stage("scan") as counts:
+            v_edges, h_edges, stopped_early = grid_stretch.accumulate_grid_edges(
+                batches, patience, sample_step
+            )
+            if fast_grid is not None and not stopped_early and not scan["complete"]:
+                logger.info(
+                    "Fast grid inference did not converge, falling back to a full scan"
+                )
+                v_edges, h_edges, _ = grid_stretch.accumulate_grid_edges(
+                    scanned_frames()
+                )
+            counts["num_frames"] = scan["num_frames"]
+            counts["num_pixels"] = scan["num_pixels"]
+
+        # Frames that weren't looked at might use transparency too
+        has_transparency = scan["has_transparency"] or not scan["complete"]
+
+        grid = grid_stretch.analyze_grid_edges(v_edges, h_edges)
+        if cached_grid is not None:
+            cached_grid.save(grid)
+
+    grid_indices, grid_scale = grid
+    out_scale = choose_output_scale(grid_scale, force_square_aspect, force_scale)
+    stage_metrics.set_value("output_scale", [int(scale) for scale in out_scale])
+    if not upscale:
+        out_scale = (1, 1)
+
+    height_out = len(grid_indices[0]) * out_scale[0]
+    width_out = len(grid_indices[1]) * out_scale[1]
+
+    # Frames that use transparency have to be cleared before the next frame is drawn
+    # (otherwise the previous frame would show through their transparent pixels)
+    disposal = 2 if has_transparency else 1
+    stage_metrics.set_value("has_transparency", has_transparency)
+
+    # Pass two: decimate, upscale and encode one frame at a time (with optimize, see
+    # gif_writer.DeltaGifWriter, which also does the upscaling itself)
+    with stage_metrics.stage("encode") as counts, io_tools.output_file(out_path) as fp:
+        if optimize:
+            writer = gif_writer.DeltaGifWriter(
+                fp,
+                size=(width_out, height_out),
+                loop=io_tools.output_loop(img),
+                scale=out_scale,
+                executor=executor,
+            )
+        else:
+            writer = gif_writer.GifWriter(
+                fp, size=(width_out, height_out), loop=io_tools.output_loop(img)
+            )
+
+        with writer:
+            for frames, duration in decoded_frames():
+                counts["num_frames"] += 1
+                counts["num_pixels"] += frames.shape[-2] * frames.shape[-1]
+
+                native = grid_stretch.mask_by_row_indices(frames, grid_indices)
+                native = spatial_axes_before_channels(native)[0]
+                if optimize:
+                    writer.write_frame(native, duration=duration)
+                    continue
+
+                # Palette indices are found at the native resolution, and only the
+                # (1-byte) indices are upscaled
+                indices, palette, transparency = gif_writer.palettize(native)
+                indices = grid_stretch.integer_upscale(indices, out_scale)
+
+                writer.write_frame(
+                    gif_writer.palette_image(indices, palette),
+                    duration=duration,
+                    disposal=disposal,
+                    transparency=transparency,
+                )
+
+    stage_metrics.set_input_size(**counts)
+
+
+def fast_grid_options(options):
+    # Keyword arguments for grid_stretch.analyze_input_grid_fast() from the
+    # commandline options, or None if fast grid inference wasn't requested
+    if not options.fast_grid:
+        return None
+
+    return {
+        "patience": options.grid_patience,
+        "sample_step": options.grid_sample,
+        "max_frames": options.grid_max_frames,
+    }
+
+
+def grid_source(path_arg, img, options):
+    # Where the grid of an input comes from, given the (commandline) options: a
+    # grid_cache.FixedGrid for --grid-from, a grid_cache.CachedGrid for --grid-cache,
+    # or None if the grid is simply analyzed from the input itself
+    if options.reference_grid is not None:
+        size, grid = options.reference_grid
+        if img.size != size:
+            raise ValueError(
+                f"Input size {img.size} doesn't match the size {size} of the input "
+                "given with --grid-from"
+            )
+        return grid_cache.FixedGrid(grid)
+
+    if options.grid_cache is None:
+        return None
+
+    cache = grid_cache.GridCache(options.grid_cache, options.grid_cache_size * 2**20)
+
+    # Fast grid inference (which may stop before seeing every frame) can give a
+    # different grid than a full scan, so the entries are kept separate
+    analysis = [fast_grid_options(options), options.stream]
+    if options.grid_session is not None:
+        key = grid_cache.session_key(options.grid_session, img.size, analysis)
+    else:
+        key = grid_cache.content_key(path_arg, analysis)
+
+    return cache.entry(key)
+
+
+def reference_grid(path_arg, options):
+    # Analyze the grid of the input given with --grid-from, returning its size along
+    # with the grid, so it can be applied to other inputs of the same size
+    img = Image.open(path_arg)
+    fast_grid = fast_grid_options(options)
+    cached_grid = grid_source(path_arg, img, options)
+
+    frames = grid_analysis_frames(decode_frames(img))
+    return img.size, analyze_grid(frames, fast_grid, cached_grid)
+
+
+def grid_analysis_frames(decoded, chunk_frames=None):
+    # The frames of a DecodedFrames the way grid analysis looks at them, with shape
+    # (# of frames, # of channels, height, width): palette indices made comparable
+    # (see canonical_palette_indices()), or RGBA frames with pure-transparent pixels
+    # made consistent (in place, chunk_frames frames at a time, if given)
+    frames = spatial_axes_to_end(decoded.frames)
+    if decoded.is_indexed:
+        lookup = canonical_palette_indices(decoded.palette, decoded.transparency)
+        return lookup[frames]
+
+    chunk_frames = chunk_frames or max(len(frames), 1)
+    for start in range(0, len(frames), chunk_frames):
+        chunk = frames[start : start + chunk_frames]
+        if uses_transparency(spatial_axes_before_channels(chunk)):
+            consistent_pure_transparency(chunk)
+    return frames
+
+
+def grid_report(grid, size, options):
+    # Triage report on an input's grid (as JSON-friendly values), for --analyze-only:
+    # the grid itself (the first row and column of each block), a histogram of the
+    # blocks' lengths along each axis, the apparent (vertical, horizontal) scale, the
+    # (width, height) native size, with one pixel per block, and how confident the
+    # scale is along each axis (the fraction of blocks that are exactly that long)
+    #
+    # Inputs whose blocks all have the same length along each axis aren't distorted,
+    # and fixing them (at that scale) would give the same image back, so they're
+    # reported with the action "no-op" rather than "fix"
+    (rows, columns), grid_scale = grid
+    width, height = size
+    report = {
+        "size": [width, height],
+        "native_size": [len(columns), len(rows)],
+        "scale": [int(scale) for scale in grid_scale],
+        "grid": {
+            "rows": np.asarray(rows).tolist(),
+            "columns": np.asarray(columns).tolist(),
+        },
+        "block_lengths": {},
+        "confidence": {},
+    }
+
+    for axis, indices, length, scale in (
+        ("vertical", rows, height, grid_scale[0]),
+        ("horizontal", columns, width, grid_scale[1]),
+    ):
+        lengths = grid_stretch.block_lengths(indices, length)
+        values, counts = np.unique(lengths, return_counts=True)
+        report["block_lengths"][axis] = {
+            str(value): int(count) for value, count in zip(values, counts)
+        }
+        report["confidence"][axis] = float(np.mean(lengths == scale))
+
+    report["distorted"] = any(
+        len(histogram) > 1 for histogram in report["block_lengths"].values()
+    )
+    out_scale = choose_output_scale(
+        grid_scale, options.force_square, options.force_scale
+    )
+    unchanged = (
+        not report["distorted"]
+        and not options.native
+        and [int(scale) for scale in out_scale] == report["scale"]
+    )
+    report["action"] = "no-op" if unchanged else "fix"
+    return report
+
+
+def analyze_file(path_arg, out_path, options):
+    # Same as process_file(), for --analyze-only: only the input's grid is analyzed
+    # (nothing is upscaled or saved), and a triage report on it (see grid_report())
+    # is written as JSON to out_path, and included in the metrics as "report"
+    metrics = stage_metrics.Metrics(path_arg, trace_memory=options.profile is not None)
+    with metrics.activate():
+        with io_tools.open_input(path_arg) as fp:
+            report = analyze_input(path_arg, fp, options)
+        metrics.set("report", report)
+
+    with io_tools.output_file(out_path) as fp:
+        fp.write(json.dumps(report, indent=2).encode())
+    return metrics.to_dict()
+
+
+def analyze_input(path_arg, fp, options):
+    # The actual work of analyze_file()
+    img = Image.open(fp)
+    counts = {"num_frames": getattr(img, "n_frames", 1)}
+    counts["num_pixels"] = counts["num_frames"] * img.width * img.height
+    stage_metrics.set_input_size(**counts)
+    cached_grid = grid_source(path_arg, img, options)
+
+    # Header-only fast path: a grid that's already known (with --grid-from, or from
+    # --grid-cache) only needs the image's size, and none of its frames are decoded
+    grid = None if cached_grid is None else cached_grid.load()
+    decoded = grid is None
+    if grid is not None:
+        check_grid(grid, (img.height, img.width))
+    elif uses_memmap(img, options):
+        with tempfile.TemporaryDirectory(
+            prefix="fix-pixel-grid-", dir=options.scratch
+        ) as scratch:
+            with stage_metrics.stage("decode", **counts):
+                frames = decode_frames(img, memmap_path=Path(scratch) / "frames.bin")
+            frames = grid_analysis_frames(frames, chunk_frames=16)
+            grid = analyze_grid(
+                frames, fast_grid_options(options), cached_grid, chunk_frames=16
+            )
+            del frames
+    else:
+        with stage_metrics.stage("decode", **counts):
+            frames = grid_analysis_frames(decode_frames(img))
+        grid = analyze_grid(frames, fast_grid_options(options), cached_grid)
+
+    report = grid_report(grid, img.size, options)
+    report["num_frames"] = counts["num_frames"]
+    report["decoded"] = decoded
+    return report
+
+
+def process_file_memmap(
+    img, out_path, scratch, options, cached_grid=None, optimize=True
+):
+    # The part of process_file() for frames kept in np.memmap-backed arrays, in
+    # files in the given scratch directory, rather than in memory
+    with stage_metrics.stage("decode") as counts:
+        decoded = decode_frames(img, memmap_path=scratch / "frames.bin")
+        counts.update(frame_counts(decoded.frames))
+    stage_metrics.set_input_size(**counts)
+    frames, durations = decoded.frames, decoded.durations
+
+    if options.collapse_duplicates:
+        with stage_metrics.stage("collapse_duplicates", **counts):
+            frames, durations = collapse_duplicate_frames(
+                frames, durations, in_place=True
+            )
+
+    has_transparency = detect_transparency(frames, options, chunk_frames=16)
+
+    frames, out_scale = process_frames_chunked(
+        frames,
+        scratch / "output_frames.bin",
+        options.force_square,
+        options.force_scale,
+        fast_grid_options(options),
+        cached_grid,
+        upscale=False,
+        has_transparency=has_transparency,
+    )
+
+    with stage_metrics.stage("save", **frame_counts(frames)):
+        io_tools.save_from_frames(
+            decoded,
+            frames,
+            out_path,
+            has_transparency,
+            durations,
+            optimize,
+            output_scale(out_scale, options),
+            options.format,
+        )
+
+
+def detect_transparency(frames, options, chunk_frames=None):
+    # Whether the decoded frames (see uses_transparency()) need to be treated as
+    # transparent: if any of their pixels are, or with --transparent, always;
+    # recorded in the metrics either way
+    with stage_metrics.stage("detect_transparency", **frame_counts(frames)):
+        has_transparency = options.transparent or uses_transparency(
+            frames, chunk_frames
+        )
+    stage_metrics.set_value("has_transparency", bool(has_transparency))
+    return has_transparency
+
+
+def output_scale(out_scale, options):
+    # Scale to upscale native-resolution output frames by as they're saved: the
+    # chosen out_scale, or none at all with --native (out_scale is recorded in the
+    # metrics either way)
+    stage_metrics.set_value("output_scale", [int(scale) for scale in out_scale])
+    return (1, 1) if options.native else tuple(out_scale)
+
+
+def uses_memmap(img, options):
+    # Whether the image's frames are kept in (memory-mapped) scratch files rather
+    # than in memory: always with --memmap, or with --max-memory, if they'd take up
+    # more than that
+    memory_budget = None if options.max_memory is None else options.max_memory * 2**20
+    return options.memmap or (
+        memory_budget is not None and estimated_frames_bytes(img) > memory_budget
+    )
+
+
+def frame_counts(frames):
+    # Number of frames and pixels (as for stage_metrics.stage()) in frames with shape
+    # (# of frames, height, width[, # of color channels])
+    return {
+        "num_frames": frames.shape[0],
+        "num_pixels": frames.shape[0] * frames.shape[1] * frames.shape[2],
+    }
+
+
+def process_file(path_arg, out_path, options):
+    # Open, process and save a single image, with the given (commandline) options,
+    # returning the metrics of each stage of processing it (see stage_metrics.Metrics),
+    # as a dict; with --profile, they include each stage's peak memory use
+    metrics = stage_metrics.Metrics(path_arg, trace_memory=options.profile is not None)
+    with metrics.activate():
+        run_pipeline(path_arg, out_path, options)
+
+    return metrics.to_dict()
+
+
+def run_pipeline(path_arg, out_path, options, optimize=True):
+    # The actual work of process_file(); path_arg can also be an archive member
+    # (see io_tools.ArchiveMember), which is decoded straight from its archive, and
+    # path_arg and out_path can both be binary file objects, as long as the options
+    # don't involve any other files (e.g. --grid-cache, --memmap)
+    #
+    # With --threads, each frame's decoding, gathering and encoding is spread
+    # across a pool of that many threads (see pipeline.py)
+    with pipeline.frame_executor(options.threads) as executor:
+        with io_tools.open_input(path_arg) as fp:
+            run_pipeline_on(path_arg, fp, out_path, options, optimize, executor)
+
+
+def run_pipeline_on(path_arg, fp, out_path, options, optimize, executor):
+    logger.info("Processing image at %s", path_arg)
+
+    # TODO: IO exception handling (for bad paths), etc.
+    img = Image.open(fp)
+    logger.debug("Image object info: %s", img.info)
+
+    fast_grid = fast_grid_options(options)
+    cached_grid = grid_source(path_arg, img, options)
+
+    if options.stream and getattr(img, "is_animated", False):
+        # Process and save the image's frames one at a time
+        stream_image(
+            img,
+            out_path,
+            options.force_square,
+            options.force_scale,
+            fast_grid,
+            options.collapse_duplicates,
+            optimize,
+            cached_grid,
+            upscale=not options.native,
+            executor=executor,
+        )
+        return
+
+    if uses_memmap(img, options):
+        # Frames that might not fit in memory are kept in scratch files instead
+        with tempfile.TemporaryDirectory(
+            prefix="fix-pixel-grid-", dir=options.scratch
+        ) as scratch:
+            process_file_memmap(
+                img, out_path, Path(scratch), options, cached_grid, optimize
+            )
+        return
+
+    # Every frame is decoded exactly once, up front: GIFs with a single global
+    # palette as palette indices, anything else as RGBA
+    with stage_metrics.stage("decode") as counts:
+        decoded = decode_frames(img, executor)
+        counts.update(frame_counts(decoded.frames))
+    stage_metrics.set_input_size(**counts)
+    frames, durations = decoded.frames, decoded.durations
+
+    if decoded.is_indexed:
+        palette, transparency = decoded.palette, decoded.transparency
+        if options.collapse_duplicates:
+            with stage_metrics.stage("collapse_duplicates", **counts):
+                frames, durations = collapse_duplicate_frames(frames, durations)
+
+        # A transparency index that no pixel actually uses is simply dropped
+        with stage_metrics.stage("detect_transparency", **counts):
+            if transparency is not None and not np.any(frames == transparency):
+                transparency = None
+        stage_metrics.set_value("has_transparency", transparency is not None)
+
+        frames, out_scale = process_indexed_image(
+            frames,
+            palette,
+            transparency,
+            options.force_square,
+            options.force_scale,
+            fast_grid,
+            cached_grid,
+            options.tile_threads,
+            upscale=False,
+            executor=executor,
+        )
+        with stage_metrics.stage("save", **frame_counts(frames)):
+            io_tools.save_from_indexed_frames(
+                frames,
+                palette,
+                transparency,
+                durations,
+                out_path,
+                optimize,
+                output_scale(out_scale, options),
+                options.format,
+                executor,
+                decoded.is_animated,
+                io_tools.output_loop(decoded),
+            )
+        return
+
+    if options.collapse_duplicates:
+        with stage_metrics.stage("collapse_duplicates", **counts):
+            frames, durations = collapse_duplicate_frames(frames, durations)
+
+    has_transparency = detect_transparency(frames, options)
+
+    # The frames are kept at the native resolution, and only upscaled as they're
+    # saved, one at a time
+    frames, out_scale = process_frames(
+        frames,
+        options.force_square,
+        options.force_scale,
+        fast_grid,
+        cached_grid,
+        options.tile_threads,
+        upscale=False,
+        has_transparency=has_transparency,
+        executor=executor,
+    )
+
+    # Save the resulting frames as an image
+    with stage_metrics.stage("save", **frame_counts(frames)):
+        io_tools.save_from_frames(
+            decoded,
+            frames,
+            out_path,
+            has_transparency,
+            durations,
+            optimize,
+            output_scale(out_scale, options),
+            options.format,
+            executor,
+        )
+
+
+def parse_args(argv=None):
     # Commandline argument parsing
     parser = argparse.ArgumentParser()
 
-    # Files (or directories of files) to be processed
+    # Files (or directories of files, or zip/tar archives of files) to be processed
     parser.add_argument("paths", nargs="+")
 
-    # Optionally specify output directory
+    # Optionally specify output directory, or an output zip/tar archive
     # (./out/ will be used if not given)
     parser.add_argument("--out", type=str)
 
@@ -101,59 +1235,262 @@ def main():
     scale_options.add_argument("--force-square", action="store_true")
     scale_options.add_argument("--force-scale", type=int, nargs="+")
 
-    # TODO: implement a function that properly determines whether the image actually
-    # uses transparency (rather than e.g. just having an alpha channel, which may
-    # not actually be used)
+    # Treat inputs as transparent even if none of their pixels are (whether they are
+    # is otherwise detected automatically)
     parser.add_argument("--transparent", action="store_true")
 
-    args = parser.parse_args()
+    # Process animated images in two passes over their frames, so that memory use
+    # doesn't grow with the number of frames (for long recordings)
+    parser.add_argument("--stream", action="store_true")
 
-    # Paths of files to process
-    print(args.paths)
+    # Infer the grid from batches of frames, stopping once the grid stops changing
+    # (for the given number of consecutive batches), optionally only sampling every
+    # Nth row and column, and looking at no more than the given number of frames
+    # (falling back to looking at every frame if the grid hadn't stopped changing)
+    parser.add_argument("--fast-grid", action="store_true")
+    parser.add_argument("--grid-patience", type=int, default=3)
+    parser.add_argument("--grid-sample", type=int, default=1)
+    parser.add_argument("--grid-max-frames", type=int)
 
-    # Set output directory (./out/ by default)
-    out_directory = "./out/" if args.out is None else args.out
+    # Process still images (single frames) in strips of rows, on the given number of
+    # threads, e.g. for very large screenshots
+    parser.add_argument("--tile-threads", type=int)
+
+    # Decode, process and encode the frames of each animation on the given number of
+    # threads (with frames still handed out, and written, in order)
+    parser.add_argument("--threads", type=int)
+
+    # Save outputs at the native resolution (one pixel per block), rather than
+    # upscaled by the chosen scale (which is still recorded, e.g. with --profile)
+    parser.add_argument("--native", action="store_true")
+
+    # Save outputs in the given format, rather than the input's: lossless animated
+    # WebP or PNG keep exact colors without a palette, and are usually smaller
+    parser.add_argument("--format", choices=sorted(io_tools.OUTPUT_FORMATS))
+
+    # Process runs of identical consecutive frames only once, saving each run as a
+    # single frame shown for the run's total duration
+    parser.add_argument("--collapse-duplicates", action="store_true")
+
+    # Optionally cache grid analysis results in the given directory, keyed by the
+    # input's contents (or, with a session tag, by the input's size: every input of
+    # the same size within a session is assumed to share the same grid), evicting
+    # the least recently used entries once the cache exceeds the given size (in MiB)
+    parser.add_argument("--grid-cache", type=str)
+    parser.add_argument("--grid-cache-size", type=int, default=64)
+    parser.add_argument("--grid-session", type=str)
+
+    # Optionally analyze the grid of a single file, and apply it to every input
+    # (which must all be the same size as that file) instead of analyzing them
+    parser.add_argument("--grid-from", type=str)
+    parser.set_defaults(reference_grid=None)
+
+    # Keep decoded frames in (memory-mapped) scratch files instead of in memory,
+    # either always, or only for inputs whose decoded frames would take up more
+    # than the given amount of memory (in MiB)
+    parser.add_argument("--memmap", action="store_true")
+    parser.add_argument("--max-memory", type=int)
+
+    # Optionally write the wall time, frames and pixels per second, and peak memory
+    # use of each stage of processing each file, as JSON, to the given path
+    parser.add_argument("--profile", type=str)
+
+    # Log more details of what's going on (-v), or everything (-vv)
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+
+    # Number of files to process in parallel (each in its own worker process)
+    parser.add_argument("--jobs", type=int, default=1)
+
+    # Directory in which each file's own scratch directory is created
+    # (the system's temporary directory will be used if not given)
+    parser.add_argument("--scratch", type=str)
+
+    # Optionally write a per-file summary of the run, as JSON, to the given path
+    parser.add_argument("--summary", type=str)
+
+    # Only analyze the grid of each input, writing a JSON report on it (its grid,
+    # scale, native size, and whether it's distorted at all, see grid_report())
+    # instead of the fixed image
+    parser.add_argument("--analyze-only", action="store_true")
+
+    # Skip inputs whose outputs are already up to date (same input contents, options
+    # and tool version), as recorded in a manifest kept in the output directory
+    parser.add_argument("--incremental", action="store_true")
+
+    args = parser.parse_args(argv)
+    if args.stream and args.format not in (None, "gif"):
+        parser.error("--stream can only write GIFs")
+    if args.incremental and io_tools.is_archive(args.out or ""):
+        parser.error("--incremental needs an output directory, not an archive")
+    return args
+
+
+def output_paths(file_path_strings, out_directory, output_format=None, suffix=None):
+    # Output path for each of the files to be processed (with the extension of the
+    # given output format, if any, see io_tools.OUTPUT_FORMATS, or the given suffix)
+    rename = output_format is not None or suffix is not None
+    suffix = suffix or io_tools.OUTPUT_FORMATS.get(output_format, ".gif")
 
     # Create the output directory if it doesn't exist
     if not Path(out_directory).exists():
-        if out_directory.endswith(".gif"):
+        if out_directory.endswith(suffix):
             # If the given path includes a filename, create the directory containing it
             Path(out_directory).parents[0].mkdir(parents=True, exist_ok=True)
         else:
             # Otherwise, create the given path (a directory)
             Path(out_directory).mkdir(parents=True, exist_ok=True)
 
-    # Convert any supplied directory paths into paths to their files
-    file_path_strings = io_tools.directories_to_files(args.paths)
+    out_paths = []
 
     for path_arg in file_path_strings:
 
-        # Image object information
-        print(f"Processing image at {path_arg}:")
-
-        if (len(file_path_strings) == 1) and out_directory.endswith(".gif"):
+        if (len(file_path_strings) == 1) and out_directory.endswith(suffix):
             # If this is the only input file and the supplied output path includes
             # the desired output filename, use that as the filename
             filename = Path(out_directory).parts[-1]
             out_directory = Path(out_directory).parents[0]
         else:
             # Otherwise, the output filename will be the same as the input file
-            # (but in the output directory)
-            filename = Path(path_arg).parts[-1]
+            # (but in the output directory), keeping the subdirectories of files
+            # that came from an archive
+            if isinstance(path_arg, io_tools.ArchiveMember):
+                filename = path_arg.relative_path
+                (Path(out_directory) / filename).parent.mkdir(
+                    parents=True, exist_ok=True
+                )
+            else:
+                filename = Path(path_arg).parts[-1]
+            if rename:
+                filename = str(Path(filename).with_suffix(suffix))
+
+        out_paths.append(Path(out_directory) / filename)
+
+    return out_paths
+
+
+def duplicate_outputs(jobs):
+    # Output paths shared by several of the given (in_path, out_path) jobs, each with
+    # the inputs that share it
+    shared = {}
+    for in_path, out_path in jobs:
+        key = Path(out_path).resolve()
+        shared.setdefault(key, (Path(out_path), []))[1].append(in_path)
+    return {
+        out_path: in_paths
+        for out_path, in_paths in shared.values()
+        if len(in_paths) > 1
+    }
+
+
+def archive_outputs(archive, archive_path, staging_directory):
+    # Callback for batch.run_batch() that moves each output made in the staging
+    # directory into the given io_tools.ArchiveWriter as soon as it's done, so that
+    # only the outputs of jobs that are still in flight are ever on disk
+    def on_result(result):
+        if result["status"] != "ok":
+            return
+        out_path = Path(result["out_path"])
+        name = out_path.relative_to(staging_directory).as_posix()
+        archive.add(out_path, name)
+        out_path.unlink()
+        result["out_path"] = f"{archive_path}/{name}"
+
+    return on_result
+
 
-        out_path = Path(out_directory) / filename
+def main(argv=None):
+    args = parse_args(argv)
 
-        # TODO: IO exception handling (for bad paths), etc.
-        img = Image.open(path_arg)
-        print("Image object info:")
-        print(img.info)
+    # Only warnings (and errors) are logged by default
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)],
+        format="%(levelname)s %(name)s: %(message)s",
+    )
+
+    # Paths of files to process
+    logger.debug("Paths: %s", args.paths)
+
+    # Set output directory (./out/ by default)
+    out_directory = "./out/" if args.out is None else args.out
+
+    with contextlib.ExitStack() as stack:
+        # Archives that inputs are read from stay open until the batch is done
+        stack.callback(io_tools.close_archives)
+
+        # Convert any supplied directory (or archive) paths into paths to their files
+        file_path_strings = io_tools.directories_to_files(args.paths)
+
+        # With --analyze-only, each output is a JSON report instead of an image
+        process = analyze_file if args.analyze_only else process_file
+        suffix = ".json" if args.analyze_only else None
+
+        out_archive = None
+        if io_tools.is_archive(out_directory):
+            # Outputs are made in a staging directory, and each one is moved into
+            # the output archive as soon as it's done
+            out_archive = out_directory
+            out_directory = stack.enter_context(
+                tempfile.TemporaryDirectory(prefix="fix-pixel-grid-", dir=args.scratch)
+            )
+        out_paths = output_paths(file_path_strings, out_directory, args.format, suffix)
+        jobs = list(zip(file_path_strings, out_paths))
+
+        # Inputs that would end up with the same output (e.g. same-named members of
+        # different archives) are rejected up front, rather than one silently
+        # overwriting the other
+        duplicates = duplicate_outputs(jobs)
+        if duplicates:
+            for out_path, in_paths in duplicates.items():
+                logger.error(
+                    "Inputs with the same output %s: %s",
+                    out_path.relative_to(out_directory).as_posix(),
+                    ", ".join(str(in_path) for in_path in in_paths),
+                )
+            return 2
+
+        on_result = None
+        if out_archive is not None:
+            Path(out_archive).parent.mkdir(parents=True, exist_ok=True)
+            archive = stack.enter_context(io_tools.ArchiveWriter(out_archive))
+            on_result = archive_outputs(archive, out_archive, out_directory)
+
+        # The grid given with --grid-from is only analyzed once, for the whole batch
+        if args.grid_from is not None:
+            args.reference_grid = reference_grid(args.grid_from, args)
+
+        # Process every file (in parallel if requested), without letting a single
+        # failure abort the rest of the batch
+        if args.incremental:
+            manifest_directory = Path(out_directory)
+            if not manifest_directory.is_dir():
+                manifest_directory = manifest_directory.parent
+            manifest = batch.Manifest(manifest_directory)
+            results = batch.run_incremental_batch(
+                jobs,
+                process,
+                args,
+                manifest,
+                num_workers=args.jobs,
+                scratch_dir=args.scratch,
+            )
+        else:
+            results = batch.run_batch(
+                jobs,
+                process,
+                args,
+                num_workers=args.jobs,
+                scratch_dir=args.scratch,
+                on_result=on_result,
+            )
 
-        # Open and process image's frames as numpy arrays
-        frames = process_image(img, args.force_square, args.force_scale)
+    batch.print_summary(results)
+    if args.summary is not None:
+        batch.write_summary(results, args.summary)
+    if args.profile is not None:
+        stage_metrics.write_profile(results, args.profile)
 
-        # Save the resulting frames as an image
-        io_tools.save_from_frames(img, frames, out_path, args.transparent)
+    return 0 if all(result["status"] != "failed" for result in results) else 1
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,414 @@
+import collections
+import io
+import struct
+
+import numpy as np
+from PIL import Image
+
+
+def palettize(rgba, max_colors=256):
+    # Convert an array of RGBA pixels with shape (height, width, 4) into an array of
+    # palette indices with shape (height, width), plus the palette itself (with shape
+    # (# colors, 3)) and the transparency index (or None if nothing is transparent)
+    #
+    # As long as there are few enough distinct colors, there is no quantization:
+    # each distinct color gets its own palette entry, and all purely-transparent
+    # pixels (Alpha = 0) share a single palette entry
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    result = exact_palettize(rgba, max_colors)
+    if result is None:
+        transparent = rgba[..., 3] == 0
+        return quantize(rgba, transparent if np.any(transparent) else None)
+
+    return result
+
+
+def exact_palettize(rgba, max_colors=256):
+    # Same as palettize(), but giving None instead of quantizing when there are too
+    # many distinct colors
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    packed = rgba.view(np.uint32)[..., 0]
+
+    transparent = rgba[..., 3] == 0
+    has_transparency = bool(np.any(transparent))
+    if has_transparency:
+        packed = packed.copy()
+        packed[transparent] = 0
+
+    colors, indices = np.unique(packed, return_inverse=True)
+    if len(colors) > max_colors:
+        return None
+
+    palette = colors.view(np.uint8).reshape((-1, 4))[:, 0:3]
+    transparency = None
+    if has_transparency:
+        transparency = int(np.searchsorted(colors, 0))
+
+    indices = indices.reshape(packed.shape).astype(np.uint8)
+    return indices, palette, transparency
+
+
+def quantize(rgba, transparent=None):
+    # Fallback for palettize(), for frames with too many colors to keep them all:
+    # PIL's quantization, with the last palette entry reserved for transparency
+    image = Image.fromarray(rgba[..., 0:3], mode="RGB").quantize(colors=255)
+    indices = np.asarray(image).copy()
+    palette = np.asarray(image.getpalette(), dtype=np.uint8).reshape((-1, 3))
+
+    transparency = None
+    if transparent is not None:
+        transparency = 255
+        padded = np.zeros(shape=(256, 3), dtype=np.uint8)
+        padded[: min(len(palette), 255)] = palette[:255]
+        palette = padded
+        indices[transparent] = transparency
+
+    return indices, palette, transparency
+
+
+def reserve_transparency(rgba, indices, palette, transparency):
+    # Make sure the result of palettize() for the given RGBA pixels has a
+    # transparency index, even if none of the pixels use it: frames that are cleared
+    # after being shown (disposal method 2) are cleared to that index by decoders
+    # (and to the background color, an opaque palette entry, without one)
+    #
+    # A full palette leaves no room for it without quantizing the colors
+    if transparency is not None:
+        return indices, palette, transparency
+    if len(palette) < 256:
+        palette = np.concatenate([palette, np.zeros((1, 3), dtype=np.uint8)])
+        return indices, palette, len(palette) - 1
+    return quantize(rgba, np.zeros(rgba.shape[:-1], dtype=bool))
+
+
+def palette_image(indices, palette):
+    # Mode "P" PIL image from an array of palette indices and a palette given either
+    # as a flat sequence of RGB values or an array of shape (# colors, 3)
+    image = Image.fromarray(np.asarray(indices, dtype=np.uint8), mode="P")
+    image.putpalette(np.asarray(palette, dtype=np.uint8).reshape((-1,)).tolist())
+    return image
+
+
+def indices_to_rgba(indices, palette, transparency=None):
+    # Inverse of palettize(): RGBA pixels with shape (height, width, 4) from palette
+    # indices, the palette they index into, and the transparency index (if any)
+    rgba = np.full(shape=indices.shape + (4,), fill_value=255, dtype=np.uint8)
+    rgba[..., 0:3] = np.asarray(palette, dtype=np.uint8).reshape((-1, 3))[indices]
+    if transparency is not None:
+        rgba[indices == transparency] = 0
+    return rgba
+
+
+def upscale(pixels, scale):
+    # Nearest-neighbour upscale of pixels with shape (height, width[, ...]) by the
+    # given (vertical, horizontal) scale
+    v_scale, h_scale = scale
+    if (v_scale, h_scale) == (1, 1):
+        return pixels
+    return np.repeat(np.repeat(pixels, v_scale, axis=0), h_scale, axis=1)
+
+
+def split_gif_blocks(data):
+    # Split a single-frame GIF (as written by PIL) into its color table and the
+    # frame's compressed image data, i.e. the LZW minimum code size followed by the
+    # data sub-blocks and their terminator
+    flags = data[10]
+    position = 13
+
+    color_table = b""
+    if flags & 0x80:
+        table_size = 3 * 2 ** ((flags & 0x07) + 1)
+        color_table = data[position : position + table_size]
+        position += table_size
+
+    # Skip any extension blocks (e.g. graphic control, comment)
+    while data[position] == 0x21:
+        position += 2
+        while data[position] != 0:
+            position += data[position] + 1
+        position += 1
+
+    if data[position] != 0x2C:
+        raise ValueError("Expected an image descriptor in single-frame GIF data")
+
+    descriptor_flags = data[position + 9]
+    position += 10
+    if descriptor_flags & 0x80:
+        table_size = 3 * 2 ** ((descriptor_flags & 0x07) + 1)
+        color_table = data[position : position + table_size]
+        position += table_size
+
+    # The image data runs up to the trailer (0x3B) at the very end
+    image_data = data[position:-1]
+    return color_table, image_data, descriptor_flags & 0x40
+
+
+def encode_frame(image):
+    # Compress a single frame, given as a mode "P" PIL image, with PIL's GIF encoder:
+    # returns its color table, compressed image data and interlace flag (see
+    # split_gif_blocks()), along with its (width, height) size
+    #
+    # (This is the bulk of the work of writing a frame, and PIL releases the GIL
+    # while it's done, so frames can be encoded on several threads at once)
+    buffer = io.BytesIO()
+    image.save(buffer, format="GIF", optimize=False, interlace=False)
+    return split_gif_blocks(buffer.getvalue()) + (image.size,)
+
+
+class GifWriter:
+    # Writes an animated GIF one frame at a time, so that only the frame currently
+    # being written has to be held in memory
+    #
+    # Every frame is written with its own (local) color table, so the exact palette
+    # of every frame is kept. The LZW compression itself is done by PIL, by saving
+    # each frame as a single-frame GIF and copying out its compressed image data.
+    #
+    # The animation loops the given number of times (0 meaning forever), or, with a
+    # loop of None, only plays once.
+
+    def __init__(self, fp, size, loop=0):
+        self.fp = fp
+        self.width, self.height = size
+        self.num_frames = 0
+
+        # Header and logical screen descriptor (without a global color table)
+        fp.write(b"GIF89a")
+        fp.write(struct.pack("<HHBBB", self.width, self.height, 0x70, 0, 0))
+
+        # Netscape application extension, to make the animation loop
+        if loop is not None:
+            fp.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01")
+            fp.write(struct.pack("<H", loop))
+            fp.write(b"\x00")
+
+    def write_frame(
+        self, image, duration=0, disposal=0, transparency=None, offset=(0, 0)
+    ):
+        # Append a single frame, given as a mode "P" PIL image, shown for the given
+        # duration (in miliseconds)
+        self.write_encoded(
+            encode_frame(image), duration, disposal, transparency, offset
+        )
+
+    def write_encoded(
+        self, encoded, duration=0, disposal=0, transparency=None, offset=(0, 0)
+    ):
+        # Same as write_frame(), for a frame already compressed with encode_frame()
+        color_table, image_data, interlaced, (width, height) = encoded
+
+        # Graphic control extension: disposal method, delay, transparency
+        packed = (disposal & 0x07) << 2
+        if transparency is not None:
+            packed |= 0x01
+        delay = int(round(duration / 10))
+        self.fp.write(
+            struct.pack(
+                "<BBBBHBB",
+                0x21,
+                0xF9,
+                4,
+                packed,
+                delay,
+                0 if transparency is None else transparency,
+                0,
+            )
+        )
+
+        # Image descriptor, with a local color table
+        table_bits = max(int(np.ceil(np.log2(max(len(color_table) // 3, 2)))), 1)
+        color_table = color_table.ljust(3 * 2**table_bits, b"\x00")
+        self.fp.write(
+            struct.pack(
+                "<BHHHHB",
+                0x2C,
+                offset[0],
+                offset[1],
+                width,
+                height,
+                0x80 | interlaced | (table_bits - 1),
+            )
+        )
+        self.fp.write(color_table)
+        self.fp.write(image_data)
+
+        self.num_frames += 1
+
+    def close(self):
+        # Trailer
+        self.fp.write(b"\x3b")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+def bounding_box(mask):
+    # Smallest (top, bottom, left, right) box holding every True pixel of a 2D mask,
+    # or None if there are none
+    rows = np.flatnonzero(np.any(mask, axis=1))
+    if len(rows) == 0:
+        return None
+    columns = np.flatnonzero(np.any(mask, axis=0))
+    return rows[0], rows[-1] + 1, columns[0], columns[-1] + 1
+
+
+def union_box(box, other):
+    if box is None or other is None:
+        return other if box is None else box
+    return (
+        min(box[0], other[0]),
+        max(box[1], other[1]),
+        min(box[2], other[2]),
+        max(box[3], other[3]),
+    )
+
+
+class DeltaGifWriter:
+    # Same as GifWriter, but for RGBA frames, written the way gifsicle optimizes
+    # animations: every frame after the first only covers the bounding box of the
+    # pixels that changed since the previous frame, and pixels within that box which
+    # didn't change are left transparent (so they compress to almost nothing)
+    #
+    # Frames are drawn over each other (disposal method 1), except when a pixel of a
+    # frame is transparent where the previous frame's isn't: the previous frame is
+    # then cleared after being shown (disposal method 2), with its box grown to
+    # cover that pixel. Deciding that takes the next frame, so each frame is only
+    # written once the next one is given (or the writer is closed).
+    #
+    # Frames can be given at a lower resolution than the output, with the scale to
+    # upscale them by (vertical, horizontal): changes are then found, and palettes
+    # built, at that resolution, and only the (1-byte) palette indices are upscaled.
+    #
+    # With an executor (e.g. a concurrent.futures.ThreadPoolExecutor), each frame's
+    # palette and compression are done on it, while the changes between frames are
+    # still found in order: frames are written in order as they're done, with at
+    # most max_pending of them in flight.
+
+    def __init__(self, fp, size, loop=0, scale=(1, 1), executor=None, max_pending=16):
+        self.writer = GifWriter(fp, size, loop)
+        self.scale = scale
+        self.executor = executor
+        self.max_pending = max_pending
+
+        # Frames being encoded on the executor, oldest first, each with the rest of
+        # what write_encoded() needs
+        self.encoding = collections.deque()
+
+        # Packed RGBA pixels (with every transparent pixel 0) of what is shown before
+        # the pending frame is drawn, and the pending frame itself, with its duration
+        self.canvas = None
+        self.pending = None
+
+    @property
+    def num_frames(self):
+        return self.writer.num_frames + len(self.encoding) + (self.pending is not None)
+
+    def write_frame(self, rgba, duration=0):
+        # Append a single frame, given as an array of RGBA pixels with shape
+        # (height, width, 4), shown for the given duration (in miliseconds)
+        rgba = np.array(rgba, dtype=np.uint8, order="C")
+        rgba[rgba[..., 3] == 0] = 0
+        frame = rgba.view(np.uint32)[..., 0]
+
+        if self.pending is not None:
+            self.flush(frame)
+        self.pending = (frame, duration)
+
+    def flush(self, next_frame=None):
+        # Write the pending frame, knowing the frame that comes after it (if any)
+        frame, duration = self.pending
+        self.pending = None
+
+        if self.canvas is None:
+            # The first frame covers the whole image
+            self.canvas = np.zeros_like(frame)
+            changed = np.ones(frame.shape, dtype=bool)
+        else:
+            changed = frame != self.canvas
+        box = bounding_box(changed)
+
+        disposal = 1
+        if next_frame is not None:
+            cleared = (next_frame == 0) & (frame != 0)
+            if np.any(cleared):
+                disposal = 2
+                box = union_box(box, bounding_box(cleared))
+
+        if box is None:
+            # Nothing changed at all: a single transparent pixel, to keep the timing
+            box = (0, 1, 0, 1)
+
+        top, bottom, left, right = box
+        crop = frame[top:bottom, left:right]
+        unchanged = ~changed[top:bottom, left:right]
+
+        v_scale, h_scale = self.scale
+        offset = (left * h_scale, top * v_scale)
+        if self.executor is None:
+            encoded, transparency = encode_delta(
+                crop, unchanged, self.scale, disposal == 2
+            )
+            self.writer.write_encoded(encoded, duration, disposal, transparency, offset)
+        else:
+            future = self.executor.submit(
+                encode_delta, crop, unchanged, self.scale, disposal == 2
+            )
+            self.encoding.append((future, duration, disposal, offset))
+            if len(self.encoding) >= self.max_pending:
+                self.write_encoded()
+
+        # What's shown once the frame has been drawn, and then disposed of
+        self.canvas = frame
+        if disposal == 2:
+            self.canvas = frame.copy()
+            self.canvas[top:bottom, left:right] = 0
+
+    def write_encoded(self):
+        # Write the oldest frame being encoded on the executor, once it's done
+        future, duration, disposal, offset = self.encoding.popleft()
+        encoded, transparency = future.result()
+        self.writer.write_encoded(encoded, duration, disposal, transparency, offset)
+
+    def close(self):
+        if self.pending is not None:
+            self.flush()
+        while self.encoding:
+            self.write_encoded()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+def encode_delta(crop, unchanged, scale, cleared=False):
+    # Palette and compressed data of a DeltaGifWriter frame: its packed RGBA pixels
+    # within the box of changes, with unchanged pixels left transparent (but only if
+    # that doesn't take more colors than a palette can hold); returns the result of
+    # encode_frame() and the transparency index
+    #
+    # A frame that is cleared after being shown (disposal method 2) always gets a
+    # transparency index (see reserve_transparency())
+    result = exact_palettize(packed_to_rgba(np.where(unchanged, 0, crop)))
+    if result is None:
+        result = palettize(packed_to_rgba(crop))
+    indices, palette, transparency = result
+
+    if cleared:
+        indices, palette, transparency = reserve_transparency(
+            packed_to_rgba(crop), indices, palette, transparency
+        )
+
+    image = palette_image(upscale(indices, scale), palette)
+    return encode_frame(image), transparency
+
+
+def packed_to_rgba(packed):
+    # Inverse of packing RGBA pixels into uint32s: shape (..., 4) from (...)
+    return np.ascontiguousarray(packed).view(np.uint8).reshape(packed.shape + (4,))
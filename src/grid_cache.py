@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import tempfile
+from pathlib import Path
+
+import numpy as np
+
+import io_tools
+
+# Bump whenever grid analysis changes in a way that invalidates existing entries
+CACHE_VERSION = 1
+
+
+def content_key(path, *parts):
+    # Cache key for an input file's grid: a hash of the file's contents (and of any
+    # extra parts, e.g. the analysis options used), read in chunks; the file can
+    # also be a member of an archive (see io_tools.open_input())
+    digest = hashlib.sha256(f"v{CACHE_VERSION}".encode())
+    with io_tools.open_input(path) as fp:
+        for chunk in iter(lambda: fp.read(2**20), b""):
+            digest.update(chunk)
+
+    digest.update(json.dumps(parts, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def session_key(session, size, *parts):
+    # Cache key shared by every input with the same (width, height) size within a
+    # user-named session, e.g. many captures from one emulator window: all of them
+    # are assumed to be stretched onto the same grid
+    description = json.dumps(
+        [f"v{CACHE_VERSION}", "session", session, list(size), parts], sort_keys=True
+    )
+    return hashlib.sha256(description.encode()).hexdigest()
+
+
+def grid_to_json(grid):
+    grid_indices, grid_scale = grid
+    return {
+        "grid_indices": [np.asarray(indices).tolist() for indices in grid_indices],
+        "grid_scale": [int(scale) for scale in grid_scale],
+    }
+
+
+def grid_from_json(data):
+    grid_indices = tuple(np.asarray(indices) for indices in data["grid_indices"])
+    return grid_indices, tuple(data["grid_scale"])
+
+
+class GridCache:
+    # On-disk cache of grid analysis results, i.e. (grid_indices, grid_scale) as
+    # returned by grid_stretch.analyze_input_grid(), one small JSON file per entry
+    #
+    # Once the entries take up more than max_bytes in total, the least recently used
+    # ones are evicted (entries' modification times are bumped whenever they're
+    # read). Entries are written atomically, so several processes (e.g. --jobs) can
+    # share the same cache directory.
+
+    def __init__(self, directory, max_bytes=64 * 2**20):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return self.directory / f"{key}.json"
+
+    def load(self, key):
+        # The cached grid for the given key, or None if there isn't one
+        path = self.path(key)
+        try:
+            with open(path) as fp:
+                grid = grid_from_json(json.load(fp))
+            os.utime(path)
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+        return grid
+
+    def save(self, key, grid):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(grid_to_json(grid), fp)
+        os.replace(temp_path, self.path(key))
+
+        self.evict()
+
+    def evict(self):
+        # Remove the least recently used entries until the rest fit in max_bytes
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+
+    def entry(self, key):
+        return CachedGrid(self, key)
+
+
+class CachedGrid:
+    # A single cache entry, as passed to fix.analyze_grid(): load() gives the cached
+    # grid (or None), and save() stores a newly-analyzed one
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+    def load(self):
+        return self.cache.load(self.key)
+
+    def save(self, grid):
+        self.cache.save(self.key, grid)
+
+
+class FixedGrid:
+    # Stand-in for a cache entry that always gives the same, already-known grid
+    # (e.g. one analyzed from another file, with --grid-from)
+
+    def __init__(self, grid):
+        self.grid = grid
+
+    def load(self):
+        return self.grid
+
+    def save(self, grid):
+        pass
@@ -1,5 +1,9 @@
+import logging
+
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 
 def insert_bookends(arr, start, end):
     arr = np.reshape(arr, newshape=(-1,))
@@ -34,66 +38,257 @@ def spatial_axes(frames):
     return (v_axis, h_axis)
 
 
-def infer_axis_scale(frames, axis):
+def packed_dtype(num_bytes):
+    # The dtype used to hold all of one pixel's color channels as a single value:
+    # an unsigned integer when one of the right width exists (e.g. uint32 for RGBA
+    # with 8 bits per channel), and an opaque fixed-width byte string otherwise
+    try:
+        return {1: np.uint8, 2: np.uint16, 4: np.uint32, 8: np.uint64}[num_bytes]
+    except KeyError:
+        return np.dtype((np.void, num_bytes))
 
-    # The image's height (for axis==2) or width (for axis==3)
-    size = frames.shape[axis]
-    print(f"axis, size: {axis, size}")
 
-    # Difference between each pixel and its neighbor along the given axis
-    # TODO: give a toy illustrative example
-    # TODO: refactor into own function (for ease of testing)?
-    pixel_diffs = np.take(frames, np.arange(1, size), axis=axis) - np.take(
-        frames, np.arange(0, size - 1), axis=axis
-    )
-    # TODO: rewrite this so it's readable, even after autoformatting by Black
+def pack_pixels(frames):
+    # Pack all color channels of each pixel into a single value, so that two pixels
+    # can be compared with one comparison instead of one comparison per channel
     #
-    # The above is equivalent to
+    # Frames of shape
+    #   (..., color channel, vertical, horizontal)
+    # become an array of shape
+    #   (..., vertical, horizontal)
     #
-    # if axis == 2:
-    #     pixel_diffs = frames[:, :, 1:, :] - frames[:, :, :-1, :]
-    # elif axis == 3:
-    #     pixel_diffs = frames[:, :, :, 1:] - frames[:, :, :, :-1]
-    # else:
-    #     raise IndexError("Axis has to be 2 or 3")
+    # For frames produced by fix.spatial_axes_to_end(), the color channels are
+    # still adjacent in memory, so this is just a view and no pixel data is copied
+    channels_last = np.moveaxis(frames, source=-3, destination=-1)
+    if channels_last.shape[-1] == 1:
+        return channels_last[..., 0]
 
-    (v_axis, h_axis) = spatial_axes(frames)
-    other_spatial_axis = v_axis if axis != v_axis else h_axis
+    channels_last = np.ascontiguousarray(channels_last)
+    num_bytes = channels_last.shape[-1] * channels_last.itemsize
+    return channels_last.view(packed_dtype(num_bytes))[..., 0]
 
-    # Is there an edge between any two adjacent pixels
-    # (for each pair of adjacent columns (or rows)?)
-    edges = np.apply_along_axis(any_nonzero, axis=other_spatial_axis, arr=pixel_diffs)
 
-    # Edges for each frame when taken across all channels
-    edges = np.any(edges, axis=1)
+def axis_edges(frames, axis, chunk_pixels=2**22):
+    # For each pair of adjacent rows (for the vertical axis) or adjacent columns
+    # (for the horizontal axis): is there an edge between them, i.e. do the two
+    # differ at any pixel, in any color channel, in any frame?
+    #
+    # E.g. for a single frame with one color channel,
+    #
+    #   [[1, 1, 2],
+    #    [1, 1, 2],
+    #    [3, 3, 2]]
+    #
+    # the vertical edges are [False, True] (only rows 1 and 2 differ), and the
+    # horizontal edges are [False, True] (only columns 1 and 2 differ)
+    #
+    # Neighbouring packed pixels are compared directly, a limited number of frames
+    # at a time, so no full-size array of differences is ever built
+    v_axis, h_axis = spatial_axes(frames)
+    is_vertical = axis == v_axis
+
+    packed = pack_pixels(frames)
+    height, width = packed.shape[-2:]
+    packed = packed.reshape((-1, height, width))
+
+    size = height if is_vertical else width
+    edges = np.zeros(shape=(max(size - 1, 0),), dtype=bool)
 
-    # Edges when taken across all frames
-    edges = np.any(edges, axis=0)
+    frames_per_chunk = max(1, chunk_pixels // max(1, height * width))
+    for start in range(0, packed.shape[0], frames_per_chunk):
+        chunk = packed[start : start + frames_per_chunk]
+        if is_vertical:
+            edges |= np.any(chunk[:, 1:, :] != chunk[:, :-1, :], axis=(0, 2))
+        else:
+            edges |= np.any(chunk[:, :, 1:] != chunk[:, :, :-1], axis=(0, 1))
 
-    edge_indices = np.reshape(np.nonzero(edges), newshape=(-1,))
+    return edges
+
+
+def grid_from_edges(edges):
+    # Given the edges between adjacent rows (or columns), get the indices at which
+    # each block starts, and the most common block length (the apparent scale)
+    edge_indices = np.flatnonzero(edges)
 
     block_bounds = insert_bookends(edge_indices + 1, start=0, end=edges.shape[0] + 1)
 
     block_lengths = block_bounds[1:] - block_bounds[:-1]
 
-    print("Block Lengths:")
-    print(block_lengths)
+    logger.debug("Block lengths: %s", block_lengths)
 
     scale = np_mode(block_lengths)
 
     return block_bounds[:-1], scale
 
 
-def analyze_input_grid(frames):
-    (v_axis, h_axis) = spatial_axes(frames)
+def block_lengths(grid_indices, size):
+    # Length of each block along an axis of the given size, from the indices at
+    # which the blocks start (as returned by grid_from_edges())
+    return np.diff(np.append(grid_indices, size))
+
+
+def infer_axis_scale(frames, axis):
+
+    # The image's height (for axis==2) or width (for axis==3)
+    size = frames.shape[axis]
+    logger.debug("axis, size: %s", (axis, size))
+
+    # Is there an edge between any two adjacent pixels
+    # (for each pair of adjacent columns (or rows)?)
+    edges = axis_edges(frames, axis)
+
+    return grid_from_edges(edges)
+
+
+def analyze_input_grid(frames, executor=None):
+    # With an executor (e.g. a concurrent.futures.ThreadPoolExecutor), the edges are
+    # found strip by strip in parallel instead (see tiled_grid_edges())
+    if executor is not None:
+        return analyze_grid_edges(*tiled_grid_edges(frames, executor))
+
+    v_axis, h_axis = spatial_axes(frames)
 
     v_grid_indices, v_scale = infer_axis_scale(frames, axis=v_axis)
     h_grid_indices, h_scale = infer_axis_scale(frames, axis=h_axis)
 
-    print(f"Apparent vscale, hscale: {v_scale, h_scale}")
+    logger.info("Apparent vscale, hscale: %s", (v_scale, h_scale))
     return (v_grid_indices, h_grid_indices), (v_scale, h_scale)
 
 
+# Number of rows in each of the strips that large images are split into, when
+# processed in tiles
+STRIP_ROWS = 256
+
+
+def row_strips(height, strip_rows=STRIP_ROWS):
+    # Slices splitting the given number of rows into consecutive strips
+    return [
+        slice(start, min(start + strip_rows, height))
+        for start in range(0, height, strip_rows)
+    ]
+
+
+def tiled_grid_edges(frames, executor, strip_rows=STRIP_ROWS):
+    # Same as grid_edges(), with the frames split into horizontal strips of rows,
+    # whose edges are found in parallel on the given executor: numpy releases the
+    # GIL while comparing pixels, so threads can use several cores at once, and
+    # only strip-sized temporaries are ever made
+    #
+    # Each strip's edges between columns are ORed together, while its edges between
+    # rows are its own part of the whole (a strip also looks at the first row of the
+    # next strip, for the edge between the two)
+    v_axis, h_axis = spatial_axes(frames)
+    height = frames.shape[v_axis]
+    strips = row_strips(height, strip_rows)
+
+    def strip_edges(strip):
+        rows = frames[..., strip.start : strip.stop + 1, :]
+        return (
+            axis_edges(rows, v_axis),
+            axis_edges(rows[..., : strip.stop - strip.start, :], h_axis),
+        )
+
+    v_edges = np.zeros(shape=(max(height - 1, 0),), dtype=bool)
+    h_edges = np.zeros(shape=(max(frames.shape[h_axis] - 1, 0),), dtype=bool)
+    for strip, (strip_v_edges, strip_h_edges) in zip(
+        strips, executor.map(strip_edges, strips)
+    ):
+        v_edges[strip.start : strip.start + len(strip_v_edges)] = strip_v_edges
+        h_edges |= strip_h_edges
+
+    return v_edges, h_edges
+
+
+def grid_edges(frames, sample_step=1):
+    # Edges between adjacent rows and between adjacent columns of the given frames,
+    # which can be accumulated (with logical OR) over frames processed separately
+    #
+    # With a sample_step above 1, edges between rows are only looked for in every
+    # sample_step-th column (and vice versa), which is faster but may miss edges
+    v_axis, h_axis = spatial_axes(frames)
+    v_edges = axis_edges(frames[..., :, ::sample_step], axis=v_axis)
+    h_edges = axis_edges(frames[..., ::sample_step, :], axis=h_axis)
+    return v_edges, h_edges
+
+
+def analyze_grid_edges(v_edges, h_edges):
+    # Same as analyze_input_grid(), but from already-accumulated row and column edges
+    # (e.g. from grid_edges(), over every frame of the image)
+    v_grid_indices, v_scale = grid_from_edges(v_edges)
+    h_grid_indices, h_scale = grid_from_edges(h_edges)
+
+    logger.info("Apparent vscale, hscale: %s", (v_scale, h_scale))
+    return (v_grid_indices, h_grid_indices), (v_scale, h_scale)
+
+
+def accumulate_grid_edges(batches, patience=None, sample_step=1):
+    # Accumulate the row and column edges over batches of frames (any iterable of
+    # arrays of frames), stopping early once the edges haven't changed for the given
+    # number of consecutive batches (batches after that are never consumed, so e.g.
+    # frames that are decoded lazily don't even have to be decoded)
+    #
+    # Returns the edges, and whether accumulation stopped early because they had
+    # stopped changing
+    v_edges, h_edges = None, None
+    unchanged_batches = 0
+
+    for batch in batches:
+        batch_v_edges, batch_h_edges = grid_edges(batch, sample_step)
+
+        if v_edges is None:
+            v_edges, h_edges = batch_v_edges, batch_h_edges
+        else:
+            changed = np.any(batch_v_edges & ~v_edges) or np.any(
+                batch_h_edges & ~h_edges
+            )
+            v_edges |= batch_v_edges
+            h_edges |= batch_h_edges
+            unchanged_batches = 0 if changed else unchanged_batches + 1
+
+        if patience is not None and unchanged_batches >= patience:
+            return v_edges, h_edges, True
+
+    return v_edges, h_edges, False
+
+
+def strided_frame_order(num_frames, stride):
+    # Order in which to visit frames so that even the first few are spread across
+    # the whole image: every stride-th frame (0, stride, 2*stride, ...), then every
+    # stride-th frame starting from 1, and so on
+    return np.concatenate(
+        [np.arange(offset, num_frames, stride) for offset in range(stride)]
+    )
+
+
+def frame_batches(frames, batch_size=4, stride=8, max_frames=None):
+    # Batches of the given frames (of shape (# frames, # channels, height, width)),
+    # in the order given by strided_frame_order(), of at most batch_size frames each,
+    # and of at most max_frames frames in total
+    order = strided_frame_order(frames.shape[0], stride)[:max_frames]
+    for start in range(0, len(order), batch_size):
+        yield frames[np.sort(order[start : start + batch_size])]
+
+
+def analyze_input_grid_fast(
+    frames, batch_size=4, stride=8, patience=3, sample_step=1, max_frames=None
+):
+    # Faster alternative to analyze_input_grid() for images with many frames, which
+    # usually show the whole grid within their first few frames: frames are looked
+    # at in (strided) batches, stopping once the edges haven't changed for the given
+    # number of consecutive batches, and optionally only sampling every
+    # sample_step-th row and column
+    #
+    # Returns the same as analyze_input_grid(), plus whether the edges converged,
+    # i.e. either stopped changing or every frame was looked at; if they didn't
+    # (only possible when max_frames is given), the result may be missing edges,
+    # and a full scan should be done instead
+    batches = frame_batches(frames, batch_size, stride, max_frames)
+    v_edges, h_edges, stable = accumulate_grid_edges(batches, patience, sample_step)
+
+    all_frames = max_frames is None or max_frames >= frames.shape[0]
+    return analyze_grid_edges(v_edges, h_edges), stable or all_frames
+
+
 def integer_upscale(frames, scale):
     try:
         # Unpack scale if the argument is a tuple or a numpy array
@@ -151,6 +346,92 @@ def mask_by_row_indices(frames, grid_indices, dtype=np.uint8):
     return frames
 
 
+def unpack_pixels(packed, dtype=np.uint8):
+    # Inverse of pack_pixels(): packed pixels of shape
+    #   (..., vertical, horizontal)
+    # become a view of them with shape
+    #   (..., color channel, vertical, horizontal)
+    channels_last = packed[..., np.newaxis].view(dtype)
+    return np.moveaxis(channels_last, source=-1, destination=-3)
+
+
+def gather_indices(grid_indices, scale, width_in):
+    # Precomputed map from each output pixel to the input pixel it's copied from,
+    # for decimating by the given grid indices and upscaling by the given scale at
+    # once: the flat (row-major) index of the source pixel within an input frame of
+    # the given width, for each pixel of an output frame
+    #
+    # E.g. for grid indices ([0, 2], [0, 1, 3]) and scale (2, 1) in a 4px wide input,
+    # output rows come from input rows [0, 0, 2, 2], and output columns from input
+    # columns [0, 1, 3]
+    source_rows, source_columns = source_rows_and_columns(grid_indices, scale)
+    return source_rows[:, np.newaxis] * width_in + source_columns[np.newaxis, :]
+
+
+def source_rows_and_columns(grid_indices, scale):
+    # The input row each output row is copied from, and likewise for columns
+    try:
+        v_scale, h_scale = scale
+    except (TypeError, ValueError):
+        v_scale, h_scale = scale, scale
+
+    source_rows = np.repeat(np.asarray(grid_indices[0], dtype=np.intp), v_scale)
+    source_columns = np.repeat(np.asarray(grid_indices[1], dtype=np.intp), h_scale)
+    return source_rows, source_columns
+
+
+def decimate_and_upscale(frames, grid_indices, scale, out=None, executor=None):
+    # Same result as mask_by_row_indices() followed by integer_upscale(), for frames
+    # of shape
+    #   (..., color channel, vertical, horizontal)
+    # but as a single gather of whole (packed) pixels through gather_indices(),
+    # instead of four passes over the frames with a full-size temporary each
+    #
+    # The result can be written into a preallocated out, which must have the output
+    # shape and the same channels-last memory layout as the frames produced by
+    # fix.spatial_axes_to_end() (e.g. spatial_axes_to_end(np.empty(...)))
+    #
+    # With an executor (e.g. a concurrent.futures.ThreadPoolExecutor), the output is
+    # gathered in parallel instead: frame by frame if there are several frames, and
+    # otherwise in strips of rows, each with only its own part of the map from output
+    # pixels to input pixels
+    height_in, width_in = frames.shape[-2:]
+    source_rows, source_columns = source_rows_and_columns(grid_indices, scale)
+    out_shape = (len(source_rows), len(source_columns))
+
+    packed = pack_pixels(frames)
+    leading_shape = packed.shape[:-2]
+    packed = packed.reshape(leading_shape + (height_in * width_in,))
+
+    if out is None:
+        out_packed = np.empty(leading_shape + out_shape, dtype=packed.dtype)
+    else:
+        out_packed = pack_pixels(out)
+        if not np.shares_memory(out_packed, out):
+            raise ValueError("out must have its color channels last in memory")
+
+    def gather(strip, frame=Ellipsis):
+        source = source_rows[strip, np.newaxis] * width_in + source_columns
+        np.take(
+            packed[frame],
+            source,
+            axis=-1,
+            out=out_packed[frame][..., strip, :],
+            mode="clip",
+        )
+
+    if executor is None:
+        gather(slice(None))
+    elif len(leading_shape) > 0 and leading_shape[0] > 1:
+        list(executor.map(lambda frame: gather(slice(None), frame), range(len(packed))))
+    else:
+        list(executor.map(gather, row_strips(out_shape[0])))
+
+    if out is not None:
+        return out
+    return unpack_pixels(out_packed, frames.dtype)
+
+
 def main():
     pass
 
@@ -1,21 +1,26 @@
-from pathlib import Path
+import contextlib
+import io
+import logging
+import os
+import tarfile
+import zipfile
+from pathlib import Path, PurePosixPath
 
-import imageio
-import pygifsicle
+import numpy as np
 from PIL import Image, ImageSequence
 
+import gif_writer
+import pipeline
 
-def clear_tmp_folder(tmp):
-    # Remove all files in the given directory
-    for item in tmp.glob("*"):
-        if item.is_file():
-            item.unlink()
+logger = logging.getLogger(__name__)
 
 
 def directories_to_files(file_and_dir_paths):
     # Given a list of strings representing paths to files and directories, return
     # the same list, any string representing a directory replaced with (possibly
-    # multiple) strings corresponding to the files in that directory
+    # multiple) strings corresponding to the files in that directory, and any
+    # string representing an archive replaced with an ArchiveMember for each of the
+    # files in that archive
     #
     # (This entire bit of extra handling is just in case /directory/ was given
     # as an argument instead of /directory/*, which the shell itself would have
@@ -32,6 +37,10 @@ def directories_to_files(file_and_dir_paths):
             # to the list of files to be processed
             dir_file_strings = [str(item) for item in path.iterdir() if item.is_file()]
             file_path_strings += dir_file_strings
+        elif is_archive(path_arg) and path.is_file():
+            # Files in an archive are read straight from the archive, without being
+            # extracted first
+            file_path_strings += archive_members(path_arg)
         else:
             # If it's a path to a file rather than a directory, no extra handling
             # is needed, and we keep the original string
@@ -40,94 +49,443 @@ def directories_to_files(file_and_dir_paths):
     return file_path_strings
 
 
-def save_from_frames(img_in, output_frames, out_path, has_transparency):
+# Archives (zip, or tar, optionally compressed) can be given both as inputs and as
+# the output: each input member is decoded straight from its archive, and each
+# output is added to the output archive as soon as it's done, so nothing is ever
+# extracted (or all outputs kept) on disk
+ARCHIVE_SUFFIXES = (
+    ".zip",
+    ".tar",
+    ".tar.gz",
+    ".tgz",
+    ".tar.bz2",
+    ".tbz2",
+    ".tar.xz",
+    ".txz",
+)
 
-    height_out = output_frames.shape[-3]
-    width_out = output_frames.shape[-2]
+# Compression of tar archives written with each (final) suffix
+TAR_COMPRESSION = {".gz": "gz", ".tgz": "gz", ".bz2": "bz2", ".tbz2": "bz2"}
+TAR_COMPRESSION.update({".xz": "xz", ".txz": "xz"})
 
-    durations = []
-    frames = []
 
-    for index, img in enumerate(ImageSequence.Iterator(img_in)):
+def is_archive(path):
+    return str(path).lower().endswith(ARCHIVE_SUFFIXES)
 
-        frame = img.convert(mode="RGBA").copy()
 
-        # Resizing the canvas (the actual pixels will be overrwritten with paste below)
-        frame = frame.resize(size=(width_out, height_out))
+def is_zip(path):
+    return str(path).lower().endswith(".zip")
 
-        if len(output_frames.shape) == 4:
-            image = Image.fromarray(output_frames[index, :, :, :], mode="RGBA")
+
+class ArchiveMember:
+    # A file inside a zip or tar archive, standing in for its path as an input:
+    # str() gives "<archive path>/<member name>" (e.g. for summaries), and
+    # open_input() opens it for reading straight out of the archive
+    #
+    # (Tar members keep their TarInfo, so that they can be opened without scanning
+    # the archive for them again; both are picklable, e.g. for worker processes)
+
+    def __init__(self, archive_path, name, tarinfo=None):
+        self.archive_path = str(archive_path)
+        self.name = name
+        self.tarinfo = tarinfo
+
+    def __str__(self):
+        return f"{self.archive_path}/{self.name}"
+
+    def __repr__(self):
+        return f"ArchiveMember({self.archive_path!r}, {self.name!r})"
+
+    @property
+    def relative_path(self):
+        # The member's path within its archive, as a relative path that can't point
+        # outside of whatever directory it's joined onto
+        parts = PurePosixPath(self.name).parts
+        return Path(*[part for part in parts if part not in ("/", "..")])
+
+    def open(self):
+        archive = open_archive(self.archive_path)
+        if self.tarinfo is None:
+            return archive.open(self.name)
+        return archive.extractfile(self.tarinfo)
+
+
+def archive_members(path):
+    # ArchiveMember for every file in the archive at the given path, in the order
+    # they're stored in (a tar is read in a single pass, only looking at headers)
+    if is_zip(path):
+        with zipfile.ZipFile(path) as archive:
+            return [
+                ArchiveMember(path, info.filename)
+                for info in archive.infolist()
+                if not info.is_dir()
+            ]
+
+    with tarfile.open(path, "r|*") as archive:
+        return [
+            ArchiveMember(path, info.name, info) for info in archive if info.isreg()
+        ]
+
+
+# Archives opened for reading, kept open from one member to the next, so that e.g.
+# a compressed tar's members, read in order, only have to be decompressed once
+# (rather than from the start of the archive for each member); keyed by process as
+# well, since forked worker processes mustn't share their parent's file offsets
+_open_archives = {}
+
+
+def open_archive(path):
+    key = (os.getpid(), path)
+    if key not in _open_archives:
+        if is_zip(path):
+            _open_archives[key] = zipfile.ZipFile(path)
         else:
-            image = Image.fromarray(output_frames[index, :, :], mode="P")
+            _open_archives[key] = tarfile.open(path)
+    return _open_archives[key]
 
-        if img_in.is_animated:
-            durations.append(img.info["duration"])
 
-        frame.paste(image)
-        frames.append(frame)
+def close_archives():
+    while _open_archives:
+        _open_archives.popitem()[1].close()
 
-    print(f"has transparency: {has_transparency}")
-    print(image.info)
 
-    # Save frames as separate images if the input image is animated
-    # (Unfortunately, saving the frames in a single GIF with PIL introduces
-    # palette issues with certain inputs)
-    if img_in.is_animated:
-        if has_transparency:
-            # transparent = img_in.info["transparency"]
-            frames[0].save(
-                fp=out_path,
-                save_all=True,
-                append_images=frames[1:],
-                duration=durations,
-                loop=0,
-                include_color_table=True,
-                transparency=0,
-                disposal=2,
-            )
+@contextlib.contextmanager
+def open_input(path_arg):
+    # Binary file to read an input from: path_arg can be a path, an ArchiveMember,
+    # or an already-open binary file object (e.g. io.BytesIO), which is left open
+    if hasattr(path_arg, "read"):
+        yield path_arg
+    elif isinstance(path_arg, ArchiveMember):
+        with path_arg.open() as fp:
+            yield fp
+    else:
+        with open(path_arg, "rb") as fp:
+            yield fp
+
+
+class ArchiveWriter:
+    # Output archive (zip or tar, with the compression given by its suffix, see
+    # ARCHIVE_SUFFIXES) that finished outputs are added to one at a time, each
+    # streamed in from its (scratch) file
+
+    def __init__(self, path):
+        if is_zip(path):
+            self.archive = zipfile.ZipFile(path, "w", allowZip64=True)
         else:
-            # If transparency is no issue, then imageio will be used for saving
-            # the final gif, as it is more reliable for preserving the exact palette
-            # (PIL sometimes alters it due to falty quantization)
-
-            # Create tmp folder if it doesn't already exist, and clear it of
-            # any prior contents if applicable
-            tmp = Path("./tmp/")
-            tmp.mkdir(exist_ok=True)
-            clear_tmp_folder(tmp)
-
-            # Save the output frames as individual .png files to /tmp/,
-            # with each frame's index in its filename
-            for index, frame in enumerate(frames):
-                frame.save(
-                    f"./tmp/out{index:03d}.png",
-                    format="png",
-                )
+            compression = TAR_COMPRESSION.get(Path(path).suffix.lower(), "")
+            self.archive = tarfile.open(path, f"w:{compression}")
 
-            # Conversion of frame durations from miliseconds (used by PIL)
-            # to seconds (used by imageio)
-            durations = [duration / 1000 for duration in durations]
+    def add(self, file_path, name):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.write(file_path, name)
+        else:
+            self.archive.add(file_path, name)
 
-            # Load frames, sort them by filename to ensure correct order
-            png_list = [
-                str(item) for item in tmp.iterdir() if str(item).endswith(".png")
-            ]
-            png_list.sort()
-            loaded_frames = [imageio.imread(frame) for frame in png_list]
+    def close(self):
+        self.archive.close()
 
-            # Save the output GIF using imageio
-            # (the equivalent save feature in PIL had palette issues when saving to GIF
-            # for some images -- likely related to falty quantization)
-            imageio.mimsave(out_path, loaded_frames, "GIF", duration=durations)
+    def __enter__(self):
+        return self
 
-            # Cleanup: clear and delete the ./tmp/ directory
-            # clear_tmp_folder(tmp)
-            # tmp.rmdir()
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-        # Optimize the final output using pygifsicle to reduce filesize
-        pygifsicle.optimize(out_path)
+
+@contextlib.contextmanager
+def output_file(out_path):
+    # Binary file to write an output to: out_path can be either a path, or an
+    # already-open binary file object (e.g. io.BytesIO), which is left open
+    if hasattr(out_path, "write"):
+        yield out_path
+    else:
+        with open(out_path, "wb") as fp:
+            yield fp
+
+
+def PIL_format(out_path, img_format):
+    # Format to give PIL when saving to out_path: PIL picks it from the extension of
+    # a path, but file objects have none, so outputs written to them simply keep the
+    # input's format
+    return img_format if hasattr(out_path, "write") else None
+
+
+def output_loop(img_in):
+    # How many times an animated GIF output loops (see gif_writer.GifWriter): the
+    # same as the input, for GIFs (None, i.e. only playing once, if the input has no
+    # looping extension), and forever otherwise; img_in is the input as a PIL image
+    # or a fix.DecodedFrames
+    if img_in.format == "GIF":
+        return img_in.info.get("loop")
+    return 0
+
+
+# File extension of each output format (other than the input's own, by default)
+OUTPUT_FORMATS = {"gif": ".gif", "webp": ".webp", "apng": ".png"}
+
+
+def save_lossless(
+    output_frames, durations, out_path, output_format, scale=(1, 1), executor=None
+):
+    # Save RGBA frames with shape (# of frames, height, width, 4) as a lossless
+    # (animated) WebP or PNG, for output_format "webp" or "apng": there's no palette
+    # at all, so colors and alpha are kept exactly, whatever the number of colors
+    #
+    # Frames are upscaled by the given scale as they're converted to PIL images (on
+    # the given executor, if any, see pipeline.ordered_map()), but PIL's encoders
+    # for these formats hold every (upscaled) frame at once
+    frames = list(
+        pipeline.ordered_map(
+            lambda frame: Image.fromarray(
+                gif_writer.upscale(np.asarray(frame), scale), mode="RGBA"
+            ),
+            output_frames,
+            executor,
+        )
+    )
+
+    options = {"lossless": True} if output_format == "webp" else {}
+    frames[0].save(
+        out_path,
+        format={"webp": "WEBP", "apng": "PNG"}[output_format],
+        save_all=True,
+        append_images=frames[1:],
+        duration=list(durations),
+        loop=0,
+        **options,
+    )
+
+
+def encode_gif(
+    output_frames,
+    durations,
+    loop=0,
+    optimize=False,
+    scale=(1, 1),
+    executor=None,
+    has_transparency=None,
+):
+    # Encode RGBA frames with shape (# of frames, height, width, 4) as an animated
+    # GIF, entirely in memory, returning the GIF's bytes
+    #
+    # Each frame keeps its exact colors, as long as it has at most 256 of them
+    # (always the case for frames that came from a GIF in the first place)
+    #
+    # With optimize, each frame only holds what changed since the previous one (see
+    # gif_writer.DeltaGifWriter)
+    #
+    # Frames are upscaled by the given (vertical, horizontal) scale as they're
+    # encoded, so they can be given at the native resolution: palettes are built at
+    # that resolution, and only each frame's (1-byte) palette indices are upscaled
+    #
+    # With an executor, frames are palettized and compressed on it, and written in
+    # order as they're done (see pipeline.ordered_map())
+    height_out = int(output_frames.shape[1] * scale[0])
+    width_out = int(output_frames.shape[2] * scale[1])
+
+    if optimize:
+        buffer = io.BytesIO()
+        with gif_writer.DeltaGifWriter(
+            buffer,
+            size=(width_out, height_out),
+            loop=loop,
+            scale=scale,
+            executor=executor,
+        ) as writer:
+            for frame, duration in zip(output_frames, durations):
+                writer.write_frame(frame, duration=duration)
+        return buffer.getvalue()
+
+    # Frames are drawn over each other, so if any of them have transparent pixels,
+    # every frame has to be cleared before the next one is drawn: has_transparency
+    # says whether that's the case (e.g. as found by fix.detect_transparency()), or,
+    # if None, it's checked here, one frame at a time (so output_frames can also be
+    # e.g. np.memmap-backed)
+    if has_transparency is None:
+        has_transparency = any(np.any(frame[..., 3] == 0) for frame in output_frames)
+    disposal = 2 if has_transparency else 1
+
+    def encoded_frame(frame):
+        indices, palette, transparency = gif_writer.palettize(frame)
+        if disposal == 2:
+            indices, palette, transparency = gif_writer.reserve_transparency(
+                frame, indices, palette, transparency
+            )
+        image = gif_writer.palette_image(gif_writer.upscale(indices, scale), palette)
+        return gif_writer.encode_frame(image), transparency
+
+    buffer = io.BytesIO()
+    with gif_writer.GifWriter(
+        buffer, size=(width_out, height_out), loop=loop
+    ) as writer:
+        encoded_frames = pipeline.ordered_map(encoded_frame, output_frames, executor)
+        for (encoded, transparency), duration in zip(encoded_frames, durations):
+            writer.write_encoded(
+                encoded, duration, disposal=disposal, transparency=transparency
+            )
+
+    return buffer.getvalue()
+
+
+def save_from_frames(
+    img_in,
+    output_frames,
+    out_path,
+    has_transparency,
+    durations=None,
+    optimize=True,
+    scale=(1, 1),
+    output_format=None,
+    executor=None,
+):
+    # Save the output frames as an image; img_in is the input, either as a PIL
+    # image, or as the fix.DecodedFrames it was decoded into (whose metadata is
+    # then used instead, so that the input's frames aren't decoded again)
+    #
+    # Durations (one per output frame) default to those of the input's frames, and
+    # have to be given if frames were dropped or merged along the way (e.g. runs of
+    # duplicate frames collapsed into one)
+    #
+    # has_transparency (see fix.detect_transparency()) decides whether the frames
+    # of an animation are cleared before the next one is drawn (see encode_gif())
+    #
+    # With optimize, animations are written with gif_writer.DeltaGifWriter, and
+    # out_path can also be a binary file object (see output_file())
+    #
+    # The output frames can be given at the native resolution, along with the
+    # (vertical, horizontal) scale to upscale them by: each frame is only upscaled
+    # as it's encoded, so for GIFs the upscaled frames are never all held in memory
+    #
+    # With an output_format of "webp" or "apng", the frames are saved with
+    # save_lossless() instead (otherwise, the output has the input's format), which
+    # does hold every upscaled frame at once
+    #
+    # With an executor (see pipeline.frame_executor()), frames are converted and
+    # encoded on it, several at a time
+
+    if durations is None:
+        durations = getattr(img_in, "durations", None)
+    if durations is None:
+        durations = [
+            img.info.get("duration", 0) for img in ImageSequence.Iterator(img_in)
+        ]
+
+    def output_image(index):
+        # (PIL images are only made where they're needed, so that output frames that
+        # don't fit in memory, e.g. np.memmap-backed ones, are never all loaded)
+        frame = gif_writer.upscale(output_frames[index], scale)
+        if len(output_frames.shape) == 4:
+            return Image.fromarray(frame, mode="RGBA")
+        else:
+            return Image.fromarray(frame, mode="P")
+
+    logger.debug("has transparency: %s", has_transparency)
+
+    if output_format in ("webp", "apng"):
+        save_lossless(
+            output_frames, durations, out_path, output_format, scale, executor
+        )
+        return
+
+    if img_in.is_animated:
+        # The GIF is encoded in memory straight from the output frames, each frame
+        # with its own exact palette (PIL's own GIF saving sometimes alters the
+        # palette due to faulty quantization), and cleared before the next one is
+        # drawn if any of them use transparency
+        with output_file(out_path) as fp:
+            fp.write(
+                encode_gif(
+                    output_frames,
+                    durations,
+                    loop=output_loop(img_in),
+                    optimize=optimize,
+                    scale=scale,
+                    executor=executor,
+                    has_transparency=has_transparency,
+                )
+            )
 
     else:
         # If the input image is not animated, i.e. is just a single frame, saving
         # the output with PIL is fine
-        frames[0].save(out_path)
+        img_format = "GIF" if output_format == "gif" else img_in.format
+        output_image(0).save(out_path, format=PIL_format(out_path, img_format))
+
+
+def save_from_indexed_frames(
+    output_frames,
+    palette,
+    transparency,
+    durations,
+    out_path,
+    optimize=True,
+    scale=(1, 1),
+    output_format=None,
+    executor=None,
+    is_animated=None,
+    loop=0,
+):
+    # Save frames of palette indices with shape (# of frames, height, width), along
+    # with the palette they index into, as a GIF: the palette is written back out
+    # as-is, so there is no quantization and the output colors are exact
+    #
+    # Only a still input (is_animated False, by default whenever there's a single
+    # frame) is saved as a still GIF: an animation whose frames were all collapsed
+    # into one is still written as an animation, keeping its duration, and looping
+    # the given number of times (see gif_writer.GifWriter)
+    #
+    # (As for save_from_frames(), out_path can also be a binary file object, with
+    # optimize, animations are written with gif_writer.DeltaGifWriter, and frames
+    # are upscaled by scale as they're encoded, or saved with save_lossless() for an
+    # output_format of "webp" or "apng", and frames are encoded on the executor)
+    rgba_frames = pipeline.ordered_map(
+        lambda frame: gif_writer.indices_to_rgba(frame, palette, transparency),
+        output_frames,
+        executor,
+    )
+    if output_format in ("webp", "apng"):
+        save_lossless(rgba_frames, durations, out_path, output_format, scale)
+        return
+
+    height_out = int(output_frames.shape[-2] * scale[0])
+    width_out = int(output_frames.shape[-1] * scale[1])
+
+    if is_animated is None:
+        is_animated = len(output_frames) > 1
+
+    if not is_animated:
+        image = gif_writer.palette_image(
+            gif_writer.upscale(output_frames[0], scale), palette
+        )
+        if transparency is not None:
+            image.save(out_path, format="GIF", transparency=transparency)
+        else:
+            image.save(out_path, format="GIF")
+        return
+
+    if optimize:
+        with output_file(out_path) as fp, gif_writer.DeltaGifWriter(
+            fp,
+            size=(width_out, height_out),
+            loop=loop,
+            scale=scale,
+            executor=executor,
+        ) as writer:
+            for rgba, duration in zip(rgba_frames, durations):
+                writer.write_frame(rgba, duration=duration)
+        return
+
+    # Frames that use transparency have to be cleared before the next frame is drawn
+    disposal = 2 if transparency is not None else 1
+
+    def encoded_frame(frame):
+        image = gif_writer.palette_image(gif_writer.upscale(frame, scale), palette)
+        return gif_writer.encode_frame(image)
+
+    with output_file(out_path) as fp, gif_writer.GifWriter(
+        fp, size=(width_out, height_out), loop=loop
+    ) as writer:
+        encoded_frames = pipeline.ordered_map(encoded_frame, output_frames, executor)
+        for encoded, duration in zip(encoded_frames, durations):
+            writer.write_encoded(
+                encoded, duration, disposal=disposal, transparency=transparency
+            )
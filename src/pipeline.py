@@ -0,0 +1,46 @@
+import collections
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-frame work on a single animation (decoding, gathering, encoding) spread across
+# a pool of threads (see fix.py's --threads): PIL's decoders and encoders and most of
+# numpy release the GIL while they work, so frames can be handled on several cores
+# even within one process.
+#
+# Frames are handed out by a producer (e.g. PIL's frame-by-frame decoding, which
+# has to stay sequential) and their results come back in the same order, with
+# only a bounded number of frames in flight at a time, so memory use doesn't grow
+# with the number of frames.
+
+# Most frames in flight (submitted, but not yet consumed) at a time
+MAX_PENDING = 16
+
+
+@contextlib.contextmanager
+def frame_executor(threads=None):
+    # Thread pool for per-frame work with the given number of threads, or None if
+    # frames are to be handled one after another on the calling thread instead
+    if not threads or threads <= 1:
+        yield None
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        yield executor
+
+
+def ordered_map(function, items, executor=None, max_pending=MAX_PENDING):
+    # Same as map(function, items), with function run on the given executor (if
+    # any): items are only taken from the iterable as earlier results are consumed
+    # (at most max_pending ahead), and results are yielded in the order of the items
+    if executor is None:
+        yield from map(function, items)
+        return
+
+    pending = collections.deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
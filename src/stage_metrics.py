@@ -0,0 +1,217 @@
+import contextlib
+import contextvars
+import json
+import logging
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# Metrics of the file currently being processed (by this thread), if any
+_current = contextvars.ContextVar("metrics", default=None)
+
+
+class Metrics:
+    # Wall time of each stage of processing a single file, along with the number of
+    # frames and pixels each stage went through, and, with trace_memory, the peak
+    # memory used during each stage (as traced by tracemalloc, i.e. memory allocated
+    # through Python, including numpy arrays)
+    #
+    # Stages are timed through stage() anywhere in the pipeline, while the metrics
+    # are active (see activate()); outside of that, stage() does nothing at all.
+
+    def __init__(self, path=None, trace_memory=False):
+        self.path = None if path is None else str(path)
+        self.trace_memory = trace_memory
+        self.stages = {}
+        self.values = {}
+        self.num_frames = 0
+        self.num_pixels = 0
+        self.seconds = 0.0
+        self.peak_bytes = None
+
+        # Peak memory of each stage that's currently running (innermost last)
+        self._peaks = []
+
+    @contextlib.contextmanager
+    def activate(self):
+        # Make these the metrics that stage() records into, for the duration of the
+        # with block, which is timed as a whole
+        token = _current.set(self)
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            self._start_peak()
+
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.seconds += time.perf_counter() - start
+            if self.trace_memory:
+                self.peak_bytes = self._end_peak()
+            if started_tracing:
+                tracemalloc.stop()
+            _current.reset(token)
+
+    def _start_peak(self):
+        # Start tracking the peak memory of a (possibly nested) stage, keeping the
+        # peak reached so far for the stage it's nested in
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self._peaks.append(tracemalloc.get_traced_memory()[0])
+
+    def _end_peak(self):
+        # Peak memory of the innermost running stage, which is also a candidate for
+        # the peak of the stage it's nested in (tracemalloc only keeps a single peak)
+        peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+        if self._peaks:
+            self._peaks[-1] = max(self._peaks[-1], peak)
+        tracemalloc.reset_peak()
+        return peak
+
+    def record(self, name, seconds, num_frames=0, num_pixels=0, peak_bytes=None):
+        # Add to the totals of the stage with the given name (a stage may run more
+        # than once per file, e.g. once per chunk of frames)
+        totals = self.stages.setdefault(
+            name, {"seconds": 0.0, "num_frames": 0, "num_pixels": 0}
+        )
+        totals["seconds"] += seconds
+        totals["num_frames"] += num_frames
+        totals["num_pixels"] += num_pixels
+        if peak_bytes is not None:
+            totals["peak_bytes"] = max(totals.get("peak_bytes", 0), peak_bytes)
+
+    def set(self, name, value):
+        # Record any other (JSON-friendly) value about the file
+        self.values[name] = value
+
+    def to_dict(self):
+        result = {
+            "path": self.path,
+            "seconds": self.seconds,
+            "num_frames": self.num_frames,
+            "num_pixels": self.num_pixels,
+            **rates(self.seconds, self.num_frames, self.num_pixels),
+            "stages": {
+                name: {**totals, **rates(**totals)}
+                for name, totals in self.stages.items()
+            },
+            **self.values,
+        }
+        if self.peak_bytes is not None:
+            result["peak_bytes"] = self.peak_bytes
+        return result
+
+
+def rates(seconds, num_frames, num_pixels, **_):
+    if seconds <= 0:
+        return {"frames_per_second": None, "pixels_per_second": None}
+    return {
+        "frames_per_second": num_frames / seconds,
+        "pixels_per_second": num_pixels / seconds,
+    }
+
+
+def current():
+    # The active Metrics (see Metrics.activate()), or None
+    return _current.get()
+
+
+@contextlib.contextmanager
+def stage(name, frames=None, num_frames=0, num_pixels=0):
+    # Time the with block as the pipeline stage with the given name, in the active
+    # metrics (if there are none, this does nothing)
+    #
+    # The number of frames and pixels the stage goes through can be given either
+    # directly, or as an array of frames of shape (# of frames, ..., height, width);
+    # the yielded dict can also be updated with "num_frames" and "num_pixels" (for
+    # stages that only know those as they go, e.g. when streaming)
+    metrics = _current.get()
+    counts = {"num_frames": num_frames, "num_pixels": num_pixels}
+    if frames is not None:
+        counts["num_frames"] = frames.shape[0]
+        counts["num_pixels"] = frames.shape[0] * frames.shape[-2] * frames.shape[-1]
+
+    if metrics is None:
+        yield counts
+        return
+
+    if metrics.trace_memory:
+        metrics._start_peak()
+    start = time.perf_counter()
+    try:
+        yield counts
+    finally:
+        seconds = time.perf_counter() - start
+        peak_bytes = metrics._end_peak() if metrics.trace_memory else None
+        metrics.record(name, seconds, peak_bytes=peak_bytes, **counts)
+        logger.debug(
+            "%s: %s took %.3fs (%d frames)",
+            metrics.path,
+            name,
+            seconds,
+            counts["num_frames"],
+        )
+
+
+def set_input_size(frames=None, num_frames=0, num_pixels=0):
+    # Record the number of frames (and pixels) of the file being processed, in the
+    # active metrics, if any
+    metrics = _current.get()
+    if metrics is None:
+        return
+    if frames is not None:
+        num_frames = frames.shape[0]
+        num_pixels = frames.shape[0] * frames.shape[-2] * frames.shape[-1]
+    metrics.num_frames = num_frames
+    metrics.num_pixels = num_pixels
+
+
+def set_value(name, value):
+    # Record any other (JSON-friendly) value about the file being processed, in the
+    # active metrics, if any
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.set(name, value)
+
+
+def write_profile(results, profile_path):
+    # Write the metrics of every file of a batch run (as included in the results of
+    # batch.run_batch()), plus their totals, as JSON to the given path
+    files = [result["metrics"] for result in results if result.get("metrics")]
+    seconds = sum(metrics["seconds"] for metrics in files)
+    num_frames = sum(metrics["num_frames"] for metrics in files)
+    num_pixels = sum(metrics["num_pixels"] for metrics in files)
+
+    stages = {}
+    for metrics in files:
+        for name, totals in metrics["stages"].items():
+            stage_totals = stages.setdefault(
+                name, {"seconds": 0.0, "num_frames": 0, "num_pixels": 0}
+            )
+            for key in ("seconds", "num_frames", "num_pixels"):
+                stage_totals[key] += totals[key]
+            if "peak_bytes" in totals:
+                stage_totals["peak_bytes"] = max(
+                    stage_totals.get("peak_bytes", 0), totals["peak_bytes"]
+                )
+
+    profile = {
+        "total": {
+            "seconds": seconds,
+            "num_files": len(files),
+            "num_frames": num_frames,
+            "num_pixels": num_pixels,
+            **rates(seconds, num_frames, num_pixels),
+            "stages": {
+                name: {**totals, **rates(**totals)} for name, totals in stages.items()
+            },
+        },
+        "files": files,
+    }
+
+    with open(profile_path, "w") as fp:
+        json.dump(profile, fp, indent=2)
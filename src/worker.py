@@ -0,0 +1,263 @@
+import argparse
+import base64
+import json
+import logging
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+import batch
+import fix
+
+logger = logging.getLogger(__name__)
+
+# Resident worker mode: numpy, PIL etc. are only imported once, and jobs are then
+# accepted as JSON lines, either on stdin (with responses written to stdout), or
+# over a local Unix socket. Each request is a JSON object with:
+#
+#   "id"       any value, repeated in the response (responses can arrive out of
+#              order, since jobs run concurrently)
+#   "path"     path to the input image, *OR*
+#   "data"     the input image itself, base64-encoded
+#   "name"     (optional, with "data") file name for the input, whose extension
+#              also picks the output's format ("input.gif" by default)
+#   "out"      (optional) path to write the output to; otherwise the output is
+#              returned base64-encoded, as the response's "data"
+#   "options"  (optional) list of fix.py commandline options, e.g. ["--stream"]
+#
+# and each response is a JSON object with the "id", a "status" ("ok" or "failed"),
+# an "error" (or null), the job's "seconds" spent queued and processing, and its
+# "metrics" (see fix.process_file()).
+
+
+# fix.py's options that only apply to a whole batch (where outputs go, how many
+# files are processed at once, how the run is reported), which a single job can't
+# be given
+BATCH_OPTIONS = {
+    "paths": "input paths",
+    "out": "--out",
+    "jobs": "--jobs",
+    "summary": "--summary",
+    "profile": "--profile",
+    "incremental": "--incremental",
+    "analyze_only": "--analyze-only",
+    "verbose": "--verbose",
+}
+
+
+def job_options(arguments):
+    # fix.py's options from a list of commandline arguments (without the paths; a
+    # placeholder one goes first, since e.g. --force-scale takes any number of values)
+    try:
+        options = fix.parse_args(["-"] + list(arguments))
+        defaults = fix.parse_args(["-"])
+    except SystemExit:
+        raise ValueError(f"Invalid options: {arguments}")
+
+    for name, flag in BATCH_OPTIONS.items():
+        if getattr(options, name) != getattr(defaults, name):
+            raise ValueError(f"Invalid options: {flag} can't be given to a single job")
+
+    if options.grid_from is not None:
+        options.reference_grid = fix.reference_grid(options.grid_from, options)
+    return options
+
+
+def run_request(request, scratch_dir=None):
+    # Process a single job (in a worker process), never raising: any failure is
+    # reported in the returned response instead
+    response = {"id": request.get("id")}
+
+    try:
+        options = job_options(request.get("options", []))
+        with tempfile.TemporaryDirectory(
+            prefix="fix-pixel-grid-", dir=scratch_dir
+        ) as scratch:
+            name = Path(request.get("name", "input.gif")).name
+            if "data" in request:
+                in_path = Path(scratch) / f"in_{name}"
+                in_path.write_bytes(base64.b64decode(request["data"]))
+            else:
+                in_path = request["path"]
+                name = Path(in_path).name
+
+            out_path = request.get("out", Path(scratch) / f"out_{name}")
+            result = batch.run_job(
+                fix.process_file, in_path, out_path, options, scratch_dir
+            )
+
+            if result["status"] == "ok" and "out" not in request:
+                data = Path(out_path).read_bytes()
+                response["data"] = base64.b64encode(data).decode("ascii")
+    except Exception as exception:
+        result = {"status": "failed", "error": f"{type(exception).__name__}: "}
+        result["error"] += str(exception)
+
+    response["status"] = result["status"]
+    response["error"] = result["error"]
+    response["processing_seconds"] = result.get("seconds")
+    response["metrics"] = result.get("metrics")
+    return response
+
+
+def warm_up():
+    # Run in each worker process once, so that the first actual job doesn't pay
+    # for any one-time initialization
+    Image.init()
+    return os.getpid()
+
+
+class Worker:
+    # Runs jobs on a pool of (at most concurrency) worker processes, which stay
+    # around between jobs; responses are passed to the given callback as soon as
+    # each job is done
+
+    def __init__(self, concurrency=1, scratch_dir=None):
+        self.scratch_dir = scratch_dir
+        self.executor = ProcessPoolExecutor(max_workers=concurrency)
+        for future in [self.executor.submit(warm_up) for _ in range(concurrency)]:
+            future.result()
+
+    def submit(self, request, respond):
+        start = time.perf_counter()
+
+        def done(future):
+            try:
+                response = future.result()
+            except Exception as exception:
+                # (e.g. a worker process that died)
+                response = {
+                    "id": request.get("id"),
+                    "status": "failed",
+                    "error": f"{type(exception).__name__}: {exception}",
+                }
+            response["seconds"] = time.perf_counter() - start
+            logger.info(
+                "Job %s: %s in %.3fs",
+                response["id"],
+                response["status"],
+                response["seconds"],
+            )
+            respond(response)
+
+        future = self.executor.submit(run_request, request, self.scratch_dir)
+        future.add_done_callback(done)
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+def serve_lines(worker, lines, write_line):
+    # Read requests from an iterable of JSON lines, and write each response (as a
+    # JSON line) with write_line once its job is done, returning once all of them are
+    lock = threading.Lock()
+
+    def respond(response):
+        with lock:
+            write_line(json.dumps(response))
+
+    futures = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("Requests must be JSON objects")
+        except ValueError as exception:
+            respond(
+                {"id": None, "status": "failed", "error": f"Bad request: {exception}"}
+            )
+            continue
+        futures.append(worker.submit(request, respond))
+
+    for future in futures:
+        future.exception()
+
+
+def serve_stdio(worker):
+    # Requests on stdin, responses on stdout; anything else that would have been
+    # written to stdout goes to stderr instead, so it can't get mixed into the
+    # responses
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    def write_line(line):
+        responses.write(line + "\n")
+        responses.flush()
+
+    serve_lines(worker, sys.stdin, write_line)
+
+
+def serve_socket(worker, socket_path):
+    # Requests and responses over a Unix socket at the given path; every connection
+    # can send any number of requests (one per line), and gets their responses back
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def write_line(line):
+                self.wfile.write(line.encode() + b"\n")
+                self.wfile.flush()
+
+            lines = (line.decode() for line in self.rfile)
+            serve_lines(worker, lines, write_line)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    with socketserver.ThreadingUnixStreamServer(socket_path, Handler) as server:
+        logger.info("Listening on %s", socket_path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+
+    # Listen on a Unix socket at the given path (otherwise, stdin/stdout are used)
+    parser.add_argument("--socket", type=str)
+
+    # Number of jobs processed at the same time (each in its own worker process)
+    parser.add_argument("--concurrency", type=int, default=1)
+
+    # Directory in which each job's own scratch directory is created
+    parser.add_argument("--scratch", type=str)
+
+    parser.add_argument("-v", "--verbose", action="count", default=0)
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbose, 2)],
+        format="%(levelname)s %(name)s: %(message)s",
+    )
+
+    worker = Worker(args.concurrency, args.scratch)
+    try:
+        if args.socket is not None:
+            serve_socket(worker, args.socket)
+        else:
+            serve_stdio(worker)
+    finally:
+        worker.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+import asyncio
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import GifImagePlugin, Image, ImageSequence
+
+import api
+import fix
+
+
+def frames_of(data):
+    return np.stack(
+        [
+            np.asarray(frame.convert("RGBA"))
+            for frame in ImageSequence.Iterator(Image.open(io.BytesIO(data)))
+        ]
+    )
+
+
+def test_fix_image(tmp_path, monkeypatch):
+    png = open("examples/mario_86x54.png", "rb").read()
+    gif = open("examples/toy_in.gif", "rb").read()
+    expected = np.asarray(Image.open("examples/mario_86x54_output.png").convert("RGBA"))
+
+    options = fix.parse_args(["-"])
+    fix.run_pipeline("examples/toy_in.gif", tmp_path / "toy.gif", options, False)
+    expected_gif = frames_of((tmp_path / "toy.gif").read_bytes())
+
+    # Nothing is written anywhere (in particular, not in the working directory)
+    (tmp_path / "toy.gif").unlink()
+    monkeypatch.chdir(tmp_path)
+
+    output = api.fix_image(png)
+    assert Image.open(io.BytesIO(output)).format == "PNG"
+    assert np.array_equal(frames_of(output)[0], expected)
+
+    output = api.fix_image(io.BytesIO(gif))
+    assert Image.open(io.BytesIO(output)).format == "GIF"
+    assert np.array_equal(frames_of(output), expected_gif)
+
+    output = api.fix_image(png, force_scale=4)
+    assert Image.open(io.BytesIO(output)).size == (160, 120)
+    output = api.fix_image(png, force_scale=(3, 4))
+    assert Image.open(io.BytesIO(output)).size == (160, 90)
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_fix_image_async():
+    png = open("examples/mario_86x54.png", "rb").read()
+
+    async def fix_both():
+        return await asyncio.gather(
+            api.fix_image_async(png), api.fix_image_async(png, force_scale=4)
+        )
+
+    output, output_x4 = asyncio.run(fix_both())
+    assert output == api.fix_image(png)
+    assert output_x4 == api.fix_image(png, force_scale=4)
+
+
+def test_fix_image_concurrently():
+    # Decodes running at the same time don't leave PIL's (process-wide) GIF loading
+    # strategy changed, nor mix up each other's frames
+    gifs = [
+        open(path, "rb").read()
+        for path in ["examples/toy_in.gif", "examples/mario_86x54_animated.gif"]
+    ]
+    expected = [api.fix_image(gif) for gif in gifs]
+    loading_strategy = GifImagePlugin.LOADING_STRATEGY
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for _ in range(3):
+            jobs = [gifs[index % 2] for index in range(8)]
+            outputs = list(executor.map(api.fix_image, jobs))
+            assert all(
+                np.array_equal(frames_of(output), frames_of(expected[index % 2]))
+                for index, output in enumerate(outputs)
+            )
+            assert GifImagePlugin.LOADING_STRATEGY == loading_strategy
@@ -0,0 +1,199 @@
+import io
+import json
+import shutil
+import tarfile
+import zipfile
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import batch
+import fix
+
+
+def failing_process_file(in_path, out_path, options):
+    with open(out_path, "w") as fp:
+        fp.write("partial output")
+    raise ValueError("corrupt input")
+
+
+def test_run_job_failure(tmp_path):
+    out_path = tmp_path / "out.gif"
+    result = batch.run_job(
+        failing_process_file, "in.gif", out_path, None, scratch_dir=tmp_path
+    )
+
+    assert result["status"] == "failed"
+    assert result["error"] == "ValueError: corrupt input"
+
+    # Neither the partial output nor the job's scratch directory is left behind
+    assert not out_path.exists()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_batch(tmp_path):
+    in_directory = tmp_path / "in"
+    in_directory.mkdir()
+    for name in ("a.png", "b.png", "c.png"):
+        shutil.copy("examples/mario_86x54.png", in_directory / name)
+    (in_directory / "broken.gif").write_bytes(b"GIF89a not really a gif")
+
+    out_directory = tmp_path / "out"
+    summary_path = tmp_path / "summary.json"
+
+    # One corrupt file doesn't abort the rest of the batch
+    exit_code = fix.main(
+        [
+            str(in_directory),
+            "--out",
+            str(out_directory),
+            "--jobs",
+            "2",
+            "--summary",
+            str(summary_path),
+        ]
+    )
+    assert exit_code == 1
+
+    with open(summary_path) as fp:
+        summary = {result["path"]: result for result in json.load(fp)}
+    assert len(summary) == 4
+    assert summary[str(in_directory / "broken.gif")]["status"] == "failed"
+
+    expected = Image.open("examples/mario_86x54_output.png").convert("RGBA")
+    for name in ("a.png", "b.png", "c.png"):
+        assert summary[str(in_directory / name)]["status"] == "ok"
+        output = Image.open(out_directory / name).convert("RGBA")
+        assert output.tobytes() == expected.tobytes()
+
+
+def test_incremental(tmp_path, capsys):
+    in_directory = tmp_path / "in"
+    in_directory.mkdir()
+    for name in ("a.png", "b.png"):
+        shutil.copy("examples/mario_86x54.png", in_directory / name)
+    out_directory = tmp_path / "out"
+    summary_path = tmp_path / "summary.json"
+
+    def run(*extra):
+        argv = [str(in_directory), "--out", str(out_directory), "--incremental"]
+        assert fix.main(argv + ["--summary", str(summary_path)] + list(extra)) == 0
+        with open(summary_path) as fp:
+            return {
+                Path(result["path"]).name: result["status"] for result in json.load(fp)
+            }
+
+    assert run() == {"a.png": "ok", "b.png": "ok"}
+    assert (out_directory / batch.MANIFEST_NAME).exists()
+
+    # Nothing changed, so nothing is processed again
+    capsys.readouterr()
+    assert run("--jobs", "2") == {"a.png": "skipped", "b.png": "skipped"}
+    assert "0 processed (0 succeeded, 0 failed), 2 skipped" in capsys.readouterr().out
+
+    # Only changed inputs, missing outputs, and outputs made with other options are
+    shutil.copy("examples/mario_86x54_x6.png", in_directory / "a.png")
+    assert run() == {"a.png": "ok", "b.png": "skipped"}
+    (out_directory / "b.png").unlink()
+    assert run() == {"a.png": "skipped", "b.png": "ok"}
+    assert run("--force-scale", "2") == {"a.png": "ok", "b.png": "ok"}
+    assert run("--force-scale", "2", "-v") == {"a.png": "skipped", "b.png": "skipped"}
+
+    # Outputs made with --grid-from are stale once the grid in that file changes
+    # (even though its path doesn't)
+    shutil.copy("examples/mario_86x54.png", in_directory / "a.png")
+    reference_path = tmp_path / "reference.png"
+    shutil.copy("examples/mario_86x54.png", reference_path)
+    grid_from = ["--grid-from", str(reference_path)]
+    assert run(*grid_from) == {"a.png": "ok", "b.png": "ok"}
+    assert run(*grid_from) == {"a.png": "skipped", "b.png": "skipped"}
+
+    # (Same size, but with evenly sized 2x2 blocks)
+    rng = np.random.default_rng(seed=0)
+    blocks = rng.integers(0, 256, size=(27, 43, 3), dtype=np.uint8)
+    Image.fromarray(np.repeat(np.repeat(blocks, 2, axis=0), 2, axis=1)).save(
+        reference_path
+    )
+    assert run(*grid_from) == {"a.png": "ok", "b.png": "ok"}
+
+    # An input that is missing fails on its own, without stopping the rest
+    argv = [str(in_directory / "a.png"), str(in_directory / "missing.png")]
+    argv += ["--out", str(out_directory), "--incremental", "--force-scale", "3"]
+    assert fix.main(argv + ["--summary", str(summary_path)]) == 1
+    with open(summary_path) as fp:
+        results = {Path(result["path"]).name: result for result in json.load(fp)}
+    assert results["a.png"]["status"] == "ok"
+    assert results["missing.png"]["status"] == "failed"
+    assert results["missing.png"]["error"].startswith("FileNotFoundError")
+
+
+def test_archives(tmp_path):
+    # Inputs are read straight out of an archive, and outputs written straight into
+    # another one, keeping the inputs' subdirectories
+    in_path = tmp_path / "in.zip"
+    with zipfile.ZipFile(in_path, "w") as archive:
+        archive.write("examples/mario_86x54.png", "a/mario.png")
+        archive.write("examples/mario_86x54.png", "b/mario.png")
+        archive.writestr("b/broken.gif", b"GIF89a not really a gif")
+
+    expected = Image.open("examples/mario_86x54_output.png").convert("RGBA")
+    for out_name, jobs in (("out.tar.gz", "2"), ("out.zip", "1")):
+        out_path = tmp_path / out_name
+        summary_path = tmp_path / "summary.json"
+        exit_code = fix.main(
+            [str(in_path), "--out", str(out_path), "--jobs", jobs]
+            + ["--summary", str(summary_path), "--scratch", str(tmp_path)]
+        )
+        assert exit_code == 1
+
+        with open(summary_path) as fp:
+            summary = {result["path"]: result for result in json.load(fp)}
+        assert summary[f"{in_path}/b/broken.gif"]["status"] == "failed"
+        assert summary[f"{in_path}/a/mario.png"]["out_path"] == (
+            f"{out_path}/a/mario.png"
+        )
+
+        if out_name.endswith(".zip"):
+            archive = zipfile.ZipFile(out_path)
+            names, read = archive.namelist(), archive.read
+        else:
+            archive = tarfile.open(out_path)
+            names = archive.getnames()
+            read = lambda name: archive.extractfile(name).read()  # noqa: E731
+        with archive:
+            assert sorted(names) == ["a/mario.png", "b/mario.png"]
+            for name in names:
+                output = Image.open(io.BytesIO(read(name))).convert("RGBA")
+                assert output.tobytes() == expected.tobytes()
+
+    # Nothing is left behind in the scratch directory
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "in.zip",
+        "out.tar.gz",
+        "out.zip",
+        "summary.json",
+    ]
+
+
+def test_duplicate_outputs(tmp_path, caplog):
+    # Same-named members of different archives would end up as the same output, so
+    # they're rejected before anything is processed (or the output archive made)
+    in_paths = [tmp_path / "in.zip", tmp_path / "in.tar"]
+    with zipfile.ZipFile(in_paths[0], "w") as archive:
+        archive.write("examples/mario_86x54.png", "sub/mario.png")
+        archive.write("examples/mario_86x54.png", "zip_only.png")
+    with tarfile.open(in_paths[1], "w") as archive:
+        archive.add("examples/mario_86x54.png", "sub/mario.png")
+
+    for out_name in ("out.tar.gz", "out"):
+        out_path = tmp_path / out_name
+        argv = [str(path) for path in in_paths] + ["--out", str(out_path)]
+        assert fix.main(argv) == 2
+        assert not out_path.exists() or not any(
+            path.is_file() for path in out_path.rglob("*")
+        )
+        assert "sub/mario.png" in caplog.text
+        assert f"{in_paths[0]}/sub/mario.png, {in_paths[1]}/sub/mario.png" in (
+            caplog.text
+        )
@@ -0,0 +1,27 @@
+import numpy as np
+
+from benchmarks import bench_pipeline, corpus
+
+
+def test_ground_truth_grid():
+    # 40x30 stretched onto 86x54: columns are mostly 2 pixels wide (some 3), and
+    # rows are mostly 2 pixels tall (some 1)
+    h_starts, h_scale = corpus.ground_truth_grid(40, 86)
+    v_starts, v_scale = corpus.ground_truth_grid(30, 54)
+    assert (len(h_starts), h_scale) == (40, 2)
+    assert (len(v_starts), v_scale) == (30, 2)
+    assert set(np.diff(np.append(h_starts, 86))) == {2, 3}
+    assert set(np.diff(np.append(v_starts, 54))) == {1, 2}
+
+    frames = np.arange(30 * 40).reshape((1, 30, 40))
+    stretched = corpus.stretch(frames, (86, 54))
+    assert stretched.shape == (1, 54, 86)
+    assert np.array_equal(stretched[:, v_starts][:, :, h_starts], frames)
+
+
+def test_benchmark_case(tmp_path):
+    for case in corpus.make_corpus(tmp_path, [6], [(40, 30)], [(86, 54)]):
+        result = bench_pipeline.benchmark_case(case, tmp_path, repeat=1)
+        assert all(result["correct"].values())
+        assert list(result["stages"])[0] == "decode"
+        assert all(stage["seconds"] >= 0 for stage in result["stages"].values())
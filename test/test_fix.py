@@ -1,6 +1,14 @@
-# import pytest
+import json
+import tracemalloc
+from pathlib import Path
 
-# import fix
+import numpy as np
+from PIL import Image, ImageSequence
+
+import fix
+import gif_writer
+import io_tools
+import pipeline
 
 
 def test_spatial_axes_to_end():
@@ -9,3 +17,698 @@ def test_spatial_axes_to_end():
 
 def test_spatial_axes_before_channels():
     pass
+
+
+def write_stretched_gif(path, num_frames, rng):
+    # Animated GIF of random 20x15 frames, stretched onto an uneven grid
+    native = rng.integers(0, 6, size=(num_frames, 15, 20), dtype=np.uint8)
+    stretched = np.repeat(native, rng.integers(2, 4, size=15), axis=1)
+    stretched = np.repeat(stretched, rng.integers(2, 4, size=20), axis=2)
+
+    palette = rng.integers(0, 256, size=(6 * 3,)).tolist()
+    images = []
+    for frame in stretched:
+        image = Image.fromarray(frame, mode="P")
+        image.putpalette(palette)
+        images.append(image)
+
+    images[0].save(path, save_all=True, append_images=images[1:], duration=40, loop=0)
+
+
+def decoded_frames(path):
+    image = Image.open(path)
+    return np.stack([frame.convert("RGBA") for frame in ImageSequence.Iterator(image)])
+
+
+def test_stream_image(tmp_path):
+    out_path = tmp_path / "out.gif"
+
+    for in_path in ("test/images/travelling_dot_7x_wide.gif", "examples/toy_in.gif"):
+        img = Image.open(in_path)
+        expected = fix.process_image(img, force_scale=[3])
+        fix.stream_image(img, out_path, force_scale=[3], optimize=False)
+
+        # Same output as the in-memory pipeline (up to the RGB values of purely
+        # transparent pixels)
+        output = decoded_frames(out_path)
+        expected[expected[..., 3] == 0] = 0
+        output[output[..., 3] == 0] = 0
+        assert np.array_equal(output, expected)
+
+        # ... also when written as deltas between frames
+        fix.stream_image(img, out_path, force_scale=[3])
+        output = decoded_frames(out_path)
+        output[output[..., 3] == 0] = 0
+        assert np.array_equal(output, expected)
+
+        # Stopping pass one early once the grid stops changing
+        fix.stream_image(
+            img, out_path, force_scale=[3], fast_grid={"patience": 2}, optimize=False
+        )
+        output = decoded_frames(out_path)
+        output[output[..., 3] == 0] = 0
+        assert np.array_equal(output, expected)
+
+        durations = [frame.info["duration"] for frame in ImageSequence.Iterator(img)]
+        output_durations = [
+            frame.info["duration"]
+            for frame in ImageSequence.Iterator(Image.open(out_path))
+        ]
+        assert output_durations == durations
+
+        # No more than max_frames frames are looked at by the fast walk, falling
+        # back to a full scan (of every frame) if the grid hadn't stopped changing
+        for max_frames, num_frames in ((8, 8 + img.n_frames), (img.n_frames,) * 2):
+            options = fix.parse_args(
+                [in_path, "--stream", "--fast-grid", "--force-scale", "3"]
+                + ["--grid-max-frames", str(max_frames), "--grid-patience", "100"]
+            )
+            metrics = fix.process_file(in_path, out_path, options)
+            assert metrics["stages"]["scan"]["num_frames"] == num_frames
+            output = decoded_frames(out_path)
+            output[output[..., 3] == 0] = 0
+            assert np.array_equal(output, expected)
+
+
+def test_stream_image_memory(tmp_path):
+    rng = np.random.default_rng(seed=0)
+
+    # Peak memory use while streaming shouldn't grow with the number of frames
+    peaks = []
+    for num_frames in (4, 40):
+        in_path = tmp_path / f"in_{num_frames}.gif"
+        write_stretched_gif(in_path, num_frames, rng)
+
+        tracemalloc.start()
+        fix.stream_image(Image.open(in_path), tmp_path / "out.gif", optimize=False)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    assert peaks[1] < 2 * peaks[0]
+
+
+def indexed_to_RGBA(frames, palette, transparency):
+    # RGBA frames from frames of palette indices with shape (# frames, h, w[, 1])
+    frames = frames.reshape(frames.shape[0:3])
+    rgba = np.full(shape=frames.shape + (4,), fill_value=255, dtype=np.uint8)
+    rgba[..., 0:3] = palette[frames]
+    if transparency is not None:
+        rgba[frames == transparency] = 0
+    return rgba
+
+
+def test_canonical_palette_indices():
+    palette = np.array(
+        [[0, 0, 0], [9, 9, 9], [0, 0, 0], [1, 2, 3], [9, 9, 9], [9, 9, 9]],
+        dtype=np.uint8,
+    )
+    lookup = fix.canonical_palette_indices(palette)
+    assert tuple(lookup[0:6]) == (0, 1, 0, 3, 1, 1)
+
+    # The transparency index never shares its color with another index
+    lookup = fix.canonical_palette_indices(palette, transparency=4)
+    assert tuple(lookup[0:6]) == (0, 1, 0, 3, 4, 1)
+
+
+def test_PIL_image_to_indices():
+    for path in ("test/images/smwgreen_x3.gif", "examples/toy_in.gif"):
+        img = Image.open(path)
+        frames, palette, transparency, durations = fix.PIL_image_to_indices(img)
+        assert frames.dtype == np.uint8
+        assert frames.shape[-1] == 1
+
+        expected = decoded_frames(path)
+        expected[expected[..., 3] == 0] = 0
+        assert np.array_equal(indexed_to_RGBA(frames, palette, transparency), expected)
+        assert durations == [
+            frame.info["duration"] for frame in ImageSequence.Iterator(img)
+        ]
+
+    # Palette index 2 is transparent in the first frame, but an opaque color in
+    # the second one
+    assert fix.PIL_image_to_indices(Image.open("examples/trivial_in.gif")) is None
+
+    # Not a GIF
+    assert fix.PIL_image_to_indices(Image.open("examples/mario.png")) is None
+
+
+def test_PIL_image_to_indices_local_palette(tmp_path):
+    rng = np.random.default_rng(seed=0)
+    palette = rng.integers(0, 256, size=(8, 3), dtype=np.uint8)
+    indices = rng.integers(0, 8, size=(3, 10, 12), dtype=np.uint8)
+
+    # The second frame uses a (local) palette with the same colors in a different
+    # order, so its indices have to be remapped
+    order = np.array([3, 1, 7, 0, 2, 6, 5, 4])
+    images = [Image.fromarray(frame, mode="P") for frame in indices]
+    for image in images:
+        image.putpalette(palette.reshape((-1,)).tolist())
+    images[1] = Image.fromarray(np.argsort(order)[indices[1]].astype(np.uint8), "P")
+    images[1].putpalette(palette[order].reshape((-1,)).tolist())
+
+    path = tmp_path / "local.gif"
+    images[0].save(path, save_all=True, append_images=images[1:], duration=40)
+
+    frames, palette_out, transparency, _ = fix.PIL_image_to_indices(Image.open(path))
+    assert transparency is None
+    assert np.array_equal(
+        indexed_to_RGBA(frames, palette_out, None), decoded_frames(path)
+    )
+
+    # A local palette color that's missing from the global palette
+    palette[order[0]] = palette[order[0]] ^ 1
+    images[1].putpalette(palette[order].reshape((-1,)).tolist())
+    images[0].save(path, save_all=True, append_images=images[1:], duration=40)
+    assert fix.PIL_image_to_indices(Image.open(path)) is None
+
+
+def test_process_indexed_image(tmp_path):
+    out_path = tmp_path / "out.gif"
+
+    for in_path in ("test/images/travelling_dot_7x_wide.gif", "examples/real_in.gif"):
+        img = Image.open(in_path)
+        expected = fix.process_image(img, force_square_aspect=True)
+
+        frames, palette, transparency, durations = fix.PIL_image_to_indices(img)
+        output = fix.process_indexed_image(
+            frames, palette, transparency, force_square_aspect=True
+        )
+        assert output.dtype == np.uint8
+
+        io_tools.save_from_indexed_frames(
+            output, palette, transparency, durations, out_path, optimize=False
+        )
+
+        # The saved GIF matches the RGBA pipeline's output, and the input's palette
+        # is written back out unchanged
+        saved = decoded_frames(out_path)
+        expected[expected[..., 3] == 0] = 0
+        saved[saved[..., 3] == 0] = 0
+        assert np.array_equal(saved, expected)
+
+        saved_palette = Image.open(out_path).getpalette()
+        assert saved_palette[: palette.size] == palette.reshape((-1,)).tolist()
+
+
+def write_repeated_gif(path, rng, repeats, transparent=False, loop=0):
+    # Animated GIF of random frames, each frame repeated the given number of times
+    # (like a recording at a higher framerate than the game itself)
+    #
+    # (Written with GifWriter, since PIL merges identical consecutive frames itself)
+    native = rng.integers(0, 6, size=(len(repeats), 15, 20), dtype=np.uint8)
+    if transparent:
+        native[:, 0, 0] = 5
+    stretched = np.repeat(np.repeat(native, 2, axis=1), 3, axis=2)
+
+    palette = rng.integers(0, 256, size=(6, 3), dtype=np.uint8)
+    transparency = 5 if transparent else None
+    with open(path, "wb") as fp, gif_writer.GifWriter(
+        fp, size=(60, 30), loop=loop
+    ) as writer:
+        for frame, count in zip(stretched, repeats):
+            for _ in range(count):
+                writer.write_frame(
+                    gif_writer.palette_image(frame, palette),
+                    duration=20,
+                    disposal=2 if transparent else 1,
+                    transparency=transparency,
+                )
+
+
+def test_collapse_duplicate_frames():
+    rng = np.random.default_rng(seed=0)
+    distinct = rng.integers(0, 256, size=(4, 6, 5, 4), dtype=np.uint8)
+    frames = distinct[[0, 0, 0, 1, 2, 2, 0, 3]]
+    durations = [10, 20, 30, 40, 50, 60, 70, 80]
+
+    assert fix.same_as_previous(frames).tolist() == [
+        False, True, True, False, False, True, False, False
+    ]  # fmt: skip
+
+    collapsed, collapsed_durations = fix.collapse_duplicate_frames(frames, durations)
+    assert np.array_equal(collapsed, distinct[[0, 1, 2, 0, 3]])
+    assert collapsed_durations == [60, 40, 110, 70, 80]
+
+    # A run is split where its total duration would no longer fit in a GIF frame
+    _, collapsed_durations = fix.collapse_duplicate_frames(
+        frames, durations, max_duration=50
+    )
+    assert collapsed_durations == [30, 30, 40, 50, 60, 70, 80]
+
+    # The streaming version gives the same result
+    runs = list(fix.collapse_duplicate_runs(zip(frames, durations)))
+    assert np.array_equal([frame for frame, _ in runs], collapsed)
+    assert [duration for _, duration in runs] == [60, 40, 110, 70, 80]
+
+    # Nothing to collapse
+    collapsed, collapsed_durations = fix.collapse_duplicate_frames(
+        distinct, durations[0:4]
+    )
+    assert collapsed is distinct
+    assert collapsed_durations == durations[0:4]
+
+
+def test_collapse_duplicates(tmp_path):
+    rng = np.random.default_rng(seed=0)
+    repeats = [2, 1, 3, 2]
+
+    for transparent in (False, True):
+        in_path = tmp_path / "in.gif"
+        write_repeated_gif(in_path, rng, repeats, transparent)
+
+        # Every frame of the full output, and every run of identical frames in it
+        expected = decoded_frames(in_path)[np.cumsum([0] + repeats[:-1])]
+        expected = fix.process_frames(expected, force_scale=[2])
+        expected[expected[..., 3] == 0] = 0
+
+        outputs = [
+            tmp_path / name for name in ("indexed.gif", "RGBA.gif", "stream.gif")
+        ]
+        img = Image.open(in_path)
+
+        frames, palette, transparency, durations = fix.PIL_image_to_indices(img)
+        frames, durations = fix.collapse_duplicate_frames(frames, durations)
+        frames = fix.process_indexed_image(
+            frames, palette, transparency, force_scale=[2]
+        )
+        io_tools.save_from_indexed_frames(
+            frames, palette, transparency, durations, outputs[0], optimize=False
+        )
+
+        frames, durations = fix.decode_image(img)
+        frames, durations = fix.collapse_duplicate_frames(frames, durations)
+        frames = fix.process_frames(frames, force_scale=[2])
+        io_tools.save_from_frames(
+            img, frames, outputs[1], transparent, durations, optimize=False
+        )
+
+        fix.stream_image(
+            img, outputs[2], force_scale=[2], collapse_duplicates=True, optimize=False
+        )
+
+        for out_path in outputs:
+            output = decoded_frames(out_path)
+            output[output[..., 3] == 0] = 0
+            assert np.array_equal(output, expected)
+
+            output_durations = [
+                frame.info["duration"]
+                for frame in ImageSequence.Iterator(Image.open(out_path))
+            ]
+            assert output_durations == [20 * count for count in repeats]
+
+    # An animation of nothing but identical frames keeps its (total) duration,
+    # whichever way it's decoded
+    for transparent in (False, True):
+        in_path = tmp_path / "in.gif"
+        write_repeated_gif(in_path, rng, [3], transparent)
+        for extra in ([], ["--stream"], ["--memmap"]):
+            options = fix.parse_args([str(in_path), "--collapse-duplicates"] + extra)
+            options.scratch = str(tmp_path)
+            out_path = tmp_path / "out.gif"
+            fix.process_file(in_path, out_path, options)
+
+            output = Image.open(out_path)
+            assert output.n_frames == 1
+            assert output.info["duration"] == 60
+
+
+def test_process_frames_chunked(tmp_path):
+    for in_path in ("examples/toy_in.gif", "test/images/travelling_dot_7x_wide.gif"):
+        img = Image.open(in_path)
+        expected = fix.process_image(img, force_square_aspect=True)
+
+        frames, durations = fix.decode_image_to_memmap(img, tmp_path / "frames.bin")
+        assert isinstance(frames, np.memmap)
+        assert durations == fix.decode_image(img)[1]
+
+        output = fix.process_frames_chunked(
+            frames, tmp_path / "out.bin", force_square_aspect=True, chunk_frames=3
+        )
+        assert isinstance(output, np.memmap)
+        assert np.array_equal(output, expected)
+
+
+def test_process_frames_chunked_memory(tmp_path):
+    rng = np.random.default_rng(seed=0)
+
+    # Neither the input frames nor the output frames are ever all held in memory,
+    # so peak memory use doesn't grow with the number of frames
+    peaks = []
+    for num_frames in (8, 80):
+        in_path = tmp_path / f"in_{num_frames}.gif"
+        write_stretched_gif(in_path, num_frames, rng)
+        img = Image.open(in_path)
+
+        tracemalloc.start()
+        frames, _ = fix.decode_image_to_memmap(img, tmp_path / f"{num_frames}.bin")
+        fix.process_frames_chunked(
+            frames, tmp_path / f"out_{num_frames}.bin", chunk_frames=4
+        )
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    assert peaks[1] < 2 * peaks[0]
+
+
+def test_collapse_duplicate_frames_in_place(tmp_path):
+    rng = np.random.default_rng(seed=0)
+    distinct = rng.integers(0, 256, size=(3, 6, 5, 4), dtype=np.uint8)
+    frames = np.memmap(tmp_path / "frames.bin", np.uint8, "w+", shape=(6, 6, 5, 4))
+    frames[:] = distinct[[0, 1, 1, 1, 2, 2]]
+
+    collapsed, durations = fix.collapse_duplicate_frames(
+        frames, [10] * 6, in_place=True
+    )
+    assert np.shares_memory(collapsed, frames)
+    assert np.array_equal(collapsed, distinct)
+    assert durations == [10, 30, 20]
+
+
+def test_process_file_max_memory(tmp_path):
+    in_path = "examples/mario_86x54.png"
+    expected = np.array(Image.open("examples/mario_86x54_output.png").convert("RGBA"))
+
+    # The decoded input is larger than the budget, so it's processed through
+    # scratch files in the given scratch directory
+    out_path = tmp_path / "out.png"
+    options = fix.parse_args(
+        [in_path, "--max-memory", "0", "--scratch", str(tmp_path / "scratch")]
+    )
+    (tmp_path / "scratch").mkdir()
+    fix.process_file(in_path, out_path, options)
+
+    assert np.array_equal(np.array(Image.open(out_path).convert("RGBA")), expected)
+    assert list((tmp_path / "scratch").iterdir()) == []
+
+
+def test_process_frames_tiled():
+    rng = np.random.default_rng(seed=0)
+    native = rng.integers(0, 256, size=(300, 400, 4), dtype=np.uint8)
+    native[native[..., 3] < 64] = 0
+    rows = np.repeat(np.arange(300), rng.integers(2, 4, size=300))
+    columns = np.repeat(np.arange(400), rng.integers(2, 4, size=400))
+    still = native[rows][:, columns][np.newaxis]
+
+    # Same output as processing the whole frame at once, with a lower peak memory
+    # use (on top of the input frame itself; every thread adds its own strip's)
+    outputs, peaks = [], []
+    for tile_threads in (None, 1, 2):
+        frames = still.copy()
+        tracemalloc.start()
+        outputs.append(fix.process_frames(frames, tile_threads=tile_threads))
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    assert np.array_equal(outputs[0], outputs[1])
+    assert np.array_equal(outputs[0], outputs[2])
+    assert peaks[1] < 0.6 * peaks[0]
+
+    # Animations are still processed whole
+    frames = np.concatenate([still, still])
+    assert np.array_equal(fix.process_frames(frames, tile_threads=2)[1], outputs[0][0])
+
+
+def test_process_file_upscales_lazily(tmp_path):
+    rng = np.random.default_rng(seed=0)
+    in_path = tmp_path / "in.gif"
+    write_stretched_gif(in_path, 12, rng)
+    img = Image.open(in_path)
+    expected = fix.process_image(img, force_scale=[6])
+    expected_native = fix.process_image(img, force_scale=[1])
+
+    # Every pipeline saves native-resolution frames upscaled by the chosen scale (or
+    # not at all, with --native)
+    out_path = tmp_path / "out.gif"
+    for extra in ([], ["--stream"], ["--memmap", "--scratch", str(tmp_path)]):
+        for native in (False, True):
+            options = fix.parse_args(
+                [str(in_path), "--force-scale", "6"]
+                + extra
+                + (["--native"] if native else [])
+            )
+            metrics = fix.process_file(in_path, out_path, options)
+            output = decoded_frames(out_path)
+            assert np.array_equal(output, expected_native if native else expected)
+            assert metrics["output_scale"] == [6, 6]
+
+    # ... and the upscaled frames are never all held in memory at once
+    peaks = []
+    for scale in ("1", "6"):
+        options = fix.parse_args([str(in_path), "--force-scale", scale])
+        tracemalloc.start()
+        fix.process_file(in_path, out_path, options)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    assert peaks[1] < 2 * peaks[0]
+
+
+def test_output_format(tmp_path):
+    assert fix.output_paths(["a/in.gif", "b/other.gif"], str(tmp_path), "webp") == [
+        tmp_path / "in.webp",
+        tmp_path / "other.webp",
+    ]
+    assert fix.output_paths(["in.gif"], str(tmp_path / "x.png"), "apng") == [
+        tmp_path / "x.png"
+    ]
+
+    # Same frames (and durations) as the GIF output, losslessly (except that PIL
+    # merges identical consecutive frames, adding up their durations)
+    def merged(frames, durations):
+        timeline = []
+        for frame, duration in zip(frames, durations):
+            frame = np.array(frame)
+            frame[frame[..., 3] == 0] = 0
+            if timeline and np.array_equal(timeline[-1][0], frame):
+                timeline[-1][1] += duration
+            else:
+                timeline.append([frame, duration])
+        return timeline
+
+    in_path = "examples/toy_in.gif"
+    durations = [
+        frame.info["duration"] for frame in ImageSequence.Iterator(Image.open(in_path))
+    ]
+    expected = merged(fix.process_image(Image.open(in_path)), durations)
+
+    for output_format in ("webp", "apng"):
+        out_path = tmp_path / f"out.{output_format}"
+        options = fix.parse_args([in_path, "--format", output_format])
+        fix.process_file(in_path, out_path, options)
+
+        output = Image.open(out_path)
+        assert output.format == {"webp": "WEBP", "apng": "PNG"}[output_format]
+        frames, output_durations = [], []
+        for frame in ImageSequence.Iterator(output):
+            frames.append(frame.convert("RGBA"))
+            output_durations.append(frame.info["duration"])
+        output = merged(frames, output_durations)
+
+        assert len(output) == len(expected)
+        for (frame, duration), (expected_frame, expected_duration) in zip(
+            output, expected
+        ):
+            assert np.array_equal(frame, expected_frame)
+            assert duration == expected_duration
+
+
+def test_uses_transparency():
+    frames = np.full((5, 3, 4, 4), 255, dtype=np.uint8)
+    assert not fix.uses_transparency(frames)
+    assert not fix.uses_transparency(frames[:0])
+
+    frames[4, 2, 3, 3] = 0
+    assert fix.uses_transparency(frames)
+    assert fix.uses_transparency(frames, chunk_frames=2)
+    assert not fix.uses_transparency(frames[:4], chunk_frames=2)
+
+
+def test_detect_transparency(tmp_path):
+    rng = np.random.default_rng(seed=0)
+    opaque = np.repeat(np.repeat(rng.integers(0, 256, (6, 8, 4)), 3, 0), 3, 1)
+    opaque[..., 3] = 255
+    transparent = opaque.copy()
+    transparent[:3, :3, 3] = 0
+
+    # Whether any pixel is transparent is recorded, and pure-transparent pixels are
+    # only made consistent if there are any
+    for pixels, has_transparency in ((opaque, False), (transparent, True)):
+        in_path = tmp_path / "in.png"
+        Image.fromarray(pixels.astype(np.uint8), "RGBA").save(in_path)
+        for extra in ([], ["--memmap", "--scratch", str(tmp_path)]):
+            options = fix.parse_args([str(in_path)] + extra)
+            metrics = fix.process_file(in_path, tmp_path / "out.png", options)
+            assert metrics["has_transparency"] == has_transparency
+            assert ("consistent_pure_transparency" in metrics["stages"]) == (
+                has_transparency
+            )
+
+        options = fix.parse_args([str(in_path), "--transparent"])
+        metrics = fix.process_file(in_path, tmp_path / "out.png", options)
+        assert metrics["has_transparency"]
+
+    # The detected (or forced) transparency is what decides whether an animation's
+    # frames are cleared before the next one is drawn
+    in_path = "examples/trivial_in.gif"
+    for extra, disposal in (([], 1), (["--transparent"], 2)):
+        out_path = tmp_path / "out.gif"
+        options = fix.parse_args([in_path] + extra)
+        fix.run_pipeline(in_path, out_path, options, optimize=False)
+        assert [
+            frame.disposal_method
+            for frame in ImageSequence.Iterator(Image.open(out_path))
+        ] == [disposal] * 2
+
+
+def test_threads(tmp_path):
+    # Every pipeline writes exactly the same output with its frames spread across a
+    # pool of threads
+    for in_path, extra in (
+        ("examples/toy_in.gif", []),
+        ("examples/real_in.gif", []),
+        ("examples/mario_86x54_animated_x6.gif", ["--collapse-duplicates"]),
+        ("examples/toy_in.gif", ["--stream"]),
+        ("examples/toy_in.gif", ["--format", "webp"]),
+        ("examples/mario_86x54_x6.png", []),
+    ):
+        suffix = ".webp" if "webp" in extra else Path(in_path).suffix
+        outputs = []
+        for threads in ("1", "3"):
+            out_path = tmp_path / f"out_{threads}{suffix}"
+            options = fix.parse_args([in_path, "--threads", threads] + extra)
+            fix.process_file(in_path, out_path, options)
+            outputs.append(out_path.read_bytes())
+        assert outputs[0] == outputs[1], (in_path, extra)
+
+    # ... including frames decoded as RGBA and saved without optimization
+    img = Image.open("examples/toy_in.gif")
+    with pipeline.frame_executor(3) as executor:
+        frames, durations = fix.decode_image(img, executor)
+        assert np.array_equal(frames, fix.decode_image(img)[0])
+
+        output = fix.process_frames(frames, executor=executor)
+        assert np.array_equal(output, fix.process_frames(frames))
+        assert io_tools.encode_gif(output, durations, executor=executor) == (
+            io_tools.encode_gif(output, durations)
+        )
+
+
+def test_decode_frames(tmp_path):
+    img = Image.open("examples/toy_in.gif")
+    decoded = fix.decode_frames(img)
+    frames, palette, transparency, durations = fix.PIL_image_to_indices(img)
+    assert decoded.is_indexed and decoded.is_animated and decoded.format == "GIF"
+    assert np.array_equal(decoded.frames, frames)
+    assert np.array_equal(decoded.palette, palette)
+    assert decoded.durations == durations
+    assert decoded.info["loop"] == img.info["loop"]
+
+    # Images that can't be kept as palette indices are decoded as RGBA
+    for path in ("examples/trivial_in.gif", "examples/mario.png"):
+        img = Image.open(path)
+        frames, durations = fix.decode_image(img)
+        for decoded in (
+            fix.decode_frames(img),
+            fix.decode_frames(img, memmap_path=tmp_path / "frames.bin"),
+        ):
+            assert not decoded.is_indexed
+            assert np.array_equal(decoded.frames, frames)
+            assert decoded.durations == durations
+            assert decoded.is_animated == getattr(img, "is_animated", False)
+
+
+def test_loop(tmp_path):
+    # Outputs loop as many times as their input does (or only play once, like it)
+    rng = np.random.default_rng(seed=0)
+    in_path = tmp_path / "in.gif"
+    for loop in (None, 0, 3):
+        write_repeated_gif(in_path, rng, [1, 1, 1], loop=loop)
+        for extra in ([], ["--stream"], ["--memmap"], ["--format", "gif"]):
+            options = fix.parse_args([str(in_path)] + extra)
+            options.scratch = str(tmp_path)
+            for optimize in (True, False):
+                out_path = tmp_path / "out.gif"
+                fix.run_pipeline(in_path, out_path, options, optimize)
+                assert Image.open(out_path).info.get("loop") == loop
+
+
+def test_process_file_decodes_once(tmp_path, monkeypatch):
+    # Every frame is decoded exactly once, from analysis through to saving
+    num_decoded = [0]
+
+    class CountingIterator(ImageSequence.Iterator):
+        def __next__(self):
+            frame = super().__next__()
+            num_decoded[0] += 1
+            return frame
+
+    monkeypatch.setattr(ImageSequence, "Iterator", CountingIterator)
+    for in_path, extra in (
+        ("examples/toy_in.gif", []),
+        ("examples/toy_in.gif", ["--format", "webp"]),
+        ("examples/mario_86x54_x6.png", []),
+        ("examples/toy_in.gif", ["--memmap", "--scratch", str(tmp_path)]),
+    ):
+        num_decoded[0] = 0
+        suffix = ".webp" if "webp" in extra else Path(in_path).suffix
+        options = fix.parse_args([in_path] + extra)
+        fix.process_file(in_path, tmp_path / f"out{suffix}", options)
+        assert num_decoded[0] == getattr(Image.open(in_path), "n_frames", 1)
+
+
+def test_analyze_only(tmp_path):
+    out_directory = tmp_path / "out"
+    inputs = ["examples/mario_86x54.png", "examples/mario_86x54_output.png"]
+    assert fix.main(inputs + ["--analyze-only", "--out", str(out_directory)]) == 0
+
+    # Only a JSON report is written for each input, rather than the fixed image
+    assert sorted(path.name for path in out_directory.iterdir()) == [
+        "mario_86x54.json",
+        "mario_86x54_output.json",
+    ]
+    with open(out_directory / "mario_86x54.json") as fp:
+        report = json.load(fp)
+    expected_grid = fix.analyze_grid(
+        fix.spatial_axes_to_end(fix.decode_image(Image.open(inputs[0]))[0])
+    )
+    assert report["grid"] == {
+        "rows": expected_grid[0][0].tolist(),
+        "columns": expected_grid[0][1].tolist(),
+    }
+    assert report["block_lengths"] == {
+        "vertical": {"1": 6, "2": 24},
+        "horizontal": {"2": 34, "3": 6},
+    }
+    assert report["scale"] == [2, 2]
+    assert report["size"] == [86, 54] and report["native_size"] == [40, 30]
+    assert report["confidence"] == {"vertical": 0.8, "horizontal": 0.85}
+    assert report["distorted"] and report["action"] == "fix"
+    assert report["decoded"]
+
+    # Inputs that are already evenly scaled have nothing to fix (unless a
+    # different scale is asked for)
+    with open(out_directory / "mario_86x54_output.json") as fp:
+        report = json.load(fp)
+    assert not report["distorted"] and report["action"] == "no-op"
+    options = fix.parse_args([inputs[1], "--analyze-only", "--force-scale", "3"])
+    metrics = fix.analyze_file(inputs[1], tmp_path / "report.json", options)
+    assert metrics["report"]["action"] == "fix"
+    assert "decimate_and_upscale" not in metrics["stages"]
+
+    # An already-known grid doesn't need any frames decoded at all
+    options = fix.parse_args(
+        [inputs[0], "--analyze-only", "--grid-from", "examples/mario_86x54.png"]
+    )
+    options.reference_grid = fix.reference_grid(options.grid_from, options)
+    metrics = fix.analyze_file(inputs[0], tmp_path / "report.json", options)
+    assert not metrics["report"]["decoded"]
+    assert "decode" not in metrics["stages"]
+    assert metrics["report"]["block_lengths"] == report_lengths(inputs[0], tmp_path)
+
+
+def report_lengths(in_path, tmp_path):
+    options = fix.parse_args([in_path, "--analyze-only", "--memmap"])
+    options.scratch = str(tmp_path)
+    return fix.analyze_file(in_path, tmp_path / "memmap.json", options)["report"][
+        "block_lengths"
+    ]
@@ -0,0 +1,227 @@
+import io
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+import gif_writer
+
+
+def random_rgba(rng, shape, num_colors):
+    # Random RGBA frame using only the given number of distinct (opaque) colors
+    colors = rng.integers(0, 256, size=(num_colors, 4), dtype=np.uint8)
+    colors[:, 3] = 255
+    return colors[rng.integers(0, num_colors, size=shape)]
+
+
+def test_palettize_exact():
+    rng = np.random.default_rng(seed=0)
+    rgba = random_rgba(rng, (12, 17), num_colors=200)
+
+    indices, palette, transparency = gif_writer.palettize(rgba)
+    assert indices.shape == (12, 17)
+    assert indices.dtype == np.uint8
+    assert transparency is None
+    assert np.array_equal(palette[indices], rgba[..., 0:3])
+
+
+def test_palettize_transparency():
+    rng = np.random.default_rng(seed=0)
+    rgba = random_rgba(rng, (12, 17), num_colors=10)
+
+    # Purely transparent pixels with different RGB values share one palette entry
+    rgba[0, 0] = (0, 0, 0, 0)
+    rgba[3, 5] = (255, 255, 255, 0)
+    rgba[4, 4] = (0, 0, 0, 255)
+
+    indices, palette, transparency = gif_writer.palettize(rgba)
+    assert transparency is not None
+    assert indices[0, 0] == indices[3, 5] == transparency
+    assert indices[4, 4] != transparency
+    assert np.count_nonzero(indices == transparency) == 2
+
+    opaque = rgba[..., 3] == 255
+    assert np.array_equal(palette[indices][opaque], rgba[..., 0:3][opaque])
+
+
+def test_palettize_too_many_colors():
+    rng = np.random.default_rng(seed=0)
+    rgba = random_rgba(rng, (40, 40), num_colors=1000)
+    rgba[0, 0, 3] = 0
+
+    indices, palette, transparency = gif_writer.palettize(rgba)
+    assert indices.shape == (40, 40)
+    assert len(palette) <= 256
+    assert transparency == 255
+    assert indices[0, 0] == transparency
+
+
+def test_gif_writer_round_trip():
+    rng = np.random.default_rng(seed=0)
+    frames = [random_rgba(rng, (9, 14), num_colors=n) for n in (1, 2, 30, 256)]
+    # (PIL can only decode transparency in later frames if the first frame uses it)
+    for frame in frames:
+        frame[0, 0, 3] = 0
+    frames[2][0:3, 0:3, 3] = 0
+    durations = [100, 40, 2000, 60]
+
+    buffer = io.BytesIO()
+    with gif_writer.GifWriter(buffer, size=(14, 9)) as writer:
+        for frame, duration in zip(frames, durations):
+            indices, palette, transparency = gif_writer.palettize(frame)
+            image = gif_writer.palette_image(indices, palette)
+            writer.write_frame(
+                image, duration=duration, disposal=2, transparency=transparency
+            )
+    assert writer.num_frames == 4
+
+    buffer.seek(0)
+    image = Image.open(buffer)
+    assert image.size == (14, 9)
+    assert image.n_frames == 4
+    assert image.info["loop"] == 0
+
+    for frame, duration, decoded in zip(
+        frames, durations, ImageSequence.Iterator(image)
+    ):
+        assert decoded.info["duration"] == duration
+
+        decoded = np.asarray(decoded.convert("RGBA"))
+        transparent = frame[..., 3] == 0
+        assert np.array_equal(decoded[..., 3] == 0, transparent)
+        assert np.array_equal(decoded[~transparent], frame[~transparent])
+
+
+def decoded_frames(data):
+    return [
+        np.asarray(frame.convert("RGBA"))
+        for frame in ImageSequence.Iterator(Image.open(io.BytesIO(data)))
+    ]
+
+
+def assert_same_frames(decoded, expected):
+    assert len(decoded) == len(expected)
+    for frame, expected_frame in zip(decoded, expected):
+        transparent = expected_frame[..., 3] == 0
+        assert np.array_equal(frame[..., 3] == 0, transparent)
+        assert np.array_equal(frame[~transparent], expected_frame[~transparent])
+
+
+def sprite_frames(rng, num_frames, size=(20, 30), transparent=True):
+    # Frames in which a small square changes at a time, with index 0 of the palette
+    # (optionally) transparent, so that pixels also become transparent over time
+    palette = rng.integers(0, 256, size=(5, 4), dtype=np.uint8)
+    palette[:, 3] = 255
+    if transparent:
+        palette[0, 3] = 0
+
+    indices = rng.integers(0, 5, size=size)
+    frames = []
+    for _ in range(num_frames):
+        indices = indices.copy()
+        top, left = rng.integers(0, size[0] - 4), rng.integers(0, size[1] - 4)
+        indices[top : top + 4, left : left + 4] = rng.integers(0, 5, size=(4, 4))
+        frames.append(palette[indices])
+    return frames
+
+
+def test_delta_gif_writer():
+    rng = np.random.default_rng(seed=0)
+
+    for transparent in (False, True):
+        frames = sprite_frames(rng, 10, transparent=transparent)
+        # (A frame identical to the previous one)
+        frames.insert(5, frames[4])
+        durations = list(range(10, 10 * len(frames) + 10, 10))
+
+        sizes = {}
+        for scale in ((1, 1), (2, 3)):
+            size = (30 * scale[1], 20 * scale[0])
+            buffer = io.BytesIO()
+            with gif_writer.DeltaGifWriter(buffer, size, scale=scale) as writer:
+                for frame, duration in zip(frames, durations):
+                    writer.write_frame(frame, duration=duration)
+            assert writer.num_frames == len(frames)
+
+            expected = [
+                np.repeat(np.repeat(frame, scale[0], axis=0), scale[1], axis=1)
+                for frame in frames
+            ]
+            assert_same_frames(decoded_frames(buffer.getvalue()), expected)
+
+            image = Image.open(buffer)
+            assert image.size == size
+            assert [
+                frame.info["duration"] for frame in ImageSequence.Iterator(image)
+            ] == durations
+            sizes[scale] = len(buffer.getvalue())
+
+            # Encoding frames on a thread pool writes exactly the same GIF
+            threaded = io.BytesIO()
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                with gif_writer.DeltaGifWriter(
+                    threaded, size, scale=scale, executor=executor, max_pending=2
+                ) as writer:
+                    for frame, duration in zip(frames, durations):
+                        writer.write_frame(frame, duration=duration)
+            assert threaded.getvalue() == buffer.getvalue()
+
+        # Smaller than writing every frame whole
+        plain = io.BytesIO()
+        with gif_writer.GifWriter(plain, size=(30, 20)) as writer:
+            for frame, duration in zip(frames, durations):
+                indices, palette, transparency = gif_writer.palettize(frame)
+                image = gif_writer.palette_image(indices, palette)
+                writer.write_frame(
+                    image, duration=duration, disposal=2, transparency=transparency
+                )
+        assert sizes[(1, 1)] < len(plain.getvalue())
+
+
+def test_delta_gif_writer_many_colors():
+    # Frames with a full palette of 256 colors have no room for a transparent index,
+    # so changed regions are written with their actual colors instead
+    rng = np.random.default_rng(seed=0)
+    colors = rng.permutation(256)
+    first = np.full(shape=(16, 16, 4), fill_value=255, dtype=np.uint8)
+    first[..., 0] = colors.reshape((16, 16))
+    second = first.copy()
+    second[2:5, 2:5, 0:3] = first[8:11, 8:11, 0:3]
+    second[3, 3, 1] = 0
+
+    buffer = io.BytesIO()
+    with gif_writer.DeltaGifWriter(buffer, size=(16, 16)) as writer:
+        writer.write_frame(first, duration=20)
+        writer.write_frame(second, duration=20)
+
+    assert_same_frames(decoded_frames(buffer.getvalue()), [first, second])
+
+
+def test_delta_gif_writer_opaque_to_transparent():
+    # An opaque frame that is cleared after being shown (since a pixel becomes
+    # transparent in the next one) is cleared to transparency, rather than to the
+    # background color, even with a full palette (which leaves no room for a
+    # transparency index without quantizing the frame's colors)
+    rng = np.random.default_rng(seed=0)
+    opaque = np.full(shape=(4, 4, 4), fill_value=255, dtype=np.uint8)
+    opaque[..., 0] = 10
+    many_colors = np.full(shape=(16, 16, 4), fill_value=255, dtype=np.uint8)
+    many_colors[..., 0] = rng.permutation(256).reshape((16, 16))
+
+    for first in (opaque, many_colors):
+        second = first.copy()
+        second[2, 2] = 0
+
+        for executor in (None, ThreadPoolExecutor(max_workers=2)):
+            buffer = io.BytesIO()
+            with gif_writer.DeltaGifWriter(
+                buffer, size=first.shape[1::-1], executor=executor
+            ) as writer:
+                writer.write_frame(first, duration=20)
+                writer.write_frame(second, duration=20)
+                writer.write_frame(second, duration=20)
+
+            decoded = decoded_frames(buffer.getvalue())
+            assert [frame[2, 2, 3] for frame in decoded] == [255, 0, 0]
+            if first is opaque:
+                assert_same_frames(decoded, [first, second, second])
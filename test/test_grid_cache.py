@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+import fix
+import grid_cache
+
+GRID = ((np.array([0, 2, 3, 5]), np.array([0, 3, 6])), (2, 3))
+
+
+def test_grid_cache(tmp_path):
+    cache = grid_cache.GridCache(tmp_path / "cache")
+    assert cache.load("missing") is None
+
+    cache.save("key", GRID)
+    grid_indices, grid_scale = cache.load("key")
+    assert all(np.array_equal(a, b) for a, b in zip(grid_indices, GRID[0]))
+    assert grid_scale == (2, 3)
+
+
+def test_grid_cache_eviction(tmp_path):
+    cache = grid_cache.GridCache(tmp_path)
+    for index, key in enumerate(("a", "b", "c")):
+        cache.save(key, GRID)
+        os.utime(cache.path(key), (index, index))
+    entry_bytes = cache.path("a").stat().st_size
+
+    # Reading "a" makes it the most recently used entry, so "b" is evicted first
+    assert cache.load("a") is not None
+    cache.max_bytes = 3 * entry_bytes
+    cache.save("d", GRID)
+    assert sorted(path.stem for path in tmp_path.iterdir()) == ["a", "c", "d"]
+
+
+def test_grid_cache_keys(tmp_path):
+    path = tmp_path / "in.gif"
+    path.write_bytes(b"GIF89a")
+    key = grid_cache.content_key(path, {"patience": 3})
+    assert key == grid_cache.content_key(path, {"patience": 3})
+    assert key != grid_cache.content_key(path, None)
+
+    path.write_bytes(b"GIF89a, changed")
+    assert key != grid_cache.content_key(path, {"patience": 3})
+
+    key = grid_cache.session_key("snes", (86, 54))
+    assert key == grid_cache.session_key("snes", (86, 54))
+    assert key != grid_cache.session_key("snes", (86, 55))
+    assert key != grid_cache.session_key("genesis", (86, 54))
+
+
+def test_process_file_grid_cache(tmp_path):
+    in_path = "examples/mario_86x54.png"
+    expected = np.array(Image.open("examples/mario_86x54_output.png").convert("RGBA"))
+
+    options = fix.parse_args([in_path, "--grid-cache", str(tmp_path / "cache")])
+    for _ in range(2):
+        out_path = tmp_path / "out.png"
+        fix.process_file(in_path, out_path, options)
+        assert np.array_equal(np.array(Image.open(out_path).convert("RGBA")), expected)
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    # A cached grid that doesn't fit the input is an error, not a silent mismatch
+    cache = grid_cache.GridCache(tmp_path / "cache")
+    too_large = ((np.arange(0, 120, 2), np.arange(0, 120, 2)), (2, 2))
+    for path in (tmp_path / "cache").iterdir():
+        cache.save(path.stem, too_large)
+    with np.testing.assert_raises(ValueError):
+        fix.process_file(in_path, out_path, options)
+
+
+def test_grid_from(tmp_path):
+    in_path = "examples/mario_86x54.png"
+    options = fix.parse_args([in_path, "--grid-from", in_path])
+    options.reference_grid = fix.reference_grid(in_path, options)
+
+    out_path = tmp_path / "out.png"
+    fix.process_file(in_path, out_path, options)
+    expected = np.array(Image.open("examples/mario_86x54_output.png").convert("RGBA"))
+    assert np.array_equal(np.array(Image.open(out_path).convert("RGBA")), expected)
+
+    # Inputs of a different size can't use the same grid
+    with np.testing.assert_raises(ValueError):
+        fix.process_file("examples/mario.png", out_path, options)
@@ -1,3 +1,5 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import pytest
 from PIL import Image
@@ -30,6 +32,27 @@ def dot_7x_wide():
     return open_and_adjust_image("test/images/travelling_dot_7x_wide.gif")
 
 
+@pytest.fixture
+def smwgreen_x3():
+    return open_and_adjust_image("test/images/smwgreen_x3.gif")
+
+
+def legacy_axis_edges(frames, axis):
+    # The original per-row/per-column edge detection that axis_edges() replaced,
+    # kept here as a reference implementation to compare against
+    size = frames.shape[axis]
+    pixel_diffs = np.take(frames, np.arange(1, size), axis=axis) - np.take(
+        frames, np.arange(0, size - 1), axis=axis
+    )
+    v_axis, h_axis = grid_stretch.spatial_axes(frames)
+    other_spatial_axis = v_axis if axis != v_axis else h_axis
+    edges = np.apply_along_axis(
+        grid_stretch.any_nonzero, axis=other_spatial_axis, arr=pixel_diffs
+    )
+    edges = np.any(edges, axis=1)
+    return np.any(edges, axis=0)
+
+
 def test_np_mode():
     simple_flat = np.array([8, 2, 2, 2, 1, 5, 5], dtype=np.int64)
     assert grid_stretch.np_mode(simple_flat) == 2
@@ -72,6 +95,66 @@ def test_any_nonzero():
     assert grid_stretch.any_nonzero(one_nonzero)
 
 
+def test_pack_pixels():
+    # Two frames of 2x3 RGBA pixels, with axes ordered
+    #   (frame #, color channel, vertical, horizontal)
+    # as produced by fix.spatial_axes_to_end()
+    channels_last = np.arange(2 * 2 * 3 * 4, dtype=np.uint8).reshape((2, 2, 3, 4))
+    frames = fix.spatial_axes_to_end(channels_last)
+
+    packed = grid_stretch.pack_pixels(frames)
+    assert packed.shape == (2, 2, 3)
+    assert packed.dtype == np.uint32
+
+    # Each packed value holds exactly the bytes of its pixel's four channels
+    assert packed[1, 0, 2].tobytes() == channels_last[1, 0, 2, :].tobytes()
+
+    # Packing frames that are already laid out channels-last doesn't copy them
+    assert np.shares_memory(packed, channels_last)
+
+    # Pixels are equal after packing if and only if all of their channels are equal
+    channels_last[0, 1, 1, :] = channels_last[0, 1, 0, :]
+    channels_last[0, 1, 2, 0:3] = channels_last[0, 1, 0, 0:3]
+    packed = grid_stretch.pack_pixels(frames)
+    assert packed[0, 1, 1] == packed[0, 1, 0]
+    assert packed[0, 1, 2] != packed[0, 1, 0]
+
+    # Odd numbers of channels are packed into fixed-width byte strings instead
+    rgb = np.zeros(shape=(2, 3, 4, 5), dtype=np.uint8)
+    rgb[1, 2, 3, 4] = 1
+    packed = grid_stretch.pack_pixels(rgb)
+    assert packed.shape == (2, 4, 5)
+    assert np.count_nonzero(packed != packed[0, 0, 0]) == 1
+
+
+def test_axis_edges():
+    # Single frame with a single color channel
+    frames = np.array([[[[1, 1, 2], [1, 1, 2], [3, 3, 2]]]], dtype=np.uint8)
+    v_axis, h_axis = grid_stretch.spatial_axes(frames)
+    assert tuple(grid_stretch.axis_edges(frames, v_axis)) == (False, True)
+    assert tuple(grid_stretch.axis_edges(frames, h_axis)) == (False, True)
+
+
+def test_axis_edges_matches_legacy(dot_7x_wide, smwgreen_x3):
+    rng = np.random.default_rng(seed=0)
+
+    # Random blocky frames, on an uneven grid, where most neighbouring blocks only
+    # differ in one channel
+    native = rng.integers(0, 2, size=(5, 4, 9, 13), dtype=np.uint8)
+    v_repeats = rng.integers(1, 4, size=9)
+    h_repeats = rng.integers(1, 4, size=13)
+    random_frames = np.repeat(np.repeat(native, v_repeats, axis=2), h_repeats, axis=3)
+
+    # Small chunk sizes, to also exercise accumulating edges over several chunks
+    for frames in (dot_7x_wide, smwgreen_x3, random_frames):
+        v_axis, h_axis = grid_stretch.spatial_axes(frames)
+        for axis in (v_axis, h_axis):
+            expected = legacy_axis_edges(frames, axis)
+            for chunk_pixels in (1, 2**22):
+                edges = grid_stretch.axis_edges(frames, axis, chunk_pixels)
+                assert np.array_equal(edges, expected)
+
+
 def test_spatial_axes():
     # ndarray representing an animated image with shape
     #   (frame #, color channel, vertical, horizontal)
@@ -147,3 +230,160 @@ def test_integer_upscale():
 
 def test_mask_by_row_indices():
     pass
+
+
+def test_strided_frame_order():
+    order = grid_stretch.strided_frame_order(10, stride=4)
+    assert tuple(order) == (0, 4, 8, 1, 5, 9, 2, 6, 3, 7)
+
+
+def test_accumulate_grid_edges(dot_7x_wide):
+    consumed = []
+
+    def batches():
+        for index in range(len(dot_7x_wide)):
+            consumed.append(index)
+            yield dot_7x_wide[index : index + 1]
+
+    # Every batch is consumed when not stopping early
+    v_edges, h_edges, stopped_early = grid_stretch.accumulate_grid_edges(batches())
+    assert not stopped_early
+    assert len(consumed) == len(dot_7x_wide)
+    assert np.array_equal(v_edges, grid_stretch.axis_edges(dot_7x_wide, axis=2))
+    assert np.array_equal(h_edges, grid_stretch.axis_edges(dot_7x_wide, axis=3))
+
+    # The same frame over and over again: stops after the first batch, plus the
+    # given number of batches without any new edges
+    consumed.clear()
+    repeated = (dot_7x_wide[0:1] for _ in range(100))
+    _, _, stopped_early = grid_stretch.accumulate_grid_edges(repeated, patience=3)
+    assert stopped_early
+    assert next(repeated) is not None
+    assert sum(1 for _ in repeated) == 100 - 4 - 1
+
+
+def test_analyze_input_grid_fast(dot_7x_wide, smwgreen_x3):
+    for frames in (dot_7x_wide, smwgreen_x3):
+        expected = grid_stretch.analyze_input_grid(frames)
+        (grid_indices, grid_scale), converged = grid_stretch.analyze_input_grid_fast(
+            frames, batch_size=2, stride=4, patience=2
+        )
+        assert converged
+        assert all(map(np.array_equal, grid_indices, expected[0]))
+        assert grid_scale == expected[1]
+
+    # Only looking at a few frames, without the edges having stopped changing
+    _, converged = grid_stretch.analyze_input_grid_fast(
+        dot_7x_wide, batch_size=1, patience=None, max_frames=2
+    )
+    assert not converged
+
+    # Sampling every 7th row and column still finds every edge in the travelling dot
+    (grid_indices, grid_scale), converged = grid_stretch.analyze_input_grid_fast(
+        dot_7x_wide, sample_step=7
+    )
+    assert tuple(grid_indices[1]) == tuple(np.arange(start=0, stop=141, step=14))
+    assert tuple(grid_indices[0]) == tuple(np.arange(start=0, stop=85, step=7))
+    assert grid_scale == (7, 14)
+
+
+def test_gather_indices():
+    source = grid_stretch.gather_indices(([0, 2], [0, 1, 3]), (2, 1), width_in=4)
+    assert source.tolist() == [[0, 1, 3], [0, 1, 3], [8, 9, 11], [8, 9, 11]]
+
+
+def test_decimate_and_upscale(dot_7x_wide):
+    rng = np.random.default_rng(seed=0)
+    grid_indices = (np.array([0, 3, 4, 8]), np.array([0, 2, 5, 7, 11]))
+
+    rgba = fix.spatial_axes_to_end(
+        rng.integers(0, 256, size=(3, 10, 12, 4), dtype=np.uint8)
+    )
+    indexed = fix.spatial_axes_to_end(
+        rng.integers(0, 256, size=(3, 10, 12, 1), dtype=np.uint8)
+    )
+    rgb_still = rng.integers(0, 256, size=(3, 10, 12), dtype=np.uint8)
+
+    # Same result as decimating and upscaling separately, with any number of
+    # channels, with or without a frame axis
+    for frames in (rgba, indexed, rgb_still):
+        for scale in ((1, 1), (2, 3), (6, 6)):
+            expected = grid_stretch.integer_upscale(
+                grid_stretch.mask_by_row_indices(frames, grid_indices), scale
+            )
+            output = grid_stretch.decimate_and_upscale(frames, grid_indices, scale)
+            assert output.dtype == frames.dtype
+            assert np.array_equal(output, expected)
+
+    grid_indices, grid_scale = grid_stretch.analyze_input_grid(dot_7x_wide)
+    expected = grid_stretch.integer_upscale(
+        grid_stretch.mask_by_row_indices(dot_7x_wide, grid_indices), grid_scale
+    )
+
+    # Writing into a preallocated output buffer
+    out = fix.spatial_axes_to_end(np.empty((11, 91, 154, 4), dtype=np.uint8))
+    output = grid_stretch.decimate_and_upscale(
+        dot_7x_wide, grid_indices, grid_scale, out=out
+    )
+    assert output is out
+    assert np.array_equal(out, expected)
+
+    # ... which has to have the same memory layout as the frames
+    with pytest.raises(ValueError):
+        out = np.empty((11, 4, 91, 154), dtype=np.uint8)
+        grid_stretch.decimate_and_upscale(
+            dot_7x_wide, grid_indices, grid_scale, out=out
+        )
+
+
+def stretched_still(rng, native_size=(150, 200), repeats=(1, 3)):
+    # A single RGBA frame with shape (1, 4, height, width), whose native pixels are
+    # stretched unevenly (each row and column repeated 1 or 2 times)
+    native = rng.integers(0, 4, size=native_size + (1,), dtype=np.uint8)
+    frame = np.where(native == 0, 0, rng.integers(1, 256, size=native_size + (4,)))
+    frame = np.repeat(frame, rng.integers(*repeats, size=native_size[0]), axis=0)
+    frame = np.repeat(frame, rng.integers(*repeats, size=native_size[1]), axis=1)
+    return fix.spatial_axes_to_end(frame[np.newaxis].astype(np.uint8))
+
+
+def test_tiled_grid_edges():
+    rng = np.random.default_rng(seed=0)
+    frames = stretched_still(rng)
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        for strip_rows in (1, 7, 256, 1000):
+            v_edges, h_edges = grid_stretch.tiled_grid_edges(
+                frames, executor, strip_rows
+            )
+            expected_v_edges, expected_h_edges = grid_stretch.grid_edges(frames)
+            assert np.array_equal(v_edges, expected_v_edges)
+            assert np.array_equal(h_edges, expected_h_edges)
+
+        grid = grid_stretch.analyze_input_grid(frames, executor)
+
+    expected = grid_stretch.analyze_input_grid(frames)
+    assert all(np.array_equal(a, b) for a, b in zip(grid[0], expected[0]))
+    assert grid[1] == expected[1]
+
+
+def test_decimate_and_upscale_tiled():
+    rng = np.random.default_rng(seed=0)
+    frames = stretched_still(rng)
+    grid_indices, _ = grid_stretch.analyze_input_grid(frames)
+
+    # Output tall enough to be split into several strips
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        for scale in ((1, 1), (3, 2)):
+            expected = grid_stretch.decimate_and_upscale(frames, grid_indices, scale)
+            output = grid_stretch.decimate_and_upscale(
+                frames, grid_indices, scale, executor=executor
+            )
+            assert np.array_equal(output, expected)
+
+            out = fix.spatial_axes_to_end(
+                np.empty_like(fix.spatial_axes_before_channels(expected))
+            )
+            grid_stretch.decimate_and_upscale(
+                frames, grid_indices, scale, out=out, executor=executor
+            )
+            assert np.array_equal(out, expected)
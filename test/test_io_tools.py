@@ -1,7 +1,145 @@
-# import pytest
+import io
+import tarfile
+import zipfile
+from pathlib import Path
 
-# import io_tools
+import numpy as np
+from PIL import Image, ImageSequence
+
+import fix
+import io_tools
 
 
 def test_directories_to_files():
     pass
+
+
+def test_encode_gif():
+    img = Image.open("examples/toy_in.gif")
+    output_frames = fix.process_image(img)
+    durations = list(range(20, 20 + 10 * len(output_frames), 10))
+
+    encoded = Image.open(io.BytesIO(io_tools.encode_gif(output_frames, durations)))
+    assert encoded.n_frames == len(output_frames)
+
+    # Exact colors and per-frame durations
+    for frame, expected, duration in zip(
+        ImageSequence.Iterator(encoded), output_frames, durations
+    ):
+        assert frame.info["duration"] == duration
+        assert np.array_equal(np.asarray(frame.convert("RGBA")), expected)
+
+
+def test_save_from_frames(tmp_path, monkeypatch):
+    # Animations with transparency, written without optimize, are encoded one
+    # (upscaled) frame at a time too, rather than through PIL images of every frame,
+    # and keep their exact colors (and transparency, even after an opaque first
+    # frame)
+    img = Image.open("examples/toy_in.gif")
+    output_frames = fix.process_image(img)
+    output_frames[1:, 0:2, 0:3] = 0
+
+    fromarray = Image.fromarray
+    calls = []
+    monkeypatch.setattr(
+        Image,
+        "fromarray",
+        lambda array, *args, **kwargs: calls.append(array.shape)
+        or fromarray(array, *args, **kwargs),
+    )
+    out_path = tmp_path / "out.gif"
+    io_tools.save_from_frames(
+        img, output_frames, out_path, True, optimize=False, scale=(2, 3)
+    )
+    assert not any(len(shape) == 3 for shape in calls)
+    monkeypatch.undo()
+
+    expected = np.repeat(np.repeat(output_frames, 2, axis=1), 3, axis=2)
+    output = Image.open(out_path)
+    assert output.n_frames == len(output_frames)
+    for frame, expected_frame in zip(ImageSequence.Iterator(output), expected):
+        transparent = expected_frame[..., 3] == 0
+        frame = np.asarray(frame.convert("RGBA"))
+        assert np.array_equal(frame[..., 3] == 0, transparent)
+        assert np.array_equal(frame[~transparent], expected_frame[~transparent])
+
+
+def test_save_lossless(tmp_path):
+    rng = np.random.default_rng(seed=0)
+
+    # More colors than a GIF palette can hold, and some transparency
+    frames = rng.integers(0, 256, size=(4, 9, 14, 4), dtype=np.uint8)
+    frames[..., 3] = 255
+    frames[:, 0:3, 0:3] = 0
+    durations = [20, 40, 60, 80]
+
+    for output_format in ("webp", "apng"):
+        out_path = tmp_path / f"out{io_tools.OUTPUT_FORMATS[output_format]}"
+        io_tools.save_lossless(frames, durations, out_path, output_format, (2, 3))
+
+        image = Image.open(out_path)
+        assert image.format == {"webp": "WEBP", "apng": "PNG"}[output_format]
+        assert image.size == (42, 18)
+        assert image.n_frames == 4
+
+        expected = np.repeat(np.repeat(frames, 2, axis=1), 3, axis=2)
+        for frame, expected_frame, duration in zip(
+            ImageSequence.Iterator(image), expected, durations
+        ):
+            assert np.array_equal(np.asarray(frame.convert("RGBA")), expected_frame)
+            assert frame.info["duration"] == duration
+
+
+def make_archives(directory, members):
+    # The same members (name -> bytes) in a zip and in a compressed tar
+    zip_path = directory / "in.zip"
+    with zipfile.ZipFile(zip_path, "w") as archive:
+        archive.writestr("empty/", b"")
+        for name, data in members.items():
+            archive.writestr(name, data)
+
+    tar_path = directory / "in.tar.gz"
+    with tarfile.open(tar_path, "w:gz") as archive:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+
+    return zip_path, tar_path
+
+
+def test_archives(tmp_path):
+    members = {
+        "a/toy.gif": Path("examples/toy_in.gif").read_bytes(),
+        "b/toy.gif": Path("examples/trivial_in.gif").read_bytes(),
+        "../mario.png": Path("examples/mario.png").read_bytes(),
+    }
+    try:
+        for archive_path in make_archives(tmp_path, members):
+            files = io_tools.directories_to_files([str(archive_path), "x.gif"])
+            assert [str(path) for path in files] == [
+                f"{archive_path}/{name}" for name in members
+            ] + ["x.gif"]
+
+            # Members are read straight from the archive
+            for member in files[:-1]:
+                with io_tools.open_input(member) as fp:
+                    assert fp.read() == members[member.name]
+            with io_tools.open_input(files[0]) as fp:
+                assert Image.open(fp).n_frames == 41
+
+            # ... and never point outside of the directory they're extracted into
+            assert files[2].relative_path == Path("mario.png")
+    finally:
+        io_tools.close_archives()
+
+    for name in ("out.zip", "out.tar", "out.tar.xz"):
+        with io_tools.ArchiveWriter(tmp_path / name) as archive:
+            archive.add("examples/toy_in.gif", "a/toy.gif")
+        members = io_tools.archive_members(tmp_path / name)
+        assert [member.name for member in members] == ["a/toy.gif"]
+        try:
+            with io_tools.open_input(members[0]) as fp:
+                assert fp.read() == Path("examples/toy_in.gif").read_bytes()
+        finally:
+            io_tools.close_archives()
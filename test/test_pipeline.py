@@ -0,0 +1,37 @@
+import random
+import threading
+import time
+
+import pipeline
+
+
+def test_ordered_map():
+    assert list(pipeline.ordered_map(lambda x: x * 2, range(5))) == [0, 2, 4, 6, 8]
+
+    # Results come back in order, however long each item takes, and items are only
+    # taken from the iterable as results are consumed
+    taken = []
+    in_flight = []
+    lock = threading.Lock()
+
+    def items():
+        for item in range(40):
+            taken.append(item)
+            yield item
+
+    def work(item):
+        with lock:
+            in_flight.append(item)
+        time.sleep(random.uniform(0, 0.005))
+        return item * 2
+
+    with pipeline.frame_executor(4) as executor:
+        results = []
+        for result in pipeline.ordered_map(work, items(), executor, max_pending=5):
+            assert len(taken) - len(results) <= 5
+            results.append(result)
+    assert results == [2 * item for item in range(40)]
+    assert sorted(in_flight) == list(range(40))
+
+    with pipeline.frame_executor(1) as executor:
+        assert executor is None
@@ -0,0 +1,80 @@
+import json
+
+import numpy as np
+
+import fix
+import stage_metrics
+
+
+def test_stage_without_metrics():
+    # Outside of any active metrics, stages aren't recorded anywhere
+    assert stage_metrics.current() is None
+    with stage_metrics.stage("nothing", num_frames=3) as counts:
+        pass
+    assert counts["num_frames"] == 3
+
+
+def test_metrics():
+    metrics = stage_metrics.Metrics("in.gif", trace_memory=True)
+    with metrics.activate():
+        assert stage_metrics.current() is metrics
+        with stage_metrics.stage("outer", np.zeros((4, 3, 10, 20))):
+            with stage_metrics.stage("inner") as counts:
+                big = np.ones(2**20, dtype=np.uint8)
+                counts["num_frames"] += 2
+            del big
+        for _ in range(2):
+            with stage_metrics.stage("repeated", num_frames=1, num_pixels=5):
+                pass
+    assert stage_metrics.current() is None
+
+    result = metrics.to_dict()
+    assert result["path"] == "in.gif"
+    assert result["seconds"] > 0
+    stages = result["stages"]
+    assert list(stages) == ["inner", "outer", "repeated"]
+    assert (stages["outer"]["num_frames"], stages["outer"]["num_pixels"]) == (4, 800)
+    assert stages["inner"]["num_frames"] == 2
+    assert (stages["repeated"]["num_frames"], stages["repeated"]["num_pixels"]) == (
+        2,
+        10,
+    )
+
+    # The peak of a nested stage also counts towards the stage it's nested in
+    assert stages["inner"]["peak_bytes"] >= 2**20
+    assert stages["outer"]["peak_bytes"] >= 2**20
+    assert result["peak_bytes"] >= 2**20
+
+
+def test_profile(tmp_path, capsys):
+    out_directory = tmp_path / "out"
+    profile_path = tmp_path / "profile.json"
+    status = fix.main(
+        [
+            "examples/mario_86x54.png",
+            "--out",
+            str(out_directory),
+            "--profile",
+            str(profile_path),
+        ]
+    )
+    assert status == 0
+
+    # Nothing but the summary is printed by default
+    output = capsys.readouterr().out
+    assert output.startswith("Summary:")
+
+    with open(profile_path) as fp:
+        profile = json.load(fp)
+
+    png = profile["files"][0]
+    assert png["path"] == "examples/mario_86x54.png"
+    assert png["num_frames"] == 1
+    assert png["num_pixels"] == 86 * 54
+    for name in ("decode", "analyze_grid", "decimate_and_upscale", "save"):
+        assert png["stages"][name]["seconds"] > 0
+        assert png["stages"][name]["peak_bytes"] > 0
+    assert png["stages"]["decode"]["pixels_per_second"] > 0
+
+    assert profile["total"]["num_files"] == 1
+    assert "decode" in profile["total"]["stages"]
@@ -0,0 +1,94 @@
+import base64
+import io
+import json
+import subprocess
+import sys
+
+import numpy as np
+from PIL import Image
+
+import worker
+
+IN_PATH = "examples/mario_86x54.png"
+
+
+def expected_output():
+    return np.array(Image.open("examples/mario_86x54_output.png").convert("RGBA"))
+
+
+def decoded(data):
+    return np.array(Image.open(data).convert("RGBA"))
+
+
+def test_serve_lines(tmp_path):
+    requests = [
+        {"id": 1, "path": IN_PATH, "out": str(tmp_path / "out.png")},
+        {
+            "id": 2,
+            "data": base64.b64encode(open(IN_PATH, "rb").read()).decode("ascii"),
+            "name": "mario.png",
+            "options": ["--force-scale", "2"],
+        },
+        {"id": 3, "data": base64.b64encode(b"GIF89a not a gif").decode("ascii")},
+        {"id": 4, "path": IN_PATH, "options": ["--no-such-option"]},
+        {"id": 5, "path": IN_PATH, "options": ["--analyze-only"]},
+        {"id": 6, "path": IN_PATH, "options": ["--jobs", "2", "--force-square"]},
+        {"id": 7, "path": IN_PATH, "options": ["--out", str(tmp_path / "out")]},
+    ]
+    lines = [json.dumps(request) for request in requests] + ["", "not json"]
+
+    responses = []
+    jobs = worker.Worker(concurrency=2, scratch_dir=tmp_path)
+    try:
+        worker.serve_lines(jobs, lines, lambda line: responses.append(json.loads(line)))
+    finally:
+        jobs.close()
+
+    responses = {response["id"]: response for response in responses}
+    assert sorted(responses, key=str) == [1, 2, 3, 4, 5, 6, 7, None]
+
+    assert responses[1]["status"] == "ok"
+    assert np.array_equal(decoded(tmp_path / "out.png"), expected_output())
+
+    # The output is sent back when no output path is given
+    assert responses[2]["status"] == "ok"
+    data = base64.b64decode(responses[2]["data"])
+    assert np.array_equal(decoded(io.BytesIO(data)), expected_output())
+    assert responses[2]["seconds"] >= responses[2]["processing_seconds"] > 0
+    assert responses[2]["metrics"]["num_frames"] == 1
+
+    assert responses[3]["status"] == "failed"
+    assert responses[4]["status"] == "failed"
+    assert "Invalid options" in responses[4]["error"]
+
+    # Options that only apply to a whole batch are rejected, rather than ignored
+    for request_id, flag in ((5, "--analyze-only"), (6, "--jobs"), (7, "--out")):
+        assert responses[request_id]["status"] == "failed"
+        assert f"{flag} can't be given to a single job" in (
+            responses[request_id]["error"]
+        )
+    assert responses[None]["error"].startswith("Bad request")
+
+    # Only the requested output is left behind
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["out.png"]
+
+
+def test_stdio(tmp_path):
+    requests = [
+        {"id": index, "path": IN_PATH, "out": str(tmp_path / f"out_{index}.png")}
+        for index in range(3)
+    ]
+    process = subprocess.run(
+        [sys.executable, "src/worker.py", "--concurrency", "2"],
+        input="\n".join(json.dumps(request) for request in requests) + "\n",
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+    assert process.returncode == 0
+
+    responses = [json.loads(line) for line in process.stdout.splitlines()]
+    assert sorted(response["id"] for response in responses) == [0, 1, 2]
+    assert all(response["status"] == "ok" for response in responses)
+    for index in range(3):
+        assert np.array_equal(decoded(tmp_path / f"out_{index}.png"), expected_output())